@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# Extract the static files that Shiny apps serve at lib/<name>-<version>/ from the
+# shiny and htmltools wheels that we ship, so that the service worker can serve them
+# without asking the app. This writes the files to build/shinylive/app-dependencies/,
+# along with a manifest, app-dependencies.json, which lists them.
+
+import importlib
+import inspect
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any
+
+# The top-level directory of this repository.
+topdir = Path(__file__).parent.parent
+
+package_lock_file = topdir / "shinylive_lock.json"
+pyodide_dir = topdir / "build" / "shinylive" / "pyodide"
+destdir = topdir / "build" / "shinylive" / "app-dependencies"
+manifest_file = topdir / "build" / "shinylive" / "app-dependencies.json"
+
+# The wheels whose dependencies are extracted.
+PACKAGES = ("shiny", "htmltools")
+
+# Modules that define the HTML dependencies that come with shiny. Each function in
+# these modules that can be called without arguments and returns dependencies is used.
+DEPENDENCY_MODULES = (
+    "shiny.html_dependencies",
+    "shiny.ui._html_deps_external",
+    "shiny.ui._html_deps_py_shiny",
+    "shiny.ui._html_deps_shinyverse",
+)
+
+
+def install_wheels(target: str) -> None:
+    """
+    Install the shipped wheels in `target`, so that the files we extract are the ones
+    that apps will actually serve, and not whatever version is in the venv. Their own
+    dependencies (starlette and so on) come from the venv.
+    """
+    with open(package_lock_file, "r") as f:
+        lockfile = json.load(f)
+
+    wheels = [str(pyodide_dir / lockfile[name]["filename"]) for name in PACKAGES]
+    subprocess.run(
+        [sys.executable, "-m", "pip", "install", "--quiet", "--no-deps"]
+        + ["--target", target]
+        + wheels,
+        check=True,
+    )
+
+
+def find_dependencies() -> list[Any]:
+    from htmltools import HTMLDependency
+
+    deps: dict[str, HTMLDependency] = {}
+
+    def add(x: object) -> None:
+        if isinstance(x, HTMLDependency):
+            deps[f"{x.name}-{x.version}"] = x
+        elif isinstance(x, (list, tuple)):
+            for item in x:  # pyright: ignore[reportUnknownVariableType]
+                add(item)  # pyright: ignore[reportUnknownArgumentType]
+
+    for module_name in DEPENDENCY_MODULES:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        for name, fn in inspect.getmembers(module, inspect.isfunction):
+            if fn.__module__ != module_name:
+                continue
+            params = inspect.signature(fn).parameters.values()
+            if any(p.default is inspect.Parameter.empty for p in params):
+                continue
+            try:
+                add(fn())
+            except Exception as e:
+                print(f"  Skipping {module_name}.{name}(): {e}")
+
+    return list(deps.values())
+
+
+def declared_files(dep: Any, source: str) -> list[str]:
+    """
+    The files that an app serves for `dep`, relative to its `source` directory: its
+    scripts and stylesheets, or, if it was created with `all_files=True`, every file
+    in the directory.
+    """
+    if dep.all_files:
+        return [
+            os.path.relpath(os.path.join(root, filename), source)
+            for root, _, filenames in os.walk(source)
+            for filename in filenames
+        ]
+    files = [script["src"] for script in dep.script]
+    files += [stylesheet["href"] for stylesheet in dep.stylesheet]
+    return [f for f in dict.fromkeys(files) if os.path.isfile(os.path.join(source, f))]
+
+
+def main() -> None:
+    shutil.rmtree(destdir, ignore_errors=True)
+    destdir.mkdir(parents=True)
+
+    files: list[str] = []
+
+    with tempfile.TemporaryDirectory() as target:
+        install_wheels(target)
+        sys.path.insert(0, target)
+
+        for dep in find_dependencies():
+            paths = dep.source_path_map(lib_prefix="lib")
+            if not paths["source"] or not os.path.isdir(paths["source"]):
+                continue
+
+            # paths["href"] is lib/<name>-<version>.
+            dirname = paths["href"].removeprefix("lib/")
+            print(f"  {dirname}")
+            for file in declared_files(dep, paths["source"]):
+                dest = destdir / dirname / file
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(os.path.join(paths["source"], file), dest)
+                files.append(f"{dirname}/{Path(file).as_posix()}")
+
+    print(f"Writing {os.path.relpath(manifest_file)}")
+    with open(manifest_file, "w") as f:
+        json.dump({"files": sorted(files)}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
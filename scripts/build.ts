@@ -1,4 +1,5 @@
 import { spawn } from "child_process";
+import { createHash } from "crypto";
 import esbuild from "esbuild";
 import * as fs from "fs";
 import http from "http";
@@ -84,6 +85,102 @@ const metafilePlugin = {
   },
 };
 
+// Identifies the versions of the shiny and htmltools wheels that are being
+// shipped. The service worker caches the static dependencies that apps serve
+// (Bootstrap, shiny.js, etc.) under this key, so a new wheel gets a fresh
+// cache. A wheel that's been built locally may change without a new version
+// number, so the wheel's contents are part of the key when it's on disk.
+function appDependenciesKey(): string {
+  const lockfile = JSON.parse(fs.readFileSync("shinylive_lock.json", "utf8"));
+  return ["shiny", "htmltools"]
+    .map((name) => {
+      const { version, filename } = lockfile[name];
+      const wheelPath = `${BUILD_DIR}/shinylive/pyodide/${filename}`;
+      if (!fs.existsSync(wheelPath)) {
+        return `${name}-${version}`;
+      }
+      const hash = createHash("sha256")
+        .update(fs.readFileSync(wheelPath))
+        .digest("hex")
+        .slice(0, 12);
+      return `${name}-${version}-${hash}`;
+    })
+    .join("+");
+}
+
+// The files that the service worker downloads when it's installed, so that
+// Shinylive can start without the network: the bundles in shinylive/, and the
+// parts of Pyodide and the packages that are loaded when it starts. Each one
+// has an SRI hash, which is checked when it's downloaded, and which tells the
+// service worker whether the copy it has cached is current.
+type PrecacheManifest = {
+  version: string;
+  // `core` files are downloaded when the service worker is installed, and the
+  // rest in the background once it's active.
+  entries: { url: string; integrity: string; core: boolean }[];
+};
+
+// Pyodide packages that are loaded at startup, besides the ones in
+// shinylive_lock.json.
+const PRECACHE_PYODIDE_PACKAGES = ["micropip", "ssl"];
+
+function precacheManifest(): PrecacheManifest {
+  // URLs are relative to the service worker. The core files are shinylive's
+  // own, and Pyodide's.
+  const coreUrls: string[] = fs
+    .readdirSync(`${BUILD_DIR}/shinylive`)
+    .filter((file) => fs.statSync(`${BUILD_DIR}/shinylive/${file}`).isFile())
+    .map((file) => `shinylive/${file}`);
+  const packageUrls: string[] = [];
+
+  const pyodideDir = `${BUILD_DIR}/shinylive/pyodide`;
+  if (fs.existsSync(`${pyodideDir}/pyodide-lock.json`)) {
+    coreUrls.push(
+      ...[
+        "pyodide.mjs",
+        "pyodide.asm.js",
+        "pyodide.asm.wasm",
+        "python_stdlib.zip",
+        "pyodide-lock.json",
+      ].map((file) => `shinylive/pyodide/${file}`),
+    );
+
+    // The packages, and everything they depend on. These add up to around
+    // 100MB, and an app can start without them, so they're not core files.
+    const pyodideLock = JSON.parse(
+      fs.readFileSync(`${pyodideDir}/pyodide-lock.json`, "utf8"),
+    );
+    const lockfile = JSON.parse(fs.readFileSync("shinylive_lock.json", "utf8"));
+    const pending = [...Object.keys(lockfile), ...PRECACHE_PYODIDE_PACKAGES];
+    const seen = new Set<string>();
+    while (pending.length > 0) {
+      const name = pending.pop()!.toLowerCase();
+      const pkg = pyodideLock.packages[name];
+      if (seen.has(name) || !pkg) continue;
+      seen.add(name);
+      packageUrls.push(`shinylive/pyodide/${pkg.file_name}`);
+      pending.push(...pkg.depends);
+    }
+  }
+
+  const entries = [
+    ...coreUrls.map((url) => ({ url, core: true })),
+    ...packageUrls.map((url) => ({ url, core: false })),
+  ]
+    .filter(({ url }) => fs.existsSync(`${BUILD_DIR}/${url}`))
+    .map(({ url, core }) => {
+      const hash = createHash("sha256")
+        .update(fs.readFileSync(`${BUILD_DIR}/${url}`))
+        .digest("base64");
+      return { url, integrity: `sha256-${hash}`, core };
+    });
+  const version = createHash("sha256")
+    .update(JSON.stringify(entries))
+    .digest("hex")
+    .slice(0, 12);
+  return { version, entries };
+}
+
 function readdirSyncRecursive(dir: string, root: string = dir): string[] {
   return fs.readdirSync(dir).reduce((files: string[], file: string) => {
     const name = path.join(dir, file);
@@ -242,7 +339,12 @@ const buildmap = {
     minify: false,
     plugins: [createRebuildLoggerPlugin("shinylive-inject-socket")],
   }),
-  "shinylive-sw": esbuild.context({
+};
+
+// The service worker is built separately, because it has a list of the other
+// files in the build to cache.
+function buildServiceWorker(precache: PrecacheManifest) {
+  return esbuild.context({
     bundle: true,
     entryPoints: ["src/shinylive-sw.ts"],
     outdir: `${BUILD_DIR}`,
@@ -250,15 +352,17 @@ const buildmap = {
     target: "es2020",
     minify: minify,
     banner: banner,
+    define: {
+      SHINYLIVE_APP_DEPENDENCIES_KEY: JSON.stringify(appDependenciesKey()),
+      SHINYLIVE_PRECACHE_MANIFEST: JSON.stringify(precache),
+      SHINYLIVE_VERSION: JSON.stringify(SHINYLIVE_VERSION),
+    },
     plugins: [createRebuildLoggerPlugin("shinylive-sw")],
-  }),
-};
-
-// Build shinylive website HTML in /site for R or Python as requested
-buildSiteHtml(appEngine, googleTagManagerId);
+  });
+}
 
-Object.values(buildmap).forEach((build) =>
-  build
+function runBuild(build: Promise<esbuild.BuildContext>): Promise<void> {
+  return build
     .then(async (context) => {
       if (watch) {
         await context.watch();
@@ -269,8 +373,23 @@ Object.values(buildmap).forEach((build) =>
         await context.dispose();
       }
     })
-    .catch(() => process.exit(1)),
-);
+    .catch(() => process.exit(1));
+}
+
+// Build shinylive website HTML in /site for R or Python as requested
+buildSiteHtml(appEngine, googleTagManagerId);
+
+const builds = Object.values(buildmap).map(runBuild);
+if (watch) {
+  // The files change as they're worked on, so don't cache them.
+  // eslint-disable-next-line @typescript-eslint/no-floating-promises
+  runBuild(buildServiceWorker({ version: "", entries: [] }));
+} else {
+  // eslint-disable-next-line @typescript-eslint/no-floating-promises
+  Promise.all(builds).then(() =>
+    runBuild(buildServiceWorker(precacheManifest())),
+  );
+}
 
 if (serve) {
   buildmap["app"]
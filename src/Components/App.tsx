@@ -1,6 +1,7 @@
 import LZString from "lz-string";
 import * as React from "react";
 import { createRoot } from "react-dom/client";
+import { EnginePool, poolSizeFromMetaTag } from "../engine-pool";
 import {
   findExampleByTitle,
   getExampleCategories,
@@ -12,7 +13,9 @@ import { useRunOnceOnMount } from "../hooks/useRunOnceOnMount";
 import type { WebRProxyHandle } from "../hooks/useWebR";
 import { initRShiny, initWebR, useWebR } from "../hooks/useWebR";
 import { loadStatusStore } from "../load-status";
+import { prefetchPackagesForFiles } from "../prefetch-packages";
 import type { ProxyType } from "../pyodide-proxy";
+import { currentScriptDir, engineSwitch } from "../utils";
 import "./App.css";
 import { type EditorMethods } from "./Editor";
 import { ExampleSelector } from "./ExampleSelector";
@@ -64,10 +67,21 @@ export type UtilityMethods = {
   formatCode: (code: string) => Promise<string>;
 };
 
-const pyodideProxyType: ProxyType =
-  new URLSearchParams(window.location.search).get("webworker") === "0"
-    ? "normal"
-    : "webworker";
+// ?webworker=0 runs Python on the main thread, and ?sharedworker=1 runs it in a
+// SharedWorker, shared with other tabs and iframes that ask for the same. With
+// a pool of engines, each one is a separate SharedWorker, which the page's
+// engine at the same position in other tabs' pools shares.
+const pyodideProxyType: ProxyType = (() => {
+  const params = new URLSearchParams(window.location.search);
+  if (params.get("webworker") === "0") return "normal";
+  if (params.get("sharedworker") === "1") return "sharedworker";
+  return "webworker";
+})();
+
+// ?metrics=1 records timings for the messages to and from the Python engine;
+// see rpc-metrics.ts.
+const pyodideMetrics =
+  new URLSearchParams(window.location.search).get("metrics") === "1";
 
 export type AppEngine = "python" | "r";
 export type AppMode =
@@ -122,69 +136,126 @@ type AppOptions = {
         defaultTitle: string;
       }
     | false;
+
+  // Python modules to import in the background once the engine is ready, so
+  // that starting the app doesn't have to. Defaults to shiny and
+  // shiny.express. Only the first app on a page to start the engine decides.
+  warmUpModules?: string[];
+
+  // Lines of Python output per second to show in the terminal. Output past
+  // that is dropped, with a note saying how many lines were. 0 means no limit.
+  // As with warmUpModules, the first app to start the engine decides.
+  outputRateLimit?: number;
+
+  // When the page has more than one Python engine (set with a
+  // <meta name="shinylive:pyodide_pool_size"> tag), how heavy this app is
+  // relative to others, for assigning it to an engine. Defaults to 1.
+  engineWeight?: number;
+
+  // Run this app on the same engine as the other apps that set this, instead
+  // of whichever engine is least busy.
+  shareEngine?: boolean;
 };
 
 export type ProxyHandle = PyodideProxyHandle | WebRProxyHandle;
-let pyodideProxyHandlePromise: Promise<PyodideProxyHandle> | null = null;
 let webRProxyHandlePromise: Promise<WebRProxyHandle> | null = null;
 
+// Python engines, for the blocks on the page. Each is created the first time
+// it's needed. By default there's one, shared by every block; see
+// engine-pool.ts.
+const pyodidePool = new EnginePool<Promise<PyodideProxyHandle>>(
+  poolSizeFromMetaTag("shinylive:pyodide_pool_size"),
+);
+
 function ensurePyodideProxyHandlePromise({
+  engineWeight,
+  shareEngine,
+  engineOwner,
+  ...options
+}: Parameters<typeof createPyodideProxyHandlePromise>[0] & {
+  engineWeight?: number;
+  shareEngine?: boolean;
+  engineOwner?: string;
+}): Promise<PyodideProxyHandle> {
+  // An engine's options are set by the first block to be assigned to it.
+  const engineIndex = pyodidePool.size;
+  return pyodidePool.acquire(
+    () => createPyodideProxyHandlePromise({ ...options, engineIndex }),
+    { weight: engineWeight, shared: shareEngine, owner: engineOwner },
+  );
+}
+
+function createPyodideProxyHandlePromise({
   proxyType,
   shiny,
   showStartBanner,
+  warmUpModules,
+  outputRateLimit,
+  engineIndex = 0,
 }: {
   proxyType: ProxyType;
   shiny: boolean;
   showStartBanner: boolean;
+  warmUpModules?: string[];
+  outputRateLimit?: number;
+  // The engine's position in the pool.
+  engineIndex?: number;
 }): Promise<PyodideProxyHandle> {
-  if (!pyodideProxyHandlePromise) {
-    pyodideProxyHandlePromise = (async (): Promise<PyodideProxyHandle> => {
-      let pyodideProxyHandle: PyodideProxyHandle;
+  // The terminal and the bytecode cache are shared, so only the first engine
+  // clears the one and saves the other.
+  const firstEngine = engineIndex === 0;
+  return (async (): Promise<PyodideProxyHandle> => {
+    let pyodideProxyHandle: PyodideProxyHandle;
+
+    // Ensure pyodide engine and shiny can be successfully initialized
+    // If not, set the status to "failed" to report the error to the user
+    try {
+      pyodideProxyHandle = await initPyodide({
+        proxyType,
+        stdout: terminalInterface.echo,
+        stderr: terminalInterface.error,
+        outputRateLimit,
+        metrics: pyodideMetrics,
+        persistBytecode: firstEngine,
+        engineIndex,
+      });
 
-      // Ensure pyodide engine and shiny can be successfully initialized
-      // If not, set the status to "failed" to report the error to the user
-      try {
-        pyodideProxyHandle = await initPyodide({
-          proxyType,
-          stdout: terminalInterface.echo,
-          stderr: terminalInterface.error,
+      if (shiny) {
+        pyodideProxyHandle = await initShiny({
+          pyodideProxyHandle,
+          warmUpModules,
         });
-
-        if (shiny) {
-          pyodideProxyHandle = await initShiny({ pyodideProxyHandle });
-        }
-      } catch (e) {
-        loadStatusStore("python").set(
-          "failed",
-          e instanceof Error ? e.message : String(e),
-        );
-        throw e;
       }
+    } catch (e) {
+      loadStatusStore("python").set(
+        "failed",
+        e instanceof Error ? e.message : String(e),
+      );
+      throw e;
+    }
 
-      if (!pyodideProxyHandle.initError) {
-        try {
-          // This section for printing the terminal console banner is cosmetic only
-          // and logs any errors to the browser console, rather than marking the engine
-          // load as failed "failed".
-          terminalInterface.clear();
-
-          if (showStartBanner) {
-            // When we get here, .ready will always be true.
-            if (pyodideProxyHandle.ready) {
-              await pyodideProxyHandle.pyodide.runPyAsync(
-                `print(pyodide.console.BANNER); print(" ")`,
-              );
-            }
+    if (!pyodideProxyHandle.initError && firstEngine) {
+      try {
+        // This section for printing the terminal console banner is cosmetic only
+        // and logs any errors to the browser console, rather than marking the engine
+        // load as failed "failed".
+        terminalInterface.clear();
+
+        if (showStartBanner) {
+          // When we get here, .ready will always be true.
+          if (pyodideProxyHandle.ready) {
+            await pyodideProxyHandle.pyodide.runPyAsync(
+              `print(pyodide.console.BANNER); print(" ")`,
+            );
           }
-        } catch (e) {
-          console.error(e);
         }
+      } catch (e) {
+        console.error(e);
       }
+    }
 
-      return pyodideProxyHandle;
-    })();
-  }
-  return pyodideProxyHandlePromise;
+    return pyodideProxyHandle;
+  })();
 }
 
 function ensureWebRProxyHandlePromise({
@@ -196,7 +267,7 @@ function ensureWebRProxyHandlePromise({
     webRProxyHandlePromise = (async (): Promise<WebRProxyHandle> => {
       let webRProxyHandle: WebRProxyHandle;
 
-      // See the note in ensurePyodideProxyHandlePromise: only engine readiness
+      // See the note in createPyodideProxyHandlePromise: only engine readiness
       // belongs in here, because "failed" is terminal.
       try {
         webRProxyHandle = await initWebR({
@@ -266,18 +337,38 @@ export function App({
   // For most but not all appMode, set up pyodide for shiny.
   const loadShiny = !["editor-terminal"].includes(appMode);
 
-  let useWasmEngine: () => ProxyHandle;
-  switch (appEngine) {
-    case "python": {
+  // Each App takes a Python engine from the pool, and gives it back when it
+  // unmounts. It asks as the same owner every time, so that re-rendering keeps
+  // it on the same engine, counted once. The effect acquires it again because
+  // StrictMode unmounts and remounts effects once, and the render doesn't run
+  // in between.
+  const engineOwner = React.useId();
+  const acquirePyodideProxyHandlePromise = () =>
+    ensurePyodideProxyHandlePromise({
+      proxyType: pyodideProxyType,
+      shiny: loadShiny,
       // Temporarily disabled
       // Modes in which _not_ to show Pyodide startup message.
       // const showStartBanner = !["editor-terminal"].includes(appMode);
-      const promise = ensurePyodideProxyHandlePromise({
-        proxyType: pyodideProxyType,
-        shiny: loadShiny,
-        showStartBanner: false,
-      });
-      pyodideProxyHandlePromise = promise;
+      showStartBanner: false,
+      warmUpModules: appOptions.warmUpModules,
+      outputRateLimit: appOptions.outputRateLimit,
+      engineWeight: appOptions.engineWeight,
+      shareEngine: appOptions.shareEngine,
+      engineOwner,
+    });
+  const pyodideProxyHandlePromise =
+    appEngine === "python" ? acquirePyodideProxyHandlePromise() : undefined;
+  React.useEffect(() => {
+    if (appEngine !== "python") return;
+    acquirePyodideProxyHandlePromise();
+    return () => pyodidePool.release(engineOwner);
+  }, [engineOwner]);
+
+  let useWasmEngine: () => ProxyHandle;
+  switch (appEngine) {
+    case "python": {
+      const promise = pyodideProxyHandlePromise!;
       useWasmEngine = () => usePyodide({ pyodideProxyHandlePromise: promise });
       break;
     }
@@ -793,6 +884,13 @@ export function runApp(
     // FileContent[]. Ensure that they're all FileContent.
     startFiles = startFiles.map(FCorFCJSONtoFC);
 
+    // Start downloading the packages the app imports now, so that it happens
+    // while the engine boots rather than after.
+    if (engineSwitch(appEngine, false, true)) {
+      // eslint-disable-next-line @typescript-eslint/no-floating-promises
+      prefetchPackagesForFiles(startFiles, currentScriptDir() + "/pyodide/");
+    }
+
     const { ...appOpts } = opts;
     delete appOpts.allowCodeUrl;
     delete appOpts.allowExampleUrl;
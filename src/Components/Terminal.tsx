@@ -18,6 +18,9 @@ export interface TerminalInterface {
   set_clear_fn(fn: () => void): void;
 }
 
+// How much output the terminal collects before writing it, at most.
+const maxPendingOutputLength = 64 * 1024;
+
 export type TerminalMethods =
   | { ready: false }
   | {
@@ -41,13 +44,53 @@ export function Terminal({
   const xTermRef = React.useRef<XTerminal | null>(null);
   const [xTermReadline, setXTermReadline] = React.useState<Readline>();
 
+  // Output can arrive much faster than xterm can render it, so it's collected
+  // and written once per animation frame. Anything else that writes to the
+  // terminal must call flushOutput() first, to keep things in order. Browsers
+  // don't run animation frames in background tabs, so past
+  // maxPendingOutputLength characters, output is written right away instead.
+  const pendingOutputRef = React.useRef<{
+    text: string;
+    frame: number | null;
+  }>({ text: "", frame: null });
+  function flushOutput(readline: Readline) {
+    const pending = pendingOutputRef.current;
+    if (pending.frame !== null) {
+      cancelAnimationFrame(pending.frame);
+      pending.frame = null;
+    }
+    if (pending.text) {
+      readline.print(pending.text);
+      pending.text = "";
+    }
+  }
+  function queueOutput(readline: Readline, text: string) {
+    const pending = pendingOutputRef.current;
+    pending.text += text;
+    if (pending.text.length >= maxPendingOutputLength) {
+      flushOutput(readline);
+    } else if (pending.frame === null) {
+      pending.frame = requestAnimationFrame(() => flushOutput(readline));
+    }
+  }
+
+  // Whether a command from the terminal is running. Ctrl+C only restarts Python
+  // (when it can't be interrupted) if so, since otherwise there'd be nothing to
+  // stop, and restarting would lose all Python state for no reason.
+  const commandRunningRef = React.useRef(false);
+
   const runCodeRef = React.useRef(
     async (command: string): Promise<string> => "",
   );
   React.useEffect(() => {
     runCodeRef.current = async (command: string) => {
       if (!proxyHandle.ready) return "";
-      return (await proxyHandle.runCode(command)) ?? ">>> ";
+      commandRunningRef.current = true;
+      try {
+        return (await proxyHandle.runCode(command)) ?? ">>> ";
+      } finally {
+        commandRunningRef.current = false;
+      }
     };
   }, [proxyHandle]);
 
@@ -146,18 +189,21 @@ export function Terminal({
       // await jqTermRefCurrent.exec(msg);
     });
     terminalInterface.set_echo_fn(async (msg: string) => {
-      xTermReadline.println(msg);
+      queueOutput(xTermReadline, msg + "\n");
     });
     terminalInterface.set_error_fn(async (msg: string) => {
-      xTermReadline.println("\x1b[31m" + msg + "\x1b[m");
+      queueOutput(xTermReadline, "\x1b[31m" + msg + "\x1b[m\n");
     });
     terminalInterface.set_clear_fn(() => {
+      flushOutput(xTermReadline);
       xTermRefCurrent.write("\x1b[2K\r");
     });
 
     const runCodeInTerminal = async (command: string): Promise<void> => {
+      flushOutput(xTermReadline);
       xTermReadline.println(command);
       const prompt = await runCodeRef.current(command);
+      flushOutput(xTermReadline);
       xTermReadline.print(prompt);
     };
 
@@ -176,6 +222,7 @@ export function Terminal({
 
     function readLine(prompt: string) {
       if (!xTermReadline) return;
+      flushOutput(xTermReadline);
       // eslint-disable-next-line @typescript-eslint/no-floating-promises
       xTermReadline.read(prompt).then(processLine);
     }
@@ -186,16 +233,22 @@ export function Terminal({
       setTimeout(() => readLine(prompt));
     }
 
-    // Handle ctrl-c above xterm-readline so that blocking R code or Shiny apps
-    // executed by the Editor can also be interrupted
+    // Handle ctrl-c above xterm-readline so that blocking R or Python code, or
+    // Shiny apps executed by the Editor, can also be interrupted
     function handleInterrupt(event: KeyboardEvent) {
       if (!xTermRef.current) return;
       if (!proxyHandle.ready) return;
-      if (proxyHandle.engine !== "webr") return;
       if (event.key === "c" && event.ctrlKey) {
-        xTermRef.current.write("^C");
-        proxyHandle.interrupt();
-        event.stopPropagation();
+        if (proxyHandle.engine === "webr") {
+          xTermRef.current.write("^C");
+          proxyHandle.interrupt();
+          event.stopPropagation();
+        } else if (commandRunningRef.current) {
+          xTermRef.current.write("^C");
+          // eslint-disable-next-line @typescript-eslint/no-floating-promises
+          proxyHandle.interrupt({ restart: true });
+          event.stopPropagation();
+        }
       }
     }
     containerRef.current!.addEventListener("keydown", handleInterrupt, true);
@@ -1,6 +1,8 @@
 import * as React from "react";
+import { registerApp } from "../app-registry";
 import { rCharacterField } from "../r-status";
 import { useLoadStatus } from "../hooks/useLoadStatus";
+import { registerAppEngine } from "../hooks/usePyodide";
 import type { EngineName } from "../load-status";
 import { ENGINE_LABEL } from "../load-status";
 import type { PyodideProxy } from "../pyodide-proxy";
@@ -18,6 +20,10 @@ export type ViewerMethods =
       ready: true;
       runApp: (appCode: string | FileContent[]) => Promise<void>;
       stopApp: () => Promise<void>;
+      // Stop the app's code if it's stuck. For Python, this restarts the engine
+      // if it can't be interrupted; the app is then started again, unless it
+      // was still starting up.
+      interruptApp: () => Promise<void>;
     };
 
 // =============================================================================
@@ -34,61 +40,13 @@ function setupAppProxyPath(proxy: PyodideProxy | WebRProxy): {
   const appName = `app_${utils.makeRandomKey(20)}`;
   const urlPath = appName + "/";
 
-  if (!navigator.serviceWorker.controller) {
-    throw new Error("ServiceWorker controller was not found!");
-  }
-
-  // There are two times that we need to register the app path with the service
-  // worker. One time is when this Viewer component starts up. Another time is
-  // when the service worker restarts: service workers can shut down at any time
-  // and will restart as needed. When the service worker shuts down, it will
-  // lose the state that tells it how to proxy requests for `urlPath`, so when
-  // it restarts, we need to re-register with the service worker.
-  createHttpRequestChannel(proxy, appName, urlPath);
-
-  // Listen for the service worker's restart messages and re-register.
-  navigator.serviceWorker.addEventListener("message", (event) => {
-    if (event.data.type === "serviceworkerStart") {
-      createHttpRequestChannel(proxy, appName, urlPath);
-    }
-  });
+  // This also re-registers the app when the service worker restarts; see
+  // app-registry.ts.
+  registerApp(proxy, appName);
 
   return { appName, urlPath };
 }
 
-// Register the app path with the service worker
-function createHttpRequestChannel(
-  proxy: PyodideProxy | WebRProxy,
-  appName: string,
-  urlPath: string,
-): MessageChannel {
-  if (!navigator.serviceWorker.controller) {
-    throw new Error("ServiceWorker controller was not found!");
-  }
-
-  // Will this get GC'd on subsequent calls?
-  const httpRequestChannel = new MessageChannel();
-
-  httpRequestChannel.port1.addEventListener("message", (event) => {
-    const msg = event.data;
-    if (msg.type === "makeRequest") {
-      // eslint-disable-next-line @typescript-eslint/no-floating-promises
-      proxy.makeRequest(msg.scope, appName, event.ports[0]);
-    }
-  });
-  httpRequestChannel.port1.start();
-
-  navigator.serviceWorker.controller.postMessage(
-    {
-      type: "configureProxyPath",
-      path: urlPath,
-    },
-    [httpRequestChannel.port2],
-  );
-
-  return httpRequestChannel;
-}
-
 // Recovery hint shown above the error log when the engine itself fails to load.
 // A stale cache is a common cause, so suggest the user to try a hard refresh
 function RecoveryHint() {
@@ -204,6 +162,18 @@ export function Viewer({
     null,
   );
   const engineStatus = useLoadStatus(engine);
+  // The code of the Python app that's running, to start it again if the engine
+  // is restarted.
+  const runningAppCodeRef = React.useRef<string | FileContent[] | null>(null);
+
+  async function interruptApp(): Promise<void> {
+    if (!proxyHandle.ready) return;
+    if (proxyHandle.engine === "pyodide") {
+      await proxyHandle.interrupt({ restart: true });
+    } else {
+      proxyHandle.interrupt();
+    }
+  }
 
   // Add effect to monitor iframe title changes
   React.useEffect(() => {
@@ -353,6 +323,7 @@ export function Viewer({
       ready: true,
       runApp,
       stopApp,
+      interruptApp,
     });
   }, [proxyHandle.shinyReady]);
 
@@ -363,6 +334,7 @@ export function Viewer({
 
     const pyodideproxy = proxyHandle.pyodide;
     const appInfo = setupAppProxyPath(pyodideproxy);
+    registerAppEngine(appInfo.appName, pyodideproxy);
 
     async function runApp(appCode: string | FileContent[]): Promise<void> {
       try {
@@ -370,6 +342,7 @@ export function Viewer({
           throw new Error("Viewer iframe is not yet initialized");
 
         setAppRunningState("loading");
+        runningAppCodeRef.current = null;
 
         if (typeof appCode === "string") {
           appCode = [
@@ -384,20 +357,22 @@ export function Viewer({
         const appName = appInfo.appName;
 
         // Save the code in /home/pyodide/{appName} so we can load it as a
-        // module.
-        await pyodideproxy.callPyAsync({
-          fnName: ["_save_files"],
-          args: [appCode, "/home/pyodide/" + appName],
-        });
-
-        await pyodideproxy.callPyAsync({
-          fnName: ["_start_app"],
-          args: [appName],
-          kwargs: { dev_mode: devMode },
-        });
+        // module, and start the app, in a single round trip to the worker.
+        await pyodideproxy.callPyBatchAsync([
+          {
+            fnName: ["_save_files"],
+            args: [appCode, "/home/pyodide/" + appName],
+          },
+          {
+            fnName: ["_start_app"],
+            args: [appName],
+            kwargs: { dev_mode: devMode },
+          },
+        ]);
 
         viewerFrameRef.current.src = appInfo.urlPath;
         setAppRunningState("running");
+        runningAppCodeRef.current = appCode;
       } catch (e) {
         setAppRunningState("errored");
         if (e instanceof Error) {
@@ -412,6 +387,7 @@ export function Viewer({
     async function stopApp(): Promise<void> {
       if (!viewerFrameRef.current) return;
 
+      runningAppCodeRef.current = null;
       await resetPyAppFrame(
         pyodideproxy,
         appInfo.appName,
@@ -420,15 +396,40 @@ export function Viewer({
       setAppRunningState("empty");
     }
 
+    // A restarted engine has none of the old Python state, so the app has to be
+    // started again. If it was still starting, that's presumably where it got
+    // stuck, so it's left for the user to run again.
+    const removeOnRestart = pyodideproxy.onRestart(async () => {
+      const appCode = runningAppCodeRef.current;
+      runningAppCodeRef.current = null;
+      if (appCode !== null) await runApp(appCode);
+    });
+
     setViewerMethods({
       ready: true,
       runApp,
       stopApp,
+      interruptApp,
     });
+
+    return removeOnRestart;
   }, [proxyHandle.shinyReady]);
 
   const engineFailed = engineStatus.stage === "failed";
 
+  // Stops the Python code that the app is running, whether it's still starting
+  // or stuck in a long computation. webR apps can't be interrupted.
+  const interruptButton =
+    engineStatus.stage === "ready" && proxyHandle.engine === "pyodide" ? (
+      <button
+        className="interrupt-button"
+        title="Stop the Python code that the app is running"
+        onClick={() => interruptApp()}
+      >
+        Interrupt
+      </button>
+    ) : null;
+
   return (
     <div className="shinylive-viewer">
       <iframe ref={viewerFrameRef} className="app-frame" />
@@ -441,7 +442,10 @@ export function Viewer({
       ) : appRunningState === "loading" ? (
         <div className="loading-wrapper">
           <LoadingStatus engine={engine} />
+          {interruptButton}
         </div>
+      ) : appRunningState === "running" ? (
+        interruptButton
       ) : null}
     </div>
   );
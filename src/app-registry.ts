@@ -0,0 +1,148 @@
+// Registers the apps on this page with the service worker.
+//
+// The service worker proxies requests for /app_<id>/ paths to the engine that
+// runs the app. For that, it needs a port to the engine, and it has to be told
+// again whenever it restarts, since service workers can shut down at any time
+// and lose their state. Rather than a channel and a restart listener for every
+// app, there's one channel per engine, whose messages carry the app name, and
+// one listener that re-registers all of the apps in a single message.
+
+import type { PyodideProxy } from "./pyodide-proxy";
+import type { SchedulerStats } from "./request-scheduler";
+import type { Har, TrafficRecorderCommand } from "./traffic-recorder";
+import { makeRandomKey } from "./utils";
+import type { WebRProxy } from "./webr-proxy";
+
+type Engine = PyodideProxy | WebRProxy;
+
+type EngineEntry = {
+  // Identifies the engine's channel to the service worker, which sees the
+  // channels from every page it controls.
+  id: string;
+  appNames: Set<string>;
+};
+
+const engines = new Map<Engine, EngineEntry>();
+let restartListenerAdded = false;
+
+export function registerApp(engine: Engine, appName: string): void {
+  if (!navigator.serviceWorker.controller) {
+    throw new Error("ServiceWorker controller was not found!");
+  }
+
+  const entry = engines.get(engine);
+  if (entry) {
+    entry.appNames.add(appName);
+    navigator.serviceWorker.controller.postMessage({
+      type: "registerApps",
+      engineId: entry.id,
+      appNames: [appName],
+    });
+  } else {
+    const newEntry = { id: makeRandomKey(20), appNames: new Set([appName]) };
+    engines.set(engine, newEntry);
+    connectEngine(engine, newEntry);
+
+    // A restarted Python engine is a new worker, which doesn't have the port
+    // that was handed to the old one.
+    if ("onRestart" in engine) {
+      engine.onRestart(() => connectEngine(engine, newEntry));
+    }
+  }
+
+  if (!restartListenerAdded) {
+    navigator.serviceWorker.addEventListener("message", (event) => {
+      if (event.data.type === "serviceworkerStart") {
+        for (const [engine, entry] of engines) {
+          connectEngine(engine, entry);
+        }
+      }
+    });
+    restartListenerAdded = true;
+  }
+}
+
+// The service worker's request queues for this page's engines (see
+// request-scheduler.ts), by engine ID.
+export function requestQueueStats(): Promise<Record<string, SchedulerStats>> {
+  return askServiceWorker(
+    {
+      type: "getRequestStats",
+      engineIds: Array.from(engines.values(), (entry) => entry.id),
+    },
+    {},
+  );
+}
+
+// Control the service worker's recorder of app traffic (see
+// traffic-recorder.ts). The reply says whether it's recording, and for
+// "export", has the recording as HAR.
+export function trafficRecorder(
+  command: TrafficRecorderCommand,
+): Promise<{ recording: boolean; har?: Har }> {
+  return askServiceWorker(
+    { type: "trafficRecorder", command },
+    { recording: false },
+  );
+}
+
+// Send a message to the service worker, and wait for its reply on a port that
+// goes with it. If there's no service worker, resolve with `fallback`.
+function askServiceWorker<T>(
+  msg: Record<string, unknown>,
+  fallback: T,
+): Promise<T> {
+  const controller = navigator.serviceWorker.controller;
+  if (!controller) return Promise.resolve(fallback);
+
+  const channel = new MessageChannel();
+  const reply = new Promise<T>((resolve) => {
+    channel.port1.onmessage = (event) => {
+      channel.port1.close();
+      resolve(event.data);
+    };
+  });
+  controller.postMessage(msg, [channel.port2]);
+  return reply;
+}
+
+// Give the service worker a new channel to the engine, and register all of the
+// engine's apps on it.
+function connectEngine(engine: Engine, entry: EngineEntry): void {
+  if (!navigator.serviceWorker.controller) {
+    throw new Error("ServiceWorker controller was not found!");
+  }
+
+  const channel = new MessageChannel();
+
+  if ("serveApps" in engine) {
+    // The service worker talks to the engine directly.
+    engine.serveApps(channel.port1);
+  } else {
+    channel.port1.addEventListener("message", (event) => {
+      const msg = event.data;
+      if (msg.type === "makeRequest") {
+        // eslint-disable-next-line @typescript-eslint/no-floating-promises
+        engine.makeRequest(msg.scope, msg.appName, event.ports[0]);
+      } else if (msg.type === "openChannel") {
+        // Hand it to the same listener as a websocket that's opened from the
+        // app's page through this window.
+        window.postMessage(
+          { type: "openChannel", path: msg.path, appName: msg.appName },
+          "*",
+          [event.ports[0]],
+        );
+      }
+    });
+    channel.port1.start();
+  }
+
+  navigator.serviceWorker.controller.postMessage(
+    {
+      type: "registerApps",
+      engineId: entry.id,
+      appNames: Array.from(entry.appNames),
+    },
+    [channel.port2],
+  );
+}
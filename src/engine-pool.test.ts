@@ -0,0 +1,110 @@
+import type { EngineRequest } from "./engine-pool";
+import { EnginePool, poolSizeFromMetaTag } from "./engine-pool";
+
+describe("EnginePool", () => {
+  // Engines are just numbers here, in the order they were created.
+  function makePool(maxSize: number) {
+    const pool = new EnginePool<number>(maxSize);
+    let created = 0;
+    const acquire = (request?: EngineRequest) =>
+      pool.acquire(() => created++, request);
+    return { pool, acquire };
+  }
+
+  test("a pool of one shares a single engine", () => {
+    const { pool, acquire } = makePool(1);
+    expect([acquire(), acquire(), acquire()]).toEqual([0, 0, 0]);
+    expect(pool.size).toBe(1);
+  });
+
+  test("creates engines until full, then assigns round-robin", () => {
+    const { pool, acquire } = makePool(3);
+    expect([acquire(), acquire(), acquire(), acquire(), acquire()]).toEqual([
+      0, 1, 2, 0, 1,
+    ]);
+    expect(pool.size).toBe(3);
+  });
+
+  test("assigns by weight once the pool is full", () => {
+    const { acquire } = makePool(2);
+    expect(acquire({ weight: 3 })).toBe(0);
+    expect(acquire()).toBe(1);
+    // Engine 1 has a load of 1, and engine 0 a load of 3.
+    expect(acquire()).toBe(1);
+    expect(acquire()).toBe(1);
+    expect(acquire()).toBe(0);
+  });
+
+  test("blocks that ask to share get the same engine", () => {
+    const { pool, acquire } = makePool(4);
+    expect(acquire({ shared: true })).toBe(0);
+    expect(acquire()).toBe(1);
+    expect(acquire({ shared: true })).toBe(0);
+    expect(acquire({ shared: true })).toBe(0);
+    expect(pool.size).toBe(2);
+  });
+
+  test("an owner that asks again keeps its engine, counted once", () => {
+    const { acquire } = makePool(2);
+    expect(acquire({ owner: "a" })).toBe(0);
+    expect(acquire({ owner: "a" })).toBe(0);
+    expect(acquire({ owner: "b" })).toBe(1);
+    expect(acquire({ owner: "b" })).toBe(1);
+    // Both engines have a load of 1.
+    expect(acquire()).toBe(0);
+  });
+
+  test("released engines take new blocks first", () => {
+    const { pool, acquire } = makePool(2);
+    expect([
+      acquire({ owner: "a" }),
+      acquire({ owner: "b" }),
+      acquire({ owner: "c" }),
+    ]).toEqual([0, 1, 0]);
+    pool.release("a");
+    pool.release("c");
+    pool.release("c");
+    // Engine 0 has a load of 0, and engine 1 a load of 1.
+    expect(acquire()).toBe(0);
+    expect(acquire()).toBe(0);
+    expect(acquire()).toBe(1);
+  });
+
+  test("a released owner gets the same engine back", () => {
+    const { pool, acquire } = makePool(2);
+    expect(acquire({ owner: "a", weight: 2 })).toBe(0);
+    expect(acquire({ owner: "b" })).toBe(1);
+    pool.release("a");
+    expect(acquire({ owner: "a", weight: 2 })).toBe(0);
+    // Engine 0 has its load of 2 again.
+    expect(acquire()).toBe(1);
+  });
+
+  test("invalid sizes mean a single engine", () => {
+    expect(new EnginePool(0).maxSize).toBe(1);
+    expect(new EnginePool(NaN).maxSize).toBe(1);
+    expect(new EnginePool(2.7).maxSize).toBe(2);
+  });
+});
+
+describe("poolSizeFromMetaTag()", () => {
+  afterEach(() => {
+    document.head.innerHTML = "";
+  });
+
+  test("defaults to 1 without a tag", () => {
+    expect(poolSizeFromMetaTag("shinylive:pyodide_pool_size")).toBe(1);
+  });
+
+  test("reads the tag's content", () => {
+    document.head.innerHTML =
+      '<meta name="shinylive:pyodide_pool_size" content="4" />';
+    expect(poolSizeFromMetaTag("shinylive:pyodide_pool_size")).toBe(4);
+  });
+
+  test("ignores content that isn't a number", () => {
+    document.head.innerHTML =
+      '<meta name="shinylive:pyodide_pool_size" content="many" />';
+    expect(poolSizeFromMetaTag("shinylive:pyodide_pool_size")).toBe(1);
+  });
+});
@@ -0,0 +1,94 @@
+// Assigns the Shinylive blocks on a page to a bounded set of engines.
+//
+// Each engine is a separate Pyodide worker, with its own interpreter and event
+// loop, so a heavy app only slows down the apps on the same engine. Engines are
+// created on demand until the pool is full; after that, each block goes to the
+// engine with the least total weight, which for equal weights is round-robin.
+// Blocks that ask to share all go to the same engine.
+
+export type EngineRequest = {
+  // How heavy the block is, relative to a typical block's weight of 1.
+  weight?: number;
+  // Run on the same engine as the other blocks that ask to share.
+  shared?: boolean;
+  // Identifies the block. Asking again with the same owner returns the same
+  // engine, and doesn't add to its load again, so acquire() can be called on
+  // every render.
+  owner?: string;
+};
+
+type Slot<T> = { engine: T; load: number };
+type Holder<T> = { slot: Slot<T>; weight: number; held: boolean };
+
+export class EnginePool<T> {
+  readonly maxSize: number;
+  private slots: Slot<T>[] = [];
+  private sharedSlot: Slot<T> | undefined;
+  private holders = new Map<string, Holder<T>>();
+
+  constructor(maxSize: number) {
+    this.maxSize = Number.isFinite(maxSize)
+      ? Math.max(1, Math.floor(maxSize))
+      : 1;
+  }
+
+  // Return an engine for a block, calling `create()` if a new one is needed.
+  acquire(
+    create: () => T,
+    { weight = 1, shared = false, owner }: EngineRequest = {},
+  ): T {
+    const holder = owner === undefined ? undefined : this.holders.get(owner);
+    if (holder) {
+      if (!holder.held) {
+        holder.slot.load += holder.weight;
+        holder.held = true;
+      }
+      return holder.slot.engine;
+    }
+
+    let slot: Slot<T>;
+    if (shared && this.sharedSlot) {
+      slot = this.sharedSlot;
+    } else if (this.slots.length < this.maxSize) {
+      slot = { engine: create(), load: 0 };
+      this.slots.push(slot);
+    } else {
+      slot = this.slots.reduce((a, b) => (b.load < a.load ? b : a));
+    }
+
+    if (shared && !this.sharedSlot) {
+      this.sharedSlot = slot;
+    }
+    slot.load += weight;
+    if (owner !== undefined) {
+      this.holders.set(owner, { slot, weight, held: true });
+    }
+    return slot.engine;
+  }
+
+  // Give back the engine that `owner` acquired, when its block goes away. The
+  // engine itself keeps running, for the blocks assigned to it later. If the
+  // block comes back, as React's StrictMode does with effects, it acquires the
+  // same engine again.
+  release(owner: string): void {
+    const holder = this.holders.get(owner);
+    if (holder?.held) {
+      holder.slot.load = Math.max(0, holder.slot.load - holder.weight);
+      holder.held = false;
+    }
+  }
+
+  get size(): number {
+    return this.slots.length;
+  }
+}
+
+// Read the pool size from a <meta name="..."> tag on the page, like:
+//   <meta name="shinylive:pyodide_pool_size" content="4" />
+// Without one, there is a single engine, shared by every block.
+export function poolSizeFromMetaTag(name: string): number {
+  const tag = document.querySelector<HTMLMetaElement>(`meta[name="${name}"]`);
+  if (tag === null) return 1;
+  const size = parseInt(tag.content, 10);
+  return Number.isNaN(size) ? 1 : size;
+}
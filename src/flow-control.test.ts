@@ -0,0 +1,37 @@
+import { CreditWindow } from "./flow-control";
+
+describe("CreditWindow", () => {
+  test("lets the first `size` messages through straight away", async () => {
+    const credits = new CreditWindow(2);
+    const acquired: number[] = [];
+    for (let i = 0; i < 3; i++) {
+      // eslint-disable-next-line @typescript-eslint/no-floating-promises
+      credits.acquire().then(() => acquired.push(i));
+    }
+    await Promise.resolve();
+    expect(acquired).toEqual([0, 1]);
+
+    credits.release();
+    await Promise.resolve();
+    expect(acquired).toEqual([0, 1, 2]);
+  });
+
+  test("banks acknowledgements that arrive with nothing waiting", async () => {
+    const credits = new CreditWindow(1);
+    await credits.acquire();
+    credits.release();
+    await expect(credits.acquire()).resolves.toBeUndefined();
+  });
+
+  test("lets waiting senders go when it's closed", async () => {
+    const credits = new CreditWindow(1);
+    await credits.acquire();
+    const waiting = credits.acquire();
+    expect(credits.closed).toBe(false);
+
+    credits.close();
+    await waiting;
+    await credits.acquire();
+    expect(credits.closed).toBe(true);
+  });
+});
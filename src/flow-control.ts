@@ -0,0 +1,51 @@
+// Backpressure for streams of messages over a MessagePort.
+//
+// postMessage() never blocks, so a sender that reads from a fast source (like
+// a request body in the service worker) can queue up any amount of data in
+// front of a slow receiver. With a CreditWindow, the sender can only have a
+// fixed number of messages outstanding: it takes a credit before each message,
+// and gets one back each time the receiver acknowledges one.
+
+export class CreditWindow {
+  private credits: number;
+  private waiting: Array<() => void> = [];
+  private isClosed = false;
+
+  constructor(size: number) {
+    this.credits = Math.max(1, size);
+  }
+
+  // Resolves when a message can be sent, or when the window is closed; check
+  // `closed` afterwards to tell which.
+  acquire(): Promise<void> {
+    if (this.isClosed) return Promise.resolve();
+    if (this.credits > 0) {
+      this.credits--;
+      return Promise.resolve();
+    }
+    return new Promise((resolve) => this.waiting.push(resolve));
+  }
+
+  // Call when the receiver acknowledges a message.
+  release(): void {
+    const next = this.waiting.shift();
+    if (next) {
+      next();
+    } else {
+      this.credits++;
+    }
+  }
+
+  // Call when no more messages are to be sent, for example because the
+  // receiver has gone away. Anything waiting in acquire() is let go.
+  close(): void {
+    this.isClosed = true;
+    for (const next of this.waiting.splice(0)) {
+      next();
+    }
+  }
+
+  get closed(): boolean {
+    return this.isClosed;
+  }
+}
@@ -1,8 +1,13 @@
 import React, { useEffect } from "react";
+import { requestQueueStats, trafficRecorder } from "../app-registry";
 import { checkEngineAssetReachable } from "../engine-load-guard";
+import { downloadFile } from "../fileio";
 import { loadStatusStore } from "../load-status";
 import type { ProxyType, PyodideProxy } from "../pyodide-proxy";
 import { loadPyodideProxy } from "../pyodide-proxy";
+import { formatStats } from "../rpc-metrics";
+import type { TrafficRecorderCommand } from "../traffic-recorder";
+import { mergeHarEntries } from "../traffic-recorder";
 import * as utils from "../utils";
 
 export type PyodideProxyHandle =
@@ -20,6 +25,10 @@ export type PyodideProxyHandle =
       // Run code directly with Pyodide. (Output will print in the terminal.)
       runCode: (command: string) => Promise<void>;
       tabComplete: (command: string) => Promise<string[]>;
+      // Stop the Python code that's running, with a KeyboardInterrupt. If that
+      // isn't possible on this page and `restart` is true, restart the engine
+      // instead, which loses all Python state.
+      interrupt: (options?: { restart?: boolean }) => Promise<void>;
     };
 
 // =============================================================================
@@ -29,10 +38,26 @@ export async function initPyodide({
   proxyType = "webworker",
   stdout,
   stderr,
+  outputRateLimit,
+  metrics = false,
+  persistBytecode = true,
+  engineIndex = 0,
 }: {
   proxyType?: ProxyType;
   stdout?: (msg: string) => Promise<void>;
   stderr?: (msg: string) => void;
+  // Lines of output per second, past which output is dropped. 0 means no
+  // limit. See output-buffer.ts for the default.
+  outputRateLimit?: number;
+  // Record timings for the messages to and from the engine. They can be seen
+  // with window.shinylive.metrics(), or by typing %metrics in the terminal.
+  metrics?: boolean;
+  // Save compiled bytecode to the cache that's shared with the page's other
+  // engines. Only one engine on a page should; the others read it.
+  persistBytecode?: boolean;
+  // The engine's position in the page's pool. SharedWorker engines are shared
+  // with other tabs by position; see loadPyodideProxy().
+  engineIndex?: number;
 }): Promise<PyodideProxyHandle> {
   // Defaults for stdout and stderr if not provided: log to console
   if (!stdout) stdout = async (x: string) => console.log("pyodide echo:" + x);
@@ -50,10 +75,19 @@ export async function initPyodide({
   if (unreachable) throw new Error(unreachable);
 
   const pyodideProxy = await loadPyodideProxy(
-    { type: proxyType, indexURL: baseUrl },
+    {
+      type: proxyType,
+      indexURL: baseUrl,
+      output: { maxLinesPerSecond: outputRateLimit },
+      metrics,
+      engineIndex,
+    },
     stdout,
     stderr,
   );
+  if (metrics) {
+    exposeMetrics(pyodideProxy);
+  }
 
   let initError = false;
   try {
@@ -61,7 +95,10 @@ export async function initPyodide({
     // packages, since the worker calls loadPackagesFromImports before running
     // the code, so boot and package loading are reported as a single stage.
     status.set("engine-start");
-    await pyodideProxy.runPyAsync(load_python_pre);
+    await pyodideProxy.runPyAsync(load_python_pre, { once: true });
+    if (!persistBytecode) {
+      await pyodideProxy.runPyAsync("_pycache_writer = False");
+    }
     status.set("ready");
   } catch (e) {
     initError = true;
@@ -69,8 +106,30 @@ export async function initPyodide({
     console.error(e);
   }
 
+  // After a restart (see interrupt() below), the new engine needs the same
+  // setup as this one.
+  pyodideProxy.onRestart(async () => {
+    await pyodideProxy.runPyAsync(load_python_pre);
+    if (!persistBytecode) {
+      await pyodideProxy.runPyAsync("_pycache_writer = False");
+    }
+  });
+
+  const printOutput = stdout;
+  const printError = stderr;
+
   // Public functions
   async function runCode(command: string) {
+    if (command.trim() === "%metrics") {
+      const report = await pyodideProxy.metrics();
+      await printOutput(
+        report
+          ? formatStats(report.stats)
+          : "Metrics are off. Load the page with ?metrics=1 to record them.",
+      );
+      return;
+    }
+
     try {
       await pyodideProxy.runPyAsync(command, { printResult: true });
     } catch (e) {
@@ -87,6 +146,26 @@ export async function initPyodide({
     return await pyodideProxy.tabComplete(code);
   }
 
+  async function interrupt({ restart = false }: { restart?: boolean } = {}) {
+    if (pyodideProxy.interrupt() || !restart) return;
+
+    if (pyodideProxy.proxyType() === "sharedworker") {
+      printError(
+        "Python is shared with other pages, so it can't be interrupted or restarted from here.",
+      );
+      return;
+    }
+
+    printError(
+      "Python can't be interrupted on this page, so it is being restarted.",
+    );
+    try {
+      await pyodideProxy.restart();
+    } catch (e) {
+      console.error(e);
+    }
+  }
+
   return {
     ready: true,
     engine: "pyodide",
@@ -95,6 +174,72 @@ export async function initPyodide({
     initError: initError,
     runCode,
     tabComplete,
+    interrupt,
+  };
+}
+
+// Make window.shinylive.metrics() return the timings from every engine on the
+// page that records them, and window.shinylive.requestQueues() the state of
+// the service worker's queues of app requests for them. Also add
+// window.shinylive.traffic, which records the apps' traffic: start(), stop()
+// and clear() the service worker's recording of HTTP requests along with these
+// engines' recordings of websocket frames, and export() or download() them
+// together as HAR.
+const metricsEngines: PyodideProxy[] = [];
+// Whether window.shinylive.traffic was last started or stopped. An engine that
+// starts up while it's recording records too.
+let trafficRecording = false;
+
+function exposeMetrics(pyodideProxy: PyodideProxy): void {
+  metricsEngines.push(pyodideProxy);
+  const shinylive = ((window as any).shinylive ??= {});
+  shinylive.metrics = () =>
+    Promise.all(metricsEngines.map((engine) => engine.metrics()));
+  shinylive.requestQueues = requestQueueStats;
+
+  if (shinylive.traffic) {
+    // eslint-disable-next-line @typescript-eslint/no-floating-promises
+    if (trafficRecording) pyodideProxy.trafficRecorder("start");
+    return;
+  }
+  // Send a command to the service worker's recorder and every engine's.
+  const sendCommand = async (command: TrafficRecorderCommand) => {
+    if (command === "start") trafficRecording = true;
+    if (command === "stop") trafficRecording = false;
+    const [reply, webSockets] = await Promise.all([
+      trafficRecorder(command),
+      Promise.all(
+        metricsEngines.map((engine) => engine.trafficRecorder(command)),
+      ),
+    ]);
+    return { ...reply, webSockets: webSockets.flat() };
+  };
+  const exportHar = async () => {
+    const { har, webSockets } = await sendCommand("export");
+    if (!har) return undefined;
+    return mergeHarEntries(har, webSockets);
+  };
+  shinylive.traffic = {
+    start: async () => {
+      const { recording } = await sendCommand("start");
+      console.info(
+        "Recording app traffic. The recording is lost if the browser stops " +
+          "the service worker while it's idle.",
+      );
+      return { recording };
+    },
+    stop: async () => ({ recording: (await sendCommand("stop")).recording }),
+    clear: async () => ({ recording: (await sendCommand("clear")).recording }),
+    export: exportHar,
+    download: async () => {
+      const har = await exportHar();
+      if (!har) return;
+      await downloadFile(
+        "shinylive-traffic.har",
+        JSON.stringify(har, null, 2),
+        "application/json",
+      );
+    },
   };
 }
 
@@ -104,17 +249,36 @@ export async function initPyodide({
 // This is to be called after initPyodide(), as in:
 //   pyodideProxyHandle = await initPyodide({ ... })
 //   pyodideProxyHandle = await initShiny({ pyodideProxyHandle })
+// The modules that initShiny() imports in the background by default.
+export const defaultWarmUpModules = ["shiny", "shiny.express"];
+
 export async function initShiny({
   pyodideProxyHandle,
+  warmUpModules = defaultWarmUpModules,
 }: {
   pyodideProxyHandle: PyodideProxyHandle;
+  warmUpModules?: string[];
 }): Promise<PyodideProxyHandle> {
   if (!pyodideProxyHandle.ready) {
     throw new Error("pyodideProxyHandle is not ready");
   }
 
   const pyodideProxy = pyodideProxyHandle.pyodide;
-  ensureOpenChannelListener(pyodideProxy);
+  ensureOpenChannelListener();
+
+  // Import the modules that apps will need while the engine is otherwise idle
+  // (in the editor modes, the user is usually still reading). This returns as
+  // soon as the imports are scheduled; _start_app() waits for them to finish.
+  if (!pyodideProxyHandle.initError && warmUpModules.length > 0) {
+    try {
+      await pyodideProxy.callPyAsync({
+        fnName: ["_warm_up_imports"],
+        args: [warmUpModules],
+      });
+    } catch (e) {
+      console.error(e);
+    }
+  }
 
   return {
     ...pyodideProxyHandle,
@@ -212,14 +376,188 @@ def _pyodide_env_init():
 
 _pyodide_env_init()
 
+# CPython compiles every pure-Python module from source on each boot, because
+# the virtual filesystem starts out empty. To avoid that, bytecode is written
+# under sys.pycache_prefix, on an IndexedDB-backed mount that persists between
+# page loads.
+#
+# Every engine on a page, and in other tabs, mounts the same IndexedDB database,
+# and saving it replaces what's stored with this engine's copy. So only one
+# engine per page saves it (initPyodide() sets this to False in the others),
+# and it loads the stored copy again just before, to keep what other tabs saved.
+_PYCACHE_DIR = "/shinylive-pycache"
+_pycache_persisting = False
+_pycache_writer = True
+
+async def _pycache_sync(populate: bool) -> None:
+    import asyncio
+    from pyodide.ffi import create_once_callable
+
+    future = asyncio.get_event_loop().create_future()
+
+    def done(err=None):
+        if err:
+            future.set_exception(OSError(f"Could not sync {_PYCACHE_DIR}: {err}"))
+        else:
+            future.set_result(None)
+
+    js_pyodide.FS.syncfs(populate, create_once_callable(done))
+    await future
+
+def _pycache_stamp() -> str:
+    import sys
+    import pyodide
+
+    # What the bytecode depends on that's known at boot.
+    return "|".join([pyodide.__version__, sys.implementation.cache_tag])
+
+def _pycache_packages_stamp() -> str:
+    import importlib.metadata
+
+    # Bytecode is validated against the source when it's loaded (see
+    # _pycache_persist()), so this is about not keeping files for versions
+    # which will never be loaded again. These packages are installed after
+    # boot, so this is checked when the cache is saved.
+    versions = []
+    for name in ("shiny", "htmltools", "starlette"):
+        try:
+            versions.append(f"{name}=={importlib.metadata.version(name)}")
+        except importlib.metadata.PackageNotFoundError:
+            pass
+    return "|".join(versions)
+
+def _pycache_check_stamp(file: str, stamp: str) -> bool:
+    """
+    If the stamp saved in \`file\` isn't \`stamp\`, empty the cache and save
+    \`stamp\` instead. Returns whether the cache was emptied.
+    """
+    import os
+    import shutil
+
+    stamp_file = os.path.join(_PYCACHE_DIR, file)
+    if os.path.exists(stamp_file) and open(stamp_file).read() == stamp:
+        return False
+    for entry in os.listdir(_PYCACHE_DIR):
+        path = os.path.join(_PYCACHE_DIR, entry)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif entry != "STAMP":
+            os.remove(path)
+    with open(stamp_file, "w") as f:
+        f.write(stamp)
+    return True
+
+def _pycache_remove_app_files() -> bool:
+    """
+    Remove the bytecode that the import system wrote for app files. Each app
+    run gets a new, random directory under /home/pyodide, so it would never be
+    used again. Returns whether there was any.
+    """
+    import os
+    import shutil
+
+    home = os.path.join(_PYCACHE_DIR, "home")
+    if not os.path.exists(home):
+        return False
+    shutil.rmtree(home)
+    return True
+
+async def _pycache_setup() -> None:
+    import os
+    import sys
+    from js import Object
+    from pyodide.ffi import to_js
+
+    try:
+        os.makedirs(_PYCACHE_DIR, exist_ok=True)
+        js_pyodide.FS.mount(
+            js_pyodide.FS.filesystems.IDBFS,
+            to_js({}, dict_converter=Object.fromEntries),
+            _PYCACHE_DIR,
+        )
+        await _pycache_sync(populate=True)
+    except Exception:
+        # IndexedDB can be unavailable, as in some private browsing modes.
+        # Then modules are compiled from source, as usual.
+        return
+
+    _pycache_check_stamp("STAMP", _pycache_stamp())
+    _pycache_remove_app_files()
+
+    sys.pycache_prefix = _PYCACHE_DIR
+
+def _is_hash_based_pyc(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            header = f.read(8)
+    except OSError:
+        return False
+    # The flags word follows the 4-byte magic number; bit 0 is set for
+    # hash-based .pyc files. (PEP 552)
+    return len(header) == 8 and bool(int.from_bytes(header[4:8], "little") & 1)
+
+async def _pycache_persist() -> None:
+    import asyncio
+    import importlib.util
+    import py_compile
+    import sys
+    global _pycache_persisting
+
+    if sys.pycache_prefix != _PYCACHE_DIR or _pycache_persisting:
+        return
+    if not _pycache_writer:
+        return
+    _pycache_persisting = True
+    try:
+        # Let the app serve its first page before doing this.
+        await asyncio.sleep(1)
+
+        await _pycache_sync(populate=True)
+
+        changed = _pycache_check_stamp("PACKAGES", _pycache_packages_stamp())
+        changed = _pycache_remove_app_files() or changed
+
+        # The import system only writes timestamp-based .pyc files, which are
+        # never valid on the next boot: wheels are unpacked again, with new
+        # mtimes. So loaded modules are recompiled as hash-based .pyc files,
+        # which are checked against the source's contents instead. App files
+        # are skipped, because each app gets a new, random directory.
+        compiled = 0
+        for module in list(sys.modules.values()):
+            source = getattr(module, "__file__", None)
+            if not isinstance(source, str) or not source.endswith(".py"):
+                continue
+            if source.startswith("/home/pyodide/"):
+                continue
+            cfile = importlib.util.cache_from_source(source)
+            if _is_hash_based_pyc(cfile):
+                continue
+            try:
+                py_compile.compile(
+                    source,
+                    cfile=cfile,
+                    doraise=True,
+                    invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH,
+                )
+            except Exception:
+                continue
+            compiled += 1
+            if compiled % 50 == 0:
+                await asyncio.sleep(0)
+
+        if compiled > 0 or changed:
+            await _pycache_sync(populate=False)
+    except Exception as e:
+        print(f"Could not save the bytecode cache: {e}", file=sys.stderr)
+    finally:
+        _pycache_persisting = False
+
+await _pycache_setup()
+
 # Function for saving a set of files so we can load them as a module.
 def _save_files(files: list[dict[str, str]], destdir: str, rm_destdir: bool = True) -> None:
     import shutil
     import pyodide
-    # If called from JS and passed an Object, we need to convert it to a
-    # dict.
-    if isinstance(files, pyodide.ffi.JsProxy):
-        files = files.to_py()
 
     import os
     if rm_destdir and os.path.exists(destdir):
@@ -227,23 +565,146 @@ def _save_files(files: list[dict[str, str]], destdir: str, rm_destdir: bool = Tr
     os.makedirs(destdir, exist_ok=True)
 
     for file in files:
-        subdir = os.path.dirname(file["name"])
+        # If called from JS, each file is a JsProxy of an Object. Its fields are
+        # read directly, rather than converting it with to_py(), so that binary
+        # content is written from the JS buffer to the file without first being
+        # copied into a Python object.
+        if isinstance(file, pyodide.ffi.JsProxy):
+            name = file.name
+            file_type = getattr(file, "type", "text")
+            content = file.content
+        else:
+            name = file["name"]
+            file_type = file.get("type", "text")
+            content = file["content"]
+
+        subdir = os.path.dirname(name)
         if subdir:
             os.makedirs(os.path.join(destdir, subdir), exist_ok=True)
 
-        if "type" in file and file["type"] == "binary":
-            with open(destdir + "/" + file["name"], "wb") as f:
-                f.write(file["content"])
+        if file_type == "binary":
+            with open(destdir + "/" + name, "wb") as f:
+                if isinstance(content, pyodide.ffi.JsBuffer):
+                    content.to_file(f)
+                else:
+                    f.write(content)
         else:
-            with open(destdir + "/" + file["name"], "w") as f:
-                f.write(file["content"])
+            with open(destdir + "/" + name, "w") as f:
+                f.write(content)
+
+# Resolving requirements.txt with micropip fetches package metadata from PyPI
+# on every app start, even when all of the wheels are already cached. So the
+# first time a given requirements.txt is resolved, we store the resulting
+# install plan (exact wheel URLs and versions) in Cache Storage, keyed by
+# a hash of the normalized file and the Pyodide version. Later starts install
+# the pinned set directly and skip resolution.
+_REQUIREMENTS_PLAN_CACHE = "shinylive-requirements-plans"
+
+def _requirements_plan_url(reqs: list[str]) -> str:
+    import hashlib
+    import pyodide
 
-async def _install_requirements_from_dir(dir: str) -> None:
-    import os
-    import re
+    # Comments, blank lines, whitespace, and ordering don't change what gets
+    # installed, so they shouldn't change the key either.
+    normalized = sorted(
+        {"".join(req.split("#", 1)[0].split()) for req in reqs} - {""}
+    )
+    key = hashlib.sha256(
+        "|".join([pyodide.__version__, *normalized]).encode("utf-8")
+    ).hexdigest()
+    return f"./__shinylive_requirements_plan__/{key}"
+
+async def _load_requirements_plan(url: str) -> list[dict[str, str]] | None:
+    import json
+    try:
+        from js import caches
+        cache = await caches.open(_REQUIREMENTS_PLAN_CACHE)
+        resp = await cache.match(url)
+        if resp is None:
+            return None
+        return json.loads(await resp.text())["packages"]
+    except Exception:
+        # Cache Storage can be unavailable (e.g., in some private browsing
+        # modes); in that case we just resolve every time.
+        return None
+
+async def _save_requirements_plan(url: str, packages: list[dict[str, str]]) -> None:
+    import json
+    try:
+        from js import caches, Response
+        cache = await caches.open(_REQUIREMENTS_PLAN_CACHE)
+        await cache.put(url, Response.new(json.dumps({"packages": packages})))
+    except Exception:
+        pass
+
+async def _delete_requirements_plan(url: str) -> None:
+    try:
+        from js import caches
+        cache = await caches.open(_REQUIREMENTS_PLAN_CACHE)
+        await cache.delete(url)
+    except Exception:
+        pass
+
+def _installed_packages_snapshot() -> dict[str, str]:
     import micropip
-    import sys
+    return {name: pkg.version for name, pkg in micropip.list().items()}
+
+def _requirements_plan_entries(requested: dict[str, set[str]]) -> list[dict[str, str]]:
     import importlib.metadata
+    import json
+    import micropip
+    from packaging.requirements import Requirement
+    from packaging.utils import canonicalize_name
+
+    # The plan is the installed closure of what requirements.txt asks for, so
+    # packages that something else installed meanwhile (like the background
+    # pre-imports) don't end up in it.
+    dists: dict[str, importlib.metadata.Distribution] = {}
+    pending = list(requested.items())
+    while pending:
+        name, extras = pending.pop()
+        try:
+            dist = importlib.metadata.distribution(name)
+        except importlib.metadata.PackageNotFoundError:
+            continue
+        dists[canonicalize_name(dist.metadata["Name"])] = dist
+        for req_str in dist.requires or []:
+            req = Requirement(req_str)
+            if req.marker is not None and not any(
+                req.marker.evaluate({"extra": extra}) for extra in extras | {""}
+            ):
+                continue
+            if canonicalize_name(req.name) not in dists:
+                pending.append((req.name, set(req.extras)))
+
+    # micropip.freeze() knows the wheel URL of everything micropip installed
+    # itself; packages that came from Pyodide's own lockfile have a relative
+    # file name there, and are installed again by name.
+    frozen = json.loads(micropip.freeze())["packages"]
+    entries: list[dict[str, str]] = []
+    for name, dist in dists.items():
+        entry = {"name": dist.metadata["Name"], "version": dist.version}
+        info = frozen.get(dist.metadata["Name"]) or frozen.get(name)
+        if info and info.get("file_name", "").startswith(("http://", "https://")):
+            entry["url"] = info["file_name"]
+        entries.append(entry)
+    return entries
+
+async def _install_requirements_plan(packages: list[dict[str, str]]) -> None:
+    import micropip
+    installed = _installed_packages_snapshot()
+    pending = [pkg for pkg in packages if pkg["name"] not in installed]
+    if len(pending) == 0:
+        return
+    print(f"\\nInstalling {len(pending)} packages from requirements.txt...", end=" ", flush=True)
+    await micropip.install(
+        [pkg.get("url") or f"{pkg['name']}=={pkg['version']}" for pkg in pending],
+        deps=False,
+    )
+    print("done.", flush=True)
+
+async def _install_requirements_from_dir(dir: str) -> None:
+    import os
 
     files = os.listdir(dir)
     if "requirements.txt" not in files:
@@ -251,6 +712,29 @@ async def _install_requirements_from_dir(dir: str) -> None:
     with open(os.path.join(dir, "requirements.txt"), "r") as f:
         reqs = f.readlines()
 
+    plan_url = _requirements_plan_url(reqs)
+    plan = await _load_requirements_plan(plan_url)
+    if plan is not None:
+        try:
+            await _install_requirements_plan(plan)
+            return
+        except Exception as e:
+            # The plan is stale (e.g., a wheel URL went away). Forget it, and
+            # fall through to a full resolution, which records a new one.
+            print(f"failed ({e}); resolving requirements again.", flush=True)
+            await _delete_requirements_plan(plan_url)
+
+    requested = await _resolve_requirements(reqs)
+    await _save_requirements_plan(plan_url, _requirements_plan_entries(requested))
+
+# Install what requirements.txt asks for that isn't installed yet. Returns the
+# distributions it names, with the extras asked for of each.
+async def _resolve_requirements(reqs: list[str]) -> dict[str, set[str]]:
+    import re
+    import micropip
+    import importlib.metadata
+
+    requested: dict[str, set[str]] = {}
     for req in reqs:
         req = req.strip()
         extras = set()
@@ -279,6 +763,7 @@ async def _install_requirements_from_dir(dir: str) -> None:
             await micropip.install(req)
             print("done.", flush=True)
 
+        requested.setdefault(pkg_name, set()).update(extras)
         if len(extras) == 0:
             continue
         else:
@@ -314,16 +799,44 @@ async def _install_requirements_from_dir(dir: str) -> None:
                         await micropip.install(extra_req_name)
                         print("done.", flush = True)
 
+    return requested
 
-async def _load_packages_from_dir(dir: str) -> None:
+
+# The imports found in app files, keyed by a hash of the file's contents. Each
+# run of an app is saved to a new app_<id> directory, so paths are no use as a
+# key; when an app is run again, only the files that changed are parsed again.
+_import_scan_cache: dict[str, list[str]] = {}
+
+def _find_imports_in_dir(dir: str) -> set[str]:
+    import hashlib
     import os
-    import pyodide
-    files = os.listdir(dir)
-    imports: list[str] = []
-    for file in files:
-        if file.endswith(".py"):
-            with open(os.path.join(dir, file)) as f:
-                await js_pyodide.loadPackagesFromImports(f.read())
+    from pyodide.code import find_imports
+
+    imports: set[str] = set()
+    for root, dirs, files in os.walk(dir):
+        for file in files:
+            if not file.endswith(".py"):
+                continue
+            path = os.path.join(root, file)
+            with open(path, "rb") as f:
+                source = f.read()
+            digest = hashlib.sha1(source).hexdigest()
+            file_imports = _import_scan_cache.get(digest)
+            if file_imports is None:
+                file_imports = find_imports(source.decode("utf-8", errors="replace"))
+                _import_scan_cache[digest] = file_imports
+            imports.update(file_imports)
+    return imports
+
+async def _load_packages_from_dir(dir: str) -> None:
+    imports = _find_imports_in_dir(dir)
+    if len(imports) == 0:
+        return
+    # A single call for the union of all the files' imports, so that Pyodide
+    # downloads the packages in parallel instead of one file at a time.
+    await js_pyodide.loadPackagesFromImports(
+        "\\n".join(f"import {name}" for name in sorted(imports))
+    )
 ` +
   // In the function below, the odd importlib step for matplotlib is to work
   // around Pyodide's automatic import detection via
@@ -354,6 +867,75 @@ def _to_html(x):
         return { "type": "html", "value": img_html }
 
     return { "type": "text", "value": repr(x) }
+` +
+  // Convert a value for returnResult: "columnar" (see ColumnarResult in
+  // pyodide-proxy.ts). The "data" entries support the buffer protocol, so that
+  // JS can copy them out of the wasm heap in one go. As in _to_html(), packages
+  // are only used if they've already been imported, so that this code doesn't
+  // cause any of them to be loaded.
+  `
+_COLUMNAR_DTYPES = {"b1", "i1", "u1", "i2", "u2", "i4", "u4", "i8", "u8", "f4", "f8"}
+
+def _to_columnar_array(x, np):
+    if x.dtype.str[1:] not in _COLUMNAR_DTYPES:
+        return { "type": "value", "value": x.tolist() }
+    # Typed arrays in JS are in the platform's byte order, which for wasm is
+    # little-endian.
+    if x.dtype.byteorder == ">":
+        x = x.astype(x.dtype.newbyteorder("<"))
+    return {
+        "type": "array",
+        "dtype": x.dtype.str,
+        "shape": list(x.shape),
+        "data": np.ascontiguousarray(x),
+    }
+
+def _to_columnar(x):
+    import sys
+    np = sys.modules.get("numpy")
+    pd = sys.modules.get("pandas")
+    pa = sys.modules.get("pyarrow")
+
+    if pa is not None:
+        if pd is not None and isinstance(x, pd.DataFrame):
+            x = pa.Table.from_pandas(x)
+        if isinstance(x, pa.RecordBatch):
+            x = pa.Table.from_batches([x])
+        if isinstance(x, pa.Table):
+            sink = pa.BufferOutputStream()
+            with pa.ipc.new_stream(sink, x.schema) as writer:
+                writer.write_table(x)
+            return { "type": "arrow", "data": memoryview(sink.getvalue()) }
+
+    if pd is not None:
+        if isinstance(x, pd.DataFrame):
+            return {
+                "type": "table",
+                "names": [str(name) for name in x.columns],
+                "columns": [
+                    _to_columnar_array(x.iloc[:, i].to_numpy(), np)
+                    for i in range(x.shape[1])
+                ],
+            }
+        if isinstance(x, pd.Series):
+            x = x.to_numpy()
+
+    if np is not None and isinstance(x, np.ndarray):
+        return _to_columnar_array(x, np)
+
+    # Lists of numbers that a float64 can hold exactly.
+    if isinstance(x, (list, tuple)) and all(
+        type(v) is float or (type(v) is int and abs(v) <= 2**53) for v in x
+    ):
+        import array
+        return {
+            "type": "array",
+            "dtype": "<f8",
+            "shape": [len(x)],
+            "data": array.array("d", x),
+        }
+
+    return { "type": "value", "value": x }
 ` +
   // Reformat Python code using black. The odd importlib stuff is so that we
   // only load black (and dependencies) when we actually need it. Otherwise
@@ -392,10 +974,44 @@ class ShinyExpressAppModule:
         import shiny.express
         self.app = shiny.express.wrap_express_app(app_path)
 
+# Modules that are imported in the background once the engine is ready, so
+# that starting the first app doesn't have to pay for them. See
+# _warm_up_imports().
+_warm_up_task = None
+
+def _warm_up_imports(modules: list[str]) -> None:
+    import asyncio
+    import pyodide
+    global _warm_up_task
+
+    if isinstance(modules, pyodide.ffi.JsProxy):
+        modules = modules.to_py()
+
+    async def warm_up():
+        import importlib
+        import sys
+        for module in modules:
+            try:
+                await js_pyodide.loadPackagesFromImports(f"import {module}")
+                importlib.import_module(module)
+            except Exception as e:
+                print(f"Could not import {module} in advance: {e}", file=sys.stderr)
+            # Let anything else that's waiting on the event loop run between
+            # imports.
+            await asyncio.sleep(0)
+
+    _warm_up_task = asyncio.ensure_future(warm_up())
+
 async def _start_app(app_name, scope = _shiny_app_registry, dev_mode = False):
     import os
     import sys
     import importlib
+
+    # If the warm-up is still importing shiny, wait for it rather than import
+    # it a second time.
+    if _warm_up_task is not None:
+        await _warm_up_task
+
     import shiny
     import shiny.express
     from pathlib import Path
@@ -443,6 +1059,9 @@ async def _start_app(app_name, scope = _shiny_app_registry, dev_mode = False):
 
     sys.path.remove(app_dir)
 
+    import asyncio
+    asyncio.ensure_future(_pycache_persist())
+
 
 async def _stop_app(app_name, scope = _shiny_app_registry):
     import sys
@@ -470,27 +1089,90 @@ async def _stop_app(app_name, scope = _shiny_app_registry):
                 # loaded with 'import foo', as opposed to 'from . import foo'.
                 sys.modules.pop(name)
     return _res
+
+# Runs a request or websocket for an app, for the service worker (see
+# messageporthttp.ts and messageportwebsocket-channel.ts). JS looks this
+# function up once, rather than looking up the app's callable for each
+# request. Each event that the app sends is passed to \`send\` as plain
+# arguments, with the headers and body already converted to JS, so that JS
+# doesn't have to convert a dict for every message:
+#   send("http.response.start", status, [[name, value], ...])
+#   send("http.response.body", body, more_body)
+#   send("websocket.accept")
+#   send("websocket.send", text, bytes)
+#   send("websocket.close", code, reason)
+async def _asgi_dispatch(app_name, scope, receive, send):
+    from pyodide.ffi import to_js
+
+    app = _shiny_app_registry[app_name].app
+
+    # ASGI wants some of these as bytes, which JS doesn't have.
+    scope = scope.to_py()
+    scope["headers"] = [
+        [item.encode("latin-1") for item in header] for header in scope["headers"]
+    ]
+    for key in ("query_string", "raw_path"):
+        if isinstance(scope.get(key), str):
+            scope[key] = scope[key].encode("latin-1")
+
+    async def asgi_receive():
+        event = (await receive()).to_py()
+        if isinstance(event.get("body"), memoryview):
+            event["body"] = event["body"].tobytes()
+        if isinstance(event.get("bytes"), memoryview):
+            event["bytes"] = event["bytes"].tobytes()
+        return event
+
+    async def asgi_send(message):
+        type = message["type"]
+        if type == "http.response.start":
+            headers = [
+                [name.decode("latin-1"), value.decode("latin-1")]
+                for name, value in message.get("headers", [])
+            ]
+            await send(type, message["status"], to_js(headers))
+        elif type == "http.response.body":
+            # to_js() copies the bytes out of the wasm heap, into a buffer
+            # that JS can hand on without copying again.
+            body = message.get("body", b"")
+            await send(type, to_js(body), message.get("more_body", False))
+        elif type == "websocket.send":
+            data = message.get("bytes")
+            await send(type, message.get("text"), None if data is None else to_js(data))
+        elif type == "websocket.close":
+            await send(type, message.get("code", 1000), message.get("reason", ""))
+        else:
+            await send(type)
+
+    await app(scope, asgi_receive, asgi_send)
   `;
 
 // =============================================================================
 // Misc stuff
 // =============================================================================
 
-// TODO: Generalize this so it's not always tied to a single pyodideproxy
+// The engine that runs each app, so that an app's websocket connection reaches
+// the right one when the page has more than one. Websockets only come this way
+// when the app's page isn't controlled by the service worker; otherwise they go
+// straight to the engine (see app-registry.ts).
+const appEngines = new Map<string, PyodideProxy>();
+
+export function registerAppEngine(
+  appName: string,
+  pyodideProxy: PyodideProxy,
+): void {
+  appEngines.set(appName, pyodideProxy);
+}
+
 let channelListenerRegistered = false;
-function ensureOpenChannelListener(pyodideProxy: PyodideProxy): void {
+function ensureOpenChannelListener(): void {
   if (channelListenerRegistered) return;
 
   window.addEventListener("message", async (event) => {
     const msg = event.data;
     if (msg.type === "openChannel") {
-      const appExists = await pyodideProxy.runPyAsync(
-        `
-        "${msg.appName}" in _shiny_app_registry
-      `,
-        { returnResult: "value" },
-      );
-      if (appExists) {
+      const pyodideProxy = appEngines.get(msg.appName);
+      if (pyodideProxy) {
         await pyodideProxy.openChannel(msg.path, msg.appName, event.ports[0]);
       }
     }
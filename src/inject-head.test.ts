@@ -0,0 +1,71 @@
+import { HeadInjector } from "./inject-head";
+
+const encoder = new TextEncoder();
+const decoder = new TextDecoder();
+
+// Run `chunks` through a HeadInjector and return the result as a string.
+function inject(chunks: string[], insert = "<script></script>"): string {
+  const injector = new HeadInjector(encoder.encode(insert));
+  const output: Uint8Array[] = [];
+  for (const chunk of chunks) {
+    output.push(...injector.push(encoder.encode(chunk)));
+  }
+  output.push(...injector.flush());
+  return decoder.decode(concatAll(output));
+}
+
+function concatAll(chunks: Uint8Array[]): Uint8Array {
+  const result = new Uint8Array(chunks.reduce((n, x) => n + x.length, 0));
+  let offset = 0;
+  for (const chunk of chunks) {
+    result.set(chunk, offset);
+    offset += chunk.length;
+  }
+  return result;
+}
+
+describe("HeadInjector", () => {
+  test("inserts before </head>", () => {
+    expect(inject(["<html><head><title>x</title></head><body></body>"])).toBe(
+      "<html><head><title>x</title><script></script></head><body></body>",
+    );
+  });
+
+  test("finds </head> when it's split across chunks", () => {
+    expect(inject(["<head>a</he", "ad>b"])).toBe(
+      "<head>a<script></script></head>b",
+    );
+    expect(inject(["<head>a<", "/", "h", "ead", ">b"])).toBe(
+      "<head>a<script></script></head>b",
+    );
+  });
+
+  test("ignores case, and only uses the first </head>", () => {
+    expect(inject(["</HEAD></head>"], "X")).toBe("X</HEAD></head>");
+  });
+
+  test("passes documents without </head> through unchanged", () => {
+    expect(inject(["<body>", "</hea", "d"])).toBe("<body></head");
+  });
+
+  test("keeps multi-byte characters intact", () => {
+    const html = encoder.encode("<head><title>日本語 — café</title></head>");
+    const injector = new HeadInjector(encoder.encode("S"));
+    const output = [
+      // Split in the middle of "本".
+      ...injector.push(html.subarray(0, 17)),
+      ...injector.push(html.subarray(17)),
+      ...injector.flush(),
+    ];
+    expect(decoder.decode(concatAll(output))).toBe(
+      "<head><title>日本語 — café</title>S</head>",
+    );
+  });
+
+  test("passes chunks after the insertion straight through", () => {
+    const injector = new HeadInjector(encoder.encode("S"));
+    injector.push(encoder.encode("</head>"));
+    const chunk = encoder.encode("rest");
+    expect(injector.push(chunk)).toEqual([chunk]);
+  });
+});
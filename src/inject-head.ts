@@ -0,0 +1,89 @@
+// Insert bytes just before the </head> tag of an HTML document, as it streams
+// by.
+//
+// The service worker uses this to add the <script> tag for
+// shinylive-inject-socket.js to each app's root page. The document is scanned
+// as bytes, so nothing is decoded or re-encoded (which used to mangle anything
+// outside of Latin-1), and the tag is found even when it's split across two
+// chunks. Only the first </head> is used.
+
+const marker = new TextEncoder().encode("</head>");
+
+export class HeadInjector {
+  private done = false;
+  // The end of the previous chunk, which may hold the start of the marker.
+  private carry = new Uint8Array(0);
+
+  constructor(private insert: Uint8Array) {}
+
+  // Returns the bytes that can be passed on after `chunk`.
+  push(chunk: Uint8Array): Uint8Array[] {
+    if (this.done) return [chunk];
+
+    const data = concat(this.carry, chunk);
+    const index = indexOfMarker(data);
+    if (index !== -1) {
+      this.done = true;
+      this.carry = new Uint8Array(0);
+      return [data.subarray(0, index), this.insert, data.subarray(index)];
+    }
+
+    const keep = Math.min(marker.length - 1, data.length);
+    this.carry = data.slice(data.length - keep);
+    return [data.subarray(0, data.length - keep)];
+  }
+
+  // Returns what's left at the end of the document. If there was no </head>,
+  // the document is passed on unchanged.
+  flush(): Uint8Array[] {
+    const rest = this.carry;
+    this.carry = new Uint8Array(0);
+    return [rest];
+  }
+}
+
+export function injectBeforeHeadEnd(
+  insert: Uint8Array,
+): TransformStream<Uint8Array, Uint8Array> {
+  const injector = new HeadInjector(insert);
+  const enqueueAll = (
+    controller: TransformStreamDefaultController<Uint8Array>,
+    chunks: Uint8Array[],
+  ) => {
+    for (const chunk of chunks) {
+      if (chunk.length > 0) controller.enqueue(chunk);
+    }
+  };
+
+  return new TransformStream({
+    transform(chunk, controller) {
+      enqueueAll(controller, injector.push(chunk));
+    },
+    flush(controller) {
+      enqueueAll(controller, injector.flush());
+    },
+  });
+}
+
+// Find "</head>" in `data`, ignoring case.
+function indexOfMarker(data: Uint8Array): number {
+  const last = data.length - marker.length;
+  outer: for (let i = 0; i <= last; i++) {
+    for (let j = 0; j < marker.length; j++) {
+      let byte = data[i + j];
+      // A-Z to a-z
+      if (byte >= 0x41 && byte <= 0x5a) byte |= 0x20;
+      if (byte !== marker[j]) continue outer;
+    }
+    return i;
+  }
+  return -1;
+}
+
+function concat(a: Uint8Array, b: Uint8Array): Uint8Array {
+  if (a.length === 0) return b;
+  const result = new Uint8Array(a.length + b.length);
+  result.set(a);
+  result.set(b, a.length);
+  return result;
+}
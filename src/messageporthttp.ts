@@ -1,120 +1,237 @@
 import { AwaitableQueue } from "./awaitable-queue";
-import type { PyCallable } from "./pyodide/ffi";
+import { CreditWindow } from "./flow-control";
+import type { PyCallable, PyProxyWithHas } from "./pyodide/ffi";
 import type { loadPyodide } from "./pyodide/pyodide";
-import { uint8ArrayToString } from "./utils";
+import { transferList } from "./utils";
 
 // =============================================================================
 // Pyodide
 // =============================================================================
 type Pyodide = Awaited<ReturnType<typeof loadPyodide>>;
 
+// Request body chunks that can be on their way to the app at once. More are
+// only read from the request as the app acknowledges these, so a large upload
+// doesn't have to fit in memory in the service worker.
+const requestBodyWindowSize = 4;
+
+// Likewise, response body chunks that can be on their way from the app, or
+// waiting in the service worker to be read, at once. The app's send() waits
+// until the service worker has handed earlier ones on, so a large download
+// that's generated faster than it's saved doesn't have to fit in memory.
+const responseBodyWindowSize = 4;
+
 export async function fetchASGI(
   client: MessagePort,
-  resource: RequestInfo,
-  init?: RequestInit,
-  filter: (bodyChunk: Uint8Array, response: Response) => Uint8Array = (
-    bodyChunk,
-  ) => bodyChunk,
+  appName: string,
+  request: Request,
+  {
+    url = new URL(request.url),
+    onFinished = () => {},
+  }: {
+    // The URL to give the app, if it's not the request's own.
+    url?: URL;
+    // Called when the app has sent the whole response, or the response was
+    // cancelled.
+    onFinished?: () => void;
+  } = {},
 ): Promise<Response> {
-  if (typeof resource === "string" || typeof init !== "undefined") {
-    resource = new Request(resource, init);
-  }
-
   const channel = new MessageChannel();
   const clientPort = channel.port1;
   client.postMessage(
     {
       type: "makeRequest",
-      scope: reqToASGI(resource),
+      appName,
+      scope: reqToASGI(request, url),
     },
     [channel.port2],
   );
 
-  const blob = await resource.blob();
-  if (!blob.size) {
-    clientPort.postMessage({
-      type: "http.request",
-      more_body: false,
-    });
-  } else {
-    const reader = blob.stream().getReader();
-    try {
-      // eslint-disable-next-line no-constant-condition
-      while (true) {
-        const { value: theChunk, done } = await reader.read();
-        clientPort.postMessage({
-          type: "http.request",
-          body: theChunk,
-          more_body: !done,
-        });
-        if (done) {
-          break;
-        }
-      }
-    } finally {
-      reader.releaseLock();
-    }
-  }
+  const credits = new CreditWindow(requestBodyWindowSize);
+  const reader = (await requestBodyStream(request))?.getReader();
 
   return new Promise((resolve) => {
-    let streamController: ReadableStreamDefaultController | undefined;
-    const readableStream = new ReadableStream({
-      start(controller) {
-        streamController = controller;
+    // Response body messages that have arrived, and haven't been read yet.
+    const bodyMessages = new AwaitableQueue<{
+      body?: Uint8Array;
+      more_body?: boolean;
+    }>();
+
+    let finished = false;
+    const finish = () => {
+      if (finished) return;
+      finished = true;
+      clientPort.close();
+      onFinished();
+      // If the app answered without reading the whole request body, the rest
+      // of it isn't needed, and no acknowledgement will come for what's been
+      // sent, so stop sending.
+      credits.close();
+      reader?.cancel().catch(() => {});
+    };
+
+    // The body is pulled: each time the response's reader wants a chunk, one
+    // is taken from the queue, and the app is told that it can send another.
+    // So the app can only get a few chunks ahead of whatever is reading the
+    // response (for a download, the browser saving it to disk).
+    const readableStream = new ReadableStream<Uint8Array>(
+      {
+        async pull(controller) {
+          // An empty chunk doesn't satisfy the read, so keep going until
+          // there's something to hand on.
+          for (;;) {
+            const msg = await bodyMessages.dequeue();
+            const hasBody = msg.body !== undefined && msg.body.length > 0;
+            if (hasBody) {
+              controller.enqueue(msg.body!);
+            }
+            if (!msg.more_body) {
+              controller.close();
+              return;
+            }
+            clientPort.postMessage({ type: "http.response.ack" });
+            if (hasBody) {
+              return;
+            }
+          }
+        },
+        cancel(reason) {
+          if (!finished) {
+            // Stop the app, rather than leave it waiting to send more.
+            clientPort.postMessage({ type: "http.response.cancel" });
+          }
+          finish();
+        },
       },
-      cancel(reason) {},
-    });
-
-    let response: Response | undefined;
+      { highWaterMark: 0 },
+    );
 
     clientPort.addEventListener("message", (event) => {
       const msg = event.data;
 
-      if (msg.type === "http.response.start") {
+      if (msg.type === "http.request.ack") {
+        credits.release();
+      } else if (msg.type === "http.response.start") {
         // The response started; resolve the fetchASGI() call with a Response.
         // Next, we may or may not be receiving response body chunk(s).
-        response = asgiToRes(msg, readableStream);
-        resolve(response);
+        resolve(asgiToRes(msg, readableStream));
       } else if (msg.type === "http.response.body") {
-        // response-body message received; report it to the ReadableStream via
-        // its controller.
-        if (msg.body) {
-          streamController!.enqueue(filter(msg.body, response!));
-        }
+        bodyMessages.enqueue(msg);
         if (!msg.more_body) {
-          // All done
-          streamController!.close();
-          clientPort.close();
+          // All done, as far as the app is concerned. What's left of the body
+          // is still read from the queue.
+          finish();
         }
       } else {
         throw new Error("Unexpected event type from clientPort: " + msg.type);
       }
     });
     clientPort.start();
+
+    // eslint-disable-next-line @typescript-eslint/no-floating-promises
+    sendRequestBody(clientPort, reader, credits);
   });
 }
 
+// The request's body as a stream. Firefox doesn't implement Request.body, so
+// there the body is read with blob() instead. A Blob is held by the browser
+// rather than in JS, and is still sent to the app a chunk at a time.
+async function requestBodyStream(
+  request: Request,
+): Promise<ReadableStream<Uint8Array> | undefined> {
+  if (request.body) return request.body;
+  if (request.method === "GET" || request.method === "HEAD") return undefined;
+  if (request.bodyUsed) return undefined;
+  return (await request.blob()).stream();
+}
+
+// Stream the request body to the app as http.request messages.
+async function sendRequestBody(
+  clientPort: MessagePort,
+  reader: ReadableStreamDefaultReader<Uint8Array> | undefined,
+  credits: CreditWindow,
+): Promise<void> {
+  if (!reader) {
+    clientPort.postMessage({
+      type: "http.request",
+      more_body: false,
+    });
+    return;
+  }
+
+  try {
+    for (;;) {
+      await credits.acquire();
+      // The response has finished, so the app won't read any more.
+      if (credits.closed) break;
+      const { value: theChunk, done } = await reader.read();
+      // The chunks are ours alone, so they can be moved rather than copied.
+      clientPort.postMessage(
+        {
+          type: "http.request",
+          body: theChunk,
+          more_body: !done,
+        },
+        transferList(theChunk),
+      );
+      if (done) {
+        break;
+      }
+    }
+  } catch (e) {
+    console.error("Could not read the request body:", e);
+  } finally {
+    reader.releaseLock();
+  }
+}
+
+// _asgi_dispatch() from the Python bootstrap (see usePyodide.tsx), which runs
+// requests and websockets for apps. It's looked up once for each engine.
+const asgiDispatchFuncs = new WeakMap<Pyodide, PyCallable>();
+
+export function asgiDispatch(pyodide: Pyodide): PyCallable {
+  let func = asgiDispatchFuncs.get(pyodide);
+  if (!func) {
+    func = pyodide.globals.get("_asgi_dispatch") as PyCallable;
+    asgiDispatchFuncs.set(pyodide, func);
+  }
+  return func;
+}
+
+// _shiny_app_registry from the Python bootstrap, the apps that are running, by
+// name. Like _asgi_dispatch(), it's looked up once for each engine.
+const appRegistries = new WeakMap<Pyodide, PyProxyWithHas>();
+
+export function appRegistry(pyodide: Pyodide): PyProxyWithHas {
+  let registry = appRegistries.get(pyodide);
+  if (!registry) {
+    registry = pyodide.globals.get("_shiny_app_registry") as PyProxyWithHas;
+    appRegistries.set(pyodide, registry);
+  }
+  return registry;
+}
+
 export async function makeRequest(
   scope: ASGIHTTPRequestScope,
   appName: string,
   clientPort: MessagePort,
   pyodide: Pyodide,
 ) {
-  // We could _almost_ use app(), but unfortunately pyodide's implicit proxying
-  // behavior isn't compatible with ASGI (which wants dict, not JsProxy); we
-  // need to explicitly convert stuff first, which is what call_pyodide does.
-  const asgiFunc = pyodide.runPython(
-    `_shiny_app_registry["${appName}"].app.call_pyodide`,
-  ) as PyCallable;
-  await connect(scope, clientPort, asgiFunc);
+  await connect(scope, appName, clientPort, asgiDispatch(pyodide));
 }
 
 async function connect(
   scope: ASGIHTTPRequestScope,
+  appName: string,
   clientPort: MessagePort,
-  asgiFunc: PyCallable,
+  dispatch: PyCallable,
 ) {
   const fromClientQueue = new AwaitableQueue<Record<string, any>>();
+  const credits = new CreditWindow(responseBodyWindowSize);
+  const response: ResponseState = {
+    started: false,
+    ended: false,
+    cancelled: false,
+  };
 
   clientPort.addEventListener("message", (event) => {
     if (event.data.type === "http.request") {
@@ -123,34 +240,115 @@ async function connect(
         body: event.data.body,
         more_body: event.data.more_body,
       });
+    } else if (event.data.type === "http.response.ack") {
+      credits.release();
+    } else if (event.data.type === "http.response.cancel") {
+      response.cancelled = true;
+      // Wake up a send() that's waiting, so that it can fail.
+      credits.close();
     }
   });
   clientPort.start();
 
   async function fromClient(): Promise<Record<string, any>> {
-    return fromClientQueue.dequeue();
+    const event = await fromClientQueue.dequeue();
+    // Let fetchASGI() send another chunk of the request body.
+    clientPort.postMessage({ type: "http.request.ack" });
+    return event;
   }
 
-  async function toClient(event: Record<string, any>): Promise<void> {
-    event = Object.fromEntries(event.toJs());
-    if (event.type === "http.response.start") {
-      clientPort.postMessage({
-        type: event.type,
-        status: event.status,
-        headers: asgiHeadersToRecord(event.headers),
-      });
-    } else if (event.type === "http.response.body") {
+  // The app's events arrive already converted to JS; see _asgi_dispatch().
+  async function toClient(
+    type: string,
+    arg1?: any,
+    arg2?: any,
+  ): Promise<void> {
+    if (type === "http.response.start") {
+      response.started = true;
       clientPort.postMessage({
-        type: event.type,
-        body: asgiBodyToArray(event.body),
-        more_body: event.more_body,
+        type,
+        status: arg1,
+        headers: asgiHeadersToRecord(arg2),
       });
+    } else if (type === "http.response.body") {
+      // Wait for fetchASGI() to have room for the chunk. This holds up the
+      // app's send(), and so the app.
+      await credits.acquire();
+      if (response.cancelled) throw new Error("The response was cancelled.");
+
+      // The body is a fresh copy from to_js(), so it can be transferred.
+      const body: Uint8Array = arg1;
+      response.ended = !arg2;
+      clientPort.postMessage(
+        {
+          type,
+          body,
+          more_body: arg2,
+        },
+        transferList(body),
+      );
     } else {
-      throw new Error(`Unhandled ASGI event: ${event.type}`);
+      throw new Error(`Unhandled ASGI event: ${type}`);
     }
   }
 
-  await asgiFunc(scope, fromClient, toClient);
+  await finishingResponse(clientPort, response, () =>
+    dispatch(appName, scope, fromClient, toClient),
+  );
+}
+
+type ResponseState = {
+  started: boolean;
+  ended: boolean;
+  // Whatever was reading the response stopped, so the app's next send()
+  // failed. That's how a response normally ends when the reader stops, so it
+  // isn't an error here.
+  cancelled: boolean;
+};
+
+// Run an app's handling of a request, and if the app fails, or returns without
+// sending the whole response, finish the response for it. Otherwise
+// fetchASGI() would wait for the rest forever, and hold on to its place in the
+// engine's request queue.
+async function finishingResponse(
+  clientPort: MessagePort,
+  response: ResponseState,
+  handle: () => Promise<unknown>,
+): Promise<void> {
+  let error: unknown;
+  try {
+    await handle();
+  } catch (e) {
+    if (response.cancelled) return;
+    error = e;
+    throw e;
+  } finally {
+    if (!response.ended && !response.cancelled) {
+      if (!response.started) {
+        const body = new TextEncoder().encode(
+          error === undefined
+            ? "The app didn't send a response."
+            : `Error handling the request: ${error}`,
+        );
+        clientPort.postMessage({
+          type: "http.response.start",
+          status: 500,
+          headers: { "content-type": "text/plain; charset=utf-8" },
+        });
+        clientPort.postMessage(
+          { type: "http.response.body", body, more_body: false },
+          transferList(body),
+        );
+      } else {
+        // The headers are out, so all that can be done is to cut the body
+        // short.
+        clientPort.postMessage({
+          type: "http.response.body",
+          more_body: false,
+        });
+      }
+    }
+  }
 }
 
 function headersToASGI(headers: Headers): Array<Array<string>> {
@@ -176,8 +374,10 @@ export interface ASGIHTTPRequestScope {
   headers: Array<Array<string>>;
 }
 
-function reqToASGI(req: Request): ASGIHTTPRequestScope {
-  const url = new URL(req.url);
+function reqToASGI(
+  req: Request,
+  url = new URL(req.url),
+): ASGIHTTPRequestScope {
   return {
     type: "http",
     asgi: {
@@ -207,25 +407,18 @@ function asgiToRes(res: ASGIHttpResponse, body: ReadableStream): Response {
   });
 }
 
-function asgiHeadersToRecord(headers: any): Record<string, string> {
-  headers = headers.map(([key, val]: [Uint8Array, Uint8Array]) => {
-    return [uint8ArrayToString(key), uint8ArrayToString(val)];
-  });
+function asgiHeadersToRecord(
+  headers: Array<[string, string]>,
+): Record<string, string> {
   return Object.assign(
     {
       "cross-origin-embedder-policy": "credentialless",
       "cross-origin-resource-policy": "cross-origin",
     },
-    Object.fromEntries(headers)
+    Object.fromEntries(headers),
   );
 }
 
-function asgiBodyToArray(body: any): Uint8Array {
-  // This seems not to be needed
-  // return Uint8Array.from(body.toJs());
-  return body;
-}
-
 // =============================================================================
 // webR
 // =============================================================================
@@ -240,6 +433,11 @@ export async function makeHttpuvRequest(
   webRProxy: WebRProxy,
 ) {
   const fromClientQueue = new AwaitableQueue<Record<string, any>>();
+  const response: ResponseState = {
+    started: false,
+    ended: false,
+    cancelled: false,
+  };
 
   clientPort.addEventListener("message", (event) => {
     if (event.data.type === "http.request") {
@@ -253,7 +451,10 @@ export async function makeHttpuvRequest(
   clientPort.start();
 
   async function fromClient(): Promise<Record<string, any>> {
-    return fromClientQueue.dequeue();
+    const event = await fromClientQueue.dequeue();
+    // Let fetchASGI() send another chunk of the request body.
+    clientPort.postMessage({ type: "http.request.ack" });
+    return event;
   }
 
   async function toClient(event: Record<string, any>): Promise<void> {
@@ -282,13 +483,20 @@ export async function makeHttpuvRequest(
       headers: headers,
     });
 
-    clientPort.postMessage({
-      type: "http.response.body",
-      body: body,
-      more_body: false,
-    });
+    clientPort.postMessage(
+      {
+        type: "http.response.body",
+        body: body,
+        more_body: false,
+      },
+      transferList(body),
+    );
+    response.started = true;
+    response.ended = true;
   }
-  await handleHttpuvRequests(scope, appName, webRProxy, fromClient, toClient);
+  await finishingResponse(clientPort, response, () =>
+    handleHttpuvRequests(scope, appName, webRProxy, fromClient, toClient),
+  );
 }
 
 async function handleHttpuvRequests(
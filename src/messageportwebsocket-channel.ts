@@ -1,6 +1,10 @@
 import type { RFunction } from "webr";
 import { AwaitableQueue } from "./awaitable-queue";
+import { appRegistry, asgiDispatch } from "./messageporthttp";
 import { MessagePortWebSocket } from "./messageportwebsocket";
+import type { TrafficRecorder } from "./traffic-recorder";
+import { recordWebSocket } from "./traffic-recorder";
+import { transferList } from "./utils";
 import type { PyCallable } from "./pyodide/ffi";
 import type { loadPyodide } from "./pyodide/pyodide";
 
@@ -23,21 +27,32 @@ export async function openChannel(
   appName: string,
   clientPort: MessagePort,
   pyodide: Pyodide,
+  recorder?: TrafficRecorder,
 ): Promise<void> {
+  // This is checked here, rather than by the caller before sending the port,
+  // to save a round trip to the worker.
+  if (!appRegistry(pyodide).has(appName)) {
+    clientPort.close();
+    return;
+  }
+
   const conn = new MessagePortWebSocket(clientPort);
-  // We could _almost_ use app(), but unfortunately pyodide's implicit proxying
-  // behavior isn't compatible with ASGI (which wants dict, not JsProxy); we
-  // need to explicitly convert stuff first, which is what call_pyodide does.
-  const asgiFunc = pyodide.runPython(
-    `_shiny_app_registry["${appName}"].app.call_pyodide`,
-  ) as PyCallable;
-  await connect(path, conn, asgiFunc);
+  if (recorder) {
+    recordWebSocket(
+      recorder,
+      appName,
+      `${location.origin}/${appName}${path}`,
+      conn,
+    );
+  }
+  await connect(path, appName, conn, asgiDispatch(pyodide));
 }
 
 async function connect(
   path: string,
+  appName: string,
   conn: MessagePortWebSocket,
-  asgiFunc: PyCallable,
+  dispatch: PyCallable,
 ) {
   // The `scope` argument we'll pass to the ASGI app
   const scope = {
@@ -61,19 +76,25 @@ async function connect(
   }
 
   // A function to be called by the ASGI app to send a message to the client.
-  async function toClient(event: Record<string, any>): Promise<void> {
-    event = Object.fromEntries(event.toJs());
-    if (event.type === "websocket.accept") {
+  // The events arrive already converted to JS; see _asgi_dispatch().
+  async function toClient(
+    type: string,
+    arg1?: any,
+    arg2?: any,
+  ): Promise<void> {
+    if (type === "websocket.accept") {
       // TODO: Also pass along event.subprotocol, event.headers
       conn.accept();
-    } else if (event.type === "websocket.send") {
-      conn.send(event.text ?? event.bytes);
-    } else if (event.type === "websocket.close") {
-      conn.close(event.code, event.reason);
+    } else if (type === "websocket.send") {
+      // The bytes are a fresh copy from to_js(), so they can be transferred.
+      const bytes: Uint8Array | undefined = arg2;
+      conn.send(arg1 ?? bytes, transferList(bytes));
+    } else if (type === "websocket.close") {
+      conn.close(arg1, arg2);
       fromClientQueue.enqueue({ type: "websocket.disconnect" });
     } else {
       conn.close(1002, "ASGI protocol error");
-      throw new Error(`Unhandled ASGI event: ${event.type}`);
+      throw new Error(`Unhandled ASGI event: ${type}`);
     }
   }
 
@@ -98,7 +119,7 @@ async function connect(
 
   // Initiate the ASGI WebSocket connection. It's not done awaiting until the
   // connection is closed.
-  await asgiFunc(scope, fromClient, toClient);
+  await dispatch(appName, scope, fromClient, toClient);
 }
 
 // =============================================================================
@@ -146,6 +146,23 @@ describe("send()", () => {
     expect(received).toEqual(["one", "two", "three"]);
   });
 
+  test("reports the frames sent and received to onframe", async () => {
+    const { server, client } = connectedPair();
+    const frames: unknown[] = [];
+    server.onframe = (direction, data) => frames.push([direction, data]);
+
+    server.accept();
+    await flush();
+    server.send("out");
+    client.send("in");
+    await flush();
+
+    expect(frames).toEqual([
+      ["out", "out"],
+      ["in", "in"],
+    ]);
+  });
+
   test("is silently dropped after close", async () => {
     const { server, client, serverPort } = connectedPair();
     const onmessage = jest.fn();
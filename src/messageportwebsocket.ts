@@ -13,6 +13,9 @@ export class MessagePortWebSocket extends EventTarget {
     | undefined;
   onerror: ((this: MessagePortWebSocket, ev: Event) => any) | undefined;
   onclose: ((this: MessagePortWebSocket, ev: CloseEvent) => any) | undefined;
+  // Called with each frame that's sent ("out") or received ("in"), for
+  // recording the traffic. See traffic-recorder.ts.
+  onframe: ((direction: "in" | "out", data: unknown) => void) | undefined;
 
   constructor(port: MessagePort) {
     super();
@@ -56,7 +59,9 @@ export class MessagePortWebSocket extends EventTarget {
     this._port.postMessage({ type: "open" });
   }
 
-  send(data: unknown) {
+  // If the caller won't use `data` again, its buffer can be passed in
+  // `transfer`, to move it to the other side instead of copying it.
+  send(data: unknown, transfer: Transferable[] = []) {
     if (this.readyState === 0) {
       throw new DOMException(
         "Can't send messages while WebSocket is in CONNECTING state",
@@ -67,7 +72,8 @@ export class MessagePortWebSocket extends EventTarget {
       return;
     }
 
-    this._port.postMessage({ type: "message", value: { data } });
+    this.onframe?.("out", data);
+    this._port.postMessage({ type: "message", value: { data } }, transfer);
   }
 
   close(code?: number, reason?: string) {
@@ -93,6 +99,7 @@ export class MessagePortWebSocket extends EventTarget {
         break;
       case "message":
         if (this.readyState === 1) {
+          this.onframe?.("in", event.value.data);
           this.dispatchEvent(new MessageEvent("message", { ...event.value }));
           return;
         }
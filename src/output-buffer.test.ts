@@ -0,0 +1,88 @@
+import type { OutputChunk } from "./output-buffer";
+import { OutputBuffer } from "./output-buffer";
+
+describe("OutputBuffer", () => {
+  let flushed: OutputChunk[][];
+  const onFlush = (chunks: OutputChunk[]) => flushed.push(chunks);
+
+  beforeEach(() => {
+    flushed = [];
+    jest.useFakeTimers();
+  });
+
+  afterEach(() => {
+    jest.useRealTimers();
+  });
+
+  test("flushes after the interval, joining lines from the same stream", () => {
+    const buffer = new OutputBuffer(onFlush, { flushInterval: 20 });
+    buffer.write("stdout", "a");
+    buffer.write("stdout", "b");
+    expect(flushed).toEqual([]);
+
+    jest.advanceTimersByTime(20);
+    expect(flushed).toEqual([[{ stream: "stdout", text: "a\nb" }]]);
+  });
+
+  test("keeps stdout and stderr in order", () => {
+    const buffer = new OutputBuffer(onFlush);
+    buffer.write("stdout", "a");
+    buffer.write("stderr", "b");
+    buffer.write("stdout", "c");
+    buffer.flush();
+
+    expect(flushed).toEqual([
+      [
+        { stream: "stdout", text: "a" },
+        { stream: "stderr", text: "b" },
+        { stream: "stdout", text: "c" },
+      ],
+    ]);
+  });
+
+  test("flushes as soon as maxBufferedLines is reached", () => {
+    const buffer = new OutputBuffer(onFlush, { maxBufferedLines: 3 });
+    buffer.write("stdout", "1");
+    buffer.write("stdout", "2");
+    expect(flushed).toHaveLength(0);
+    buffer.write("stdout", "3");
+    expect(flushed).toEqual([[{ stream: "stdout", text: "1\n2\n3" }]]);
+  });
+
+  test("flush() does nothing when there's no output", () => {
+    const buffer = new OutputBuffer(onFlush);
+    buffer.flush();
+    jest.runAllTimers();
+    expect(flushed).toEqual([]);
+  });
+
+  test("drops lines over the rate limit and reports how many", () => {
+    const buffer = new OutputBuffer(onFlush, { maxLinesPerSecond: 2 });
+    for (let i = 0; i < 5; i++) {
+      buffer.write("stdout", String(i));
+    }
+    buffer.flush();
+    expect(flushed).toEqual([[{ stream: "stdout", text: "0\n1" }]]);
+
+    // The marker is written when the window ends, without more output.
+    jest.advanceTimersByTime(1000);
+    expect(flushed[1]).toEqual([{ stream: "stderr", text: "[3 lines dropped]" }]);
+
+    // The next window starts with a full allowance.
+    buffer.write("stdout", "5");
+    buffer.flush();
+    expect(flushed[2]).toEqual([{ stream: "stdout", text: "5" }]);
+  });
+
+  test("a limit of 0 means no limit", () => {
+    const buffer = new OutputBuffer(onFlush, {
+      maxLinesPerSecond: 0,
+      maxBufferedLines: Infinity,
+    });
+    for (let i = 0; i < 10000; i++) {
+      buffer.write("stdout", "x");
+    }
+    buffer.flush();
+    expect(flushed[0][0].text.split("\n")).toHaveLength(10000);
+  });
+});
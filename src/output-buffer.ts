@@ -0,0 +1,132 @@
+// Collects stdout/stderr lines from Pyodide and hands them on in batches.
+//
+// Pyodide calls its stdout/stderr callbacks once per line. In the Web Worker,
+// each of those used to be a separate message to the main thread, so an app
+// that prints on every websocket frame (or a `print()` loop) could queue up
+// thousands of messages per second and freeze the page. Here lines are
+// buffered until enough of them have accumulated or a short timer fires, and
+// anything over a per-second limit is dropped and replaced with a
+// "[N lines dropped]" marker.
+
+export type OutputStream = "stdout" | "stderr";
+
+// Consecutive lines from the same stream, joined with "\n".
+export type OutputChunk = { stream: OutputStream; text: string };
+
+export interface OutputBufferOptions {
+  // Flush as soon as this many lines are buffered.
+  maxBufferedLines?: number;
+  // Otherwise flush this many milliseconds after the first buffered line.
+  flushInterval?: number;
+  // Lines beyond this many per second are dropped. 0 means no limit.
+  maxLinesPerSecond?: number;
+}
+
+export class OutputBuffer {
+  private chunks: OutputChunk[] = [];
+  private bufferedLines = 0;
+  private timer: ReturnType<typeof setTimeout> | undefined;
+
+  private maxBufferedLines: number;
+  private flushInterval: number;
+  private maxLinesPerSecond: number;
+
+  // The one-second window that maxLinesPerSecond applies to.
+  private windowStart = -Infinity;
+  private windowLines = 0;
+  private droppedLines = 0;
+
+  constructor(
+    private onFlush: (chunks: OutputChunk[]) => void,
+    {
+      maxBufferedLines = 200,
+      flushInterval = 20,
+      maxLinesPerSecond = 2000,
+    }: OutputBufferOptions = {},
+  ) {
+    this.maxBufferedLines = maxBufferedLines;
+    this.flushInterval = flushInterval;
+    this.maxLinesPerSecond = maxLinesPerSecond;
+  }
+
+  write(stream: OutputStream, line: string): void {
+    this.rollWindow();
+
+    if (
+      this.maxLinesPerSecond > 0 &&
+      this.windowLines >= this.maxLinesPerSecond
+    ) {
+      this.droppedLines++;
+      // Make sure the marker is written when the window ends, even if nothing
+      // else is printed after this.
+      if (this.timer === undefined) {
+        this.setTimer(this.windowStart + 1000 - Date.now());
+      }
+      return;
+    }
+
+    this.windowLines++;
+    this.append(stream, line);
+
+    if (this.bufferedLines >= this.maxBufferedLines) {
+      this.flush();
+    } else if (this.timer === undefined) {
+      this.setTimer(this.flushInterval);
+    }
+  }
+
+  // Send everything that's buffered now. Call this before anything that has to
+  // arrive after the output, like the reply to a request.
+  flush(): void {
+    this.clearTimer();
+    this.rollWindow();
+    if (this.droppedLines > 0) {
+      this.setTimer(this.windowStart + 1000 - Date.now());
+    }
+
+    if (this.chunks.length === 0) return;
+    const chunks = this.chunks;
+    this.chunks = [];
+    this.bufferedLines = 0;
+    this.onFlush(chunks);
+  }
+
+  private append(stream: OutputStream, line: string): void {
+    const last = this.chunks[this.chunks.length - 1];
+    if (last && last.stream === stream) {
+      last.text += "\n" + line;
+    } else {
+      this.chunks.push({ stream, text: line });
+    }
+    this.bufferedLines++;
+  }
+
+  // Start a new window if the current one is over, and report the lines that
+  // were dropped in it.
+  private rollWindow(): void {
+    const now = Date.now();
+    if (now - this.windowStart < 1000) return;
+
+    if (this.droppedLines > 0) {
+      this.append("stderr", `[${this.droppedLines} lines dropped]`);
+      this.droppedLines = 0;
+    }
+    this.windowStart = now;
+    this.windowLines = 0;
+  }
+
+  private setTimer(delay: number): void {
+    this.clearTimer();
+    this.timer = setTimeout(() => {
+      this.timer = undefined;
+      this.flush();
+    }, Math.max(delay, 0));
+  }
+
+  private clearTimer(): void {
+    if (this.timer !== undefined) {
+      clearTimeout(this.timer);
+      this.timer = undefined;
+    }
+  }
+}
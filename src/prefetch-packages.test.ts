@@ -0,0 +1,83 @@
+import type { PackageLock } from "./prefetch-packages";
+import { findImports, packagesForImports } from "./prefetch-packages";
+
+describe("findImports()", () => {
+  test("finds plain, dotted, aliased and comma-separated imports", () => {
+    const code = [
+      "import numpy as np",
+      "import matplotlib.pyplot as plt",
+      "import os, sys",
+      "  import pandas  # indented, with a comment",
+    ].join("\n");
+    expect(findImports(code).sort()).toEqual([
+      "matplotlib",
+      "numpy",
+      "os",
+      "pandas",
+      "sys",
+    ]);
+  });
+
+  test("finds from-imports by their top-level module", () => {
+    const code = "from shiny import App, ui\nfrom shiny.express import input";
+    expect(findImports(code)).toEqual(["shiny"]);
+  });
+
+  test("skips relative imports", () => {
+    expect(findImports("from . import utils\nfrom .data import df")).toEqual(
+      [],
+    );
+  });
+
+  test("ignores lines that aren't imports", () => {
+    expect(findImports('x = "import numpy"\nprint(1)')).toEqual([]);
+  });
+});
+
+describe("packagesForImports()", () => {
+  const lock: PackageLock = {
+    packages: {
+      shiny: {
+        file_name: "shiny.whl",
+        imports: ["shiny"],
+        depends: ["htmltools", "starlette"],
+      },
+      htmltools: {
+        file_name: "htmltools.whl",
+        imports: ["htmltools"],
+        depends: ["packaging"],
+      },
+      starlette: { file_name: "starlette.whl", imports: ["starlette"] },
+      packaging: { file_name: "packaging.whl", imports: ["packaging"] },
+      "scikit-learn": {
+        file_name: "scikit_learn.whl",
+        imports: ["sklearn"],
+        depends: [],
+      },
+    },
+  };
+
+  test("includes dependencies, transitively", () => {
+    expect(packagesForImports(["shiny"], lock)).toEqual([
+      "htmltools",
+      "packaging",
+      "shiny",
+      "starlette",
+    ]);
+  });
+
+  test("maps import names to package names", () => {
+    expect(packagesForImports(["sklearn"], lock)).toEqual(["scikit-learn"]);
+  });
+
+  test("ignores imports that no package provides", () => {
+    expect(packagesForImports(["os", "utils"], lock)).toEqual([]);
+  });
+
+  test("ignores dependencies missing from the lockfile", () => {
+    const partial: PackageLock = {
+      packages: { a: { file_name: "a.whl", imports: ["a"], depends: ["b"] } },
+    };
+    expect(packagesForImports(["a"], partial)).toEqual(["a"]);
+  });
+});
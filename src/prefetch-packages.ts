@@ -0,0 +1,130 @@
+// Start downloading the wheels an app needs while the Pyodide engine boots.
+//
+// Without this, package downloads can't start until loadPyodide() has resolved
+// and the app has reached _load_packages_from_dir(), so they happen strictly
+// after the wasm is compiled. Here we read the start files on the main thread,
+// map their imports through pyodide-lock.json, and fetch the wheels so that
+// they are in the HTTP cache by the time Pyodide asks for them.
+//
+// This is only a head start. The scanner is a line-based approximation of
+// Python's import syntax, and Pyodide still does its own (exact) detection when
+// the app starts, so anything missed here is loaded then, as before.
+
+import type { FileContent } from "./Components/filecontent";
+
+// The parts of pyodide-lock.json that we use.
+export type PackageLock = {
+  packages: Record<
+    string,
+    {
+      file_name: string;
+      imports?: string[];
+      depends?: string[];
+    }
+  >;
+};
+
+const importRegex = /^\s*import\s+(.+)$/;
+const fromImportRegex = /^\s*from\s+([A-Za-z_][\w.]*)\s+import\b/;
+
+/**
+ * Return the top-level module names imported by some Python code.
+ *
+ * Relative imports are skipped, since they can only refer to the app's own
+ * files.
+ */
+export function findImports(code: string): string[] {
+  const imports = new Set<string>();
+
+  for (const line of code.split("\n")) {
+    const fromMatch = fromImportRegex.exec(line);
+    if (fromMatch) {
+      imports.add(fromMatch[1].split(".")[0]);
+      continue;
+    }
+
+    const importMatch = importRegex.exec(line);
+    if (importMatch) {
+      // "import a.b as c, d" -> ["a", "d"]
+      for (const part of importMatch[1].replace(/#.*$/, "").split(",")) {
+        const name = part.trim().split(/\s+/)[0].split(".")[0];
+        if (/^[A-Za-z_]\w*$/.test(name)) {
+          imports.add(name);
+        }
+      }
+    }
+  }
+
+  return Array.from(imports);
+}
+
+/**
+ * Return the names of the packages in the lockfile which provide `imports`,
+ * along with all of their dependencies.
+ */
+export function packagesForImports(
+  imports: string[],
+  lock: PackageLock,
+): string[] {
+  const importToPackage = new Map<string, string>();
+  for (const [name, pkg] of Object.entries(lock.packages)) {
+    for (const importName of pkg.imports ?? []) {
+      importToPackage.set(importName, name);
+    }
+  }
+
+  const result = new Set<string>();
+  const pending: string[] = [];
+  for (const importName of imports) {
+    const name = importToPackage.get(importName);
+    if (name !== undefined) pending.push(name);
+  }
+
+  while (pending.length > 0) {
+    const name = pending.pop()!;
+    if (result.has(name) || !(name in lock.packages)) continue;
+    result.add(name);
+    pending.push(...(lock.packages[name].depends ?? []));
+  }
+
+  return Array.from(result).sort();
+}
+
+/**
+ * Fetch the wheels that `files` are likely to need, so that they're cached by
+ * the time Pyodide loads them. Never throws: a failed prefetch just means the
+ * package is downloaded later, when it's needed.
+ */
+export async function prefetchPackagesForFiles(
+  files: FileContent[],
+  indexURL: string,
+): Promise<void> {
+  const imports = new Set<string>();
+  for (const file of files) {
+    if (file.type !== "text") continue;
+    if (file.name.endsWith(".py")) {
+      findImports(file.content).forEach((x) => imports.add(x));
+    }
+  }
+  if (imports.size === 0) return;
+
+  try {
+    const response = await fetch(indexURL + "pyodide-lock.json");
+    if (!response.ok) return;
+    const lock = (await response.json()) as PackageLock;
+    const baseUrl = new URL(indexURL, window.location.href);
+
+    await Promise.all(
+      packagesForImports(Array.from(imports), lock).map(async (name) => {
+        const wheel = await fetch(
+          new URL(lock.packages[name].file_name, baseUrl),
+        );
+        // Read the body to the end so that the browser caches it, without
+        // keeping it in memory here.
+        await wheel.body?.pipeTo(new WritableStream());
+      }),
+    );
+  } catch (e) {
+    console.warn("Could not prefetch packages:", e);
+  }
+}
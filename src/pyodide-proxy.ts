@@ -1,28 +1,90 @@
 import type { ASGIHTTPRequestScope } from "./messageporthttp.js";
 import { makeRequest } from "./messageporthttp.js";
 import { openChannel } from "./messageportwebsocket-channel";
-import { postableErrorObjectToError } from "./postable-error";
+import type { OutputBufferOptions } from "./output-buffer";
+import {
+  errorToPostableErrorObject,
+  postableErrorObjectToError,
+} from "./postable-error";
 import type * as PyodideWorker from "./pyodide-worker";
-import type { PyIterable, PyProxy } from "./pyodide/ffi";
+import type {
+  PyBuffer,
+  PyIterable,
+  PyProxy,
+  PyProxyWithGet,
+} from "./pyodide/ffi";
 import type { PackageData } from "./pyodide/pyodide";
 import { loadPyodide } from "./pyodide/pyodide";
+import type { RpcMetricsReport } from "./rpc-metrics";
+import { mergeReports, RpcMetrics } from "./rpc-metrics";
+import type {
+  HarEntry,
+  TrafficRecorder,
+  TrafficRecorderCommand,
+} from "./traffic-recorder";
 import * as utils from "./utils";
 
 type Pyodide = Awaited<ReturnType<typeof loadPyodide>>;
 
-export type ProxyType = "webworker" | "normal";
+export type ProxyType = "webworker" | "sharedworker" | "normal";
 
-export type ResultType = "value" | "printed_value" | "to_html" | "none";
+export type ResultType =
+  | "value"
+  | "printed_value"
+  | "to_html"
+  | "columnar"
+  | "none";
 
 export type ToHtmlResult = {
   type: "html" | "text";
   value: string;
 };
 
+// A numeric array, as a typed array in C order. `dtype` is the NumPy dtype
+// string, like "<f8" or "|b1"; int64 and uint64 data is a BigInt64Array or
+// BigUint64Array.
+export type ColumnarArray = {
+  type: "array";
+  dtype: string;
+  shape: number[];
+  data: ArrayBufferView;
+};
+
+// A value that has no columnar form, converted with toJs().
+export type ColumnarValue = {
+  type: "value";
+  value: any;
+};
+
+export type ColumnarResult =
+  | ColumnarArray
+  // A pandas DataFrame, when pyarrow isn't loaded. Numeric columns are arrays;
+  // the others are converted with toJs().
+  | {
+      type: "table";
+      names: string[];
+      columns: Array<ColumnarArray | ColumnarValue>;
+    }
+  // A pyarrow Table or RecordBatch, or a DataFrame when pyarrow is loaded, in
+  // the Arrow IPC stream format.
+  | { type: "arrow"; data: Uint8Array }
+  | ColumnarValue;
+
+// A call to a Python function, for callPyAsync() and callPyBatchAsync(). See
+// InMessageCallPyAsync in pyodide-worker.ts for how it's translated to Python.
+export interface PyCall {
+  fnName: string[];
+  args?: any[];
+  kwargs?: { [x: string]: any };
+  returnResult?: ResultType;
+  printResult?: boolean;
+}
+
 interface ReturnMapping {
   value: any;
   printed_value: string;
   to_html: ToHtmlResult;
+  columnar: ColumnarResult;
   none: void;
 }
 
@@ -62,8 +124,17 @@ export interface PyodideProxy {
   //       a ToHtmlResult object. If it succeeded in convertint to HTML, then
   //       the ToHtmlResult object's `.type` property will be "html"; otherwise
   //       it will be "text".
+  //     - If "columnar", then arrays, tables, and lists of numbers are
+  //       returned as a ColumnarResult, whose data is in typed arrays. The
+  //       conversion is done with bulk copies instead of walking the object,
+  //       and in a Web Worker the buffers are transferred rather than copied.
+  //       Anything else is converted as with "value".
   // - printResult: Should the result be printed using the stdout method which
   //     was passed to loadPyodide()?
+  // - once: For code that sets up the engine. If the engine is shared with
+  //     other documents (see SharedWorkerPyodideProxy) and one of them has
+  //     already run this code, wait for that run instead of running it again.
+  //     Nothing is returned or printed.
   //
   // If an error occurs in the Python code, then this function will throw a JS
   // error.
@@ -73,7 +144,11 @@ export interface PyodideProxy {
   // https://stackoverflow.com/questions/72166620/typescript-conditional-return-type-using-an-object-parameter-and-default-values
   runPyAsync<K extends keyof ReturnMapping = "none">(
     code: string,
-    { returnResult, printResult }?: { returnResult?: K; printResult?: boolean },
+    {
+      returnResult,
+      printResult,
+      once,
+    }?: { returnResult?: K; printResult?: boolean; once?: boolean },
   ): Promise<ReturnMapping[K]>;
 
   // registerJsModule: typeof registerJsModule;
@@ -97,6 +172,26 @@ export interface PyodideProxy {
     printResult?: boolean;
   }): Promise<any>;
 
+  // Make several calls in order, with a single message to the worker instead of
+  // one round trip per call. Returns the result of each call. If a call throws
+  // an error, the calls after it are not made, and the error is thrown.
+  callPyBatchAsync(calls: PyCall[]): Promise<any[]>;
+
+  // Raise KeyboardInterrupt in the Python code that's running, if any. This
+  // works through an interrupt buffer in a SharedArrayBuffer, so it is only
+  // possible in a Web Worker on a cross-origin isolated page. Returns false if
+  // it isn't possible; then restart() is the only way to stop running code.
+  interrupt(): boolean;
+
+  // Replace the engine with a new one, and call the onRestart() callbacks to
+  // set it up again. Calls that were waiting on the old engine throw an error.
+  restart(): Promise<void>;
+
+  // Add a function to call after the engine is restarted. They're called in the
+  // order they were added, so the first should restore the Python environment
+  // that the others rely on. Returns a function that removes the callback.
+  onRestart(callback: () => Promise<void> | void): () => void;
+
   openChannel(
     path: string,
     appName: string,
@@ -107,14 +202,41 @@ export interface PyodideProxy {
     appName: string,
     clientPort: MessagePort,
   ): Promise<void>;
+
+  // Handle HTTP requests and websocket connections for this engine's apps from
+  // the messages on `port`, whose other end is held by the service worker (see
+  // AppPortMessage and app-registry.ts). With a Web Worker, the port is handed
+  // to the worker, so the apps' traffic doesn't go through the main thread.
+  serveApps(port: MessagePort): void;
+
+  // Timings for the messages to and from the engine, if it was loaded with
+  // `metrics: true`. See rpc-metrics.ts.
+  metrics(): Promise<RpcMetricsReport | undefined>;
+
+  // Control the recording of the apps' websocket frames, if the engine was
+  // loaded with `metrics: true`. For "export", returns the HAR entries for the
+  // websockets; otherwise, an empty list. See traffic-recorder.ts.
+  trafficRecorder(command: TrafficRecorderCommand): Promise<HarEntry[]>;
 }
 
+// The messages that the service worker sends on a port that was passed to
+// serveApps(). Each one comes with a port for the request or websocket.
+export type AppPortMessage =
+  | { type: "makeRequest"; appName: string; scope: ASGIHTTPRequestScope }
+  | { type: "openChannel"; appName: string; path: string };
+
 export interface LoadPyodideConfig {
   indexURL: string;
   fullStdLib?: boolean;
   stdin?: () => string;
   stdout?: (text: string) => void;
   stderr?: (text: string) => void;
+  // How output from the Web Worker is batched and rate-limited. Not used by
+  // NormalPyodideProxy, which calls stdout and stderr directly.
+  output?: OutputBufferOptions;
+  // Record timings for the messages to and from the Web Worker. Not used by
+  // NormalPyodideProxy, which doesn't send any.
+  metrics?: boolean;
 }
 
 // =============================================================================
@@ -132,7 +254,7 @@ export async function setupPythonEnv(
   pyodide: Pyodide,
   callJS: null | ((fnName: PyIterable, args: PyIterable) => Promise<any>),
 ): Promise<PyUtils> {
-  const repr = pyodide.globals.get("repr") as (x: any) => string;
+  const repr = pyodide.globals.spec.get("repr") as (x: any) => string;
 
   // Make the JS pyodide object available in Python.
   pyodide.globals.set("js_pyodide", pyodide);
@@ -184,6 +306,7 @@ export async function setupPythonEnv(
 class NormalPyodideProxy implements PyodideProxy {
   pyodide!: Pyodide;
   pyUtils!: PyUtils;
+  callables!: PyCallableCache;
 
   constructor(
     private stdoutCallback: (text: string) => void,
@@ -194,6 +317,7 @@ class NormalPyodideProxy implements PyodideProxy {
     this.pyodide = await loadPyodide(config);
 
     this.pyUtils = await setupPythonEnv(this.pyodide, this.callJS);
+    this.callables = new PyCallableCache(this.pyodide);
   }
 
   loadPackagesFromImports(code: string) {
@@ -211,12 +335,14 @@ class NormalPyodideProxy implements PyodideProxy {
   }
 
   // https://stackoverflow.com/questions/72166620/typescript-conditional-return-type-using-an-object-parameter-and-default-values
+  //
+  // `once` makes no difference here, because this engine is never shared.
   async runPyAsync<K extends keyof ReturnMapping = "none">(
     code: string,
     {
       returnResult = "none" as K,
       printResult = false,
-    }: { returnResult?: K; printResult?: boolean } = {
+    }: { returnResult?: K; printResult?: boolean; once?: boolean } = {
       returnResult: "none" as K,
       printResult: false,
     },
@@ -232,6 +358,8 @@ class NormalPyodideProxy implements PyodideProxy {
       }
       this.stderrCallback((err as Error).message);
       throw err;
+    } finally {
+      this.callables.clear();
     }
 
     if (printResult && result !== undefined) {
@@ -265,35 +393,44 @@ class NormalPyodideProxy implements PyodideProxy {
     returnResult: K;
     printResult: boolean;
   }): Promise<ReturnMapping[K]> {
-    // fnName is something like ["os", "path", "join"]. Get the first
-    // element, then descend into it.
-    let fn = this.pyodide.globals.get(fnName[0]);
-    for (const el of fnName.slice(1)) {
-      fn = fn[el];
+    return callPyFunction(
+      { fnName, args, kwargs, returnResult, printResult },
+      this.callables,
+      this.pyodide,
+      this.pyUtils,
+      this.stdoutCallback,
+    );
+  }
+
+  async callPyBatchAsync(calls: PyCall[]): Promise<any[]> {
+    const results = [];
+    for (const call of calls) {
+      results.push(
+        await callPyFunction(
+          call,
+          this.callables,
+          this.pyodide,
+          this.pyUtils,
+          this.stdoutCallback,
+        ),
+      );
     }
+    return results;
+  }
 
-    // If fn is an async function, this will return a Promise; if it is a normal
-    // function, it will reutrn a normal value.
-    const resultMaybePromise = fn.callKwargs(...args, kwargs);
-    // This will convert non-Promises to Promises, and then await them.
-    const result = await Promise.resolve(resultMaybePromise);
+  interrupt(): boolean {
+    // Python shares this thread, so while it runs, nothing here can.
+    return false;
+  }
 
-    if (printResult && result !== undefined) {
-      this.stdoutCallback(this.pyUtils.repr(result));
-    }
+  async restart(): Promise<void> {
+    throw new Error(
+      "Python can't be restarted when it runs on the main thread.",
+    );
+  }
 
-    try {
-      return processReturnValue(
-        result,
-        returnResult,
-        this.pyodide,
-        this.pyUtils.repr,
-      );
-    } finally {
-      if (result instanceof this.pyodide.ffi.PyProxy) {
-        result.destroy();
-      }
-    }
+  onRestart(callback: () => Promise<void> | void): () => void {
+    return () => {};
   }
 
   async openChannel(
@@ -312,6 +449,20 @@ class NormalPyodideProxy implements PyodideProxy {
     await makeRequest(scope, appName, clientPort, this.pyodide);
   }
 
+  serveApps(port: MessagePort): void {
+    serveAppsPort(port, this.pyodide);
+  }
+
+  async metrics(): Promise<RpcMetricsReport | undefined> {
+    return undefined;
+  }
+
+  async trafficRecorder(
+    command: TrafficRecorderCommand,
+  ): Promise<HarEntry[]> {
+    return [];
+  }
+
   public static async build(
     config: LoadPyodideConfig,
     stdoutCallback: (text: string) => void,
@@ -347,43 +498,69 @@ class NormalPyodideProxy implements PyodideProxy {
 // WebWorkerPyodideProxy
 // =============================================================================
 
-// Narrow the types for postMessage to just the type we'll actually send.
-interface PyodideWebWorker extends Omit<Worker, "postMessage"> {
+// Narrow the types for postMessage to just the type we'll actually send. This
+// is a Worker, or a SharedWorker's port for SharedWorkerPyodideProxy.
+interface PyodideWebWorker {
   postMessage(msg: PyodideWorker.InMessage, transfer: Transferable[]): void;
+  terminate(): void;
 }
 
 class WebWorkerPyodideProxy implements PyodideProxy {
-  pyWorker: PyodideWebWorker;
+  pyWorker!: PyodideWebWorker;
+  config!: LoadPyodideConfig;
+  interruptBuffer: Uint8Array | undefined;
+  // Resolvers for the replies that postMessageAsync() is waiting on.
+  pendingReplies = new Set<(msg: PyodideWorker.ReplyMessage) => void>();
+  rpcMetrics: RpcMetrics | undefined;
+  restartCallbacks: Array<() => Promise<void> | void> = [];
 
   constructor(
     private stdoutCallback: (text: string) => void,
     private stderrCallback: (text: string) => void,
   ) {
-    this.pyWorker = new Worker(
+    if (globalThis.crossOriginIsolated) {
+      this.interruptBuffer = new Uint8Array(new SharedArrayBuffer(1));
+    }
+  }
+
+  protected startWorker(): void {
+    const worker = new Worker(
       utils.currentScriptDir() + "/pyodide-worker.js",
       { type: "module" },
     );
+    worker.onmessage = (e) => this.onWorkerMessage(e);
+    this.pyWorker = worker;
+  }
 
-    this.pyWorker.onmessage = (e) => {
-      const msg = e.data as PyodideWorker.NonReplyMessage;
-      if (msg.subtype === "output") {
-        if (msg.stdout) this.stdoutCallback(msg.stdout);
-        if (msg.stderr) this.stderrCallback(msg.stderr);
-      } else if (msg.subtype === "callJS") {
-        let fn = self as any;
-        for (const el of msg.fnName) {
-          fn = fn[el];
+  protected onWorkerMessage(e: MessageEvent): void {
+    const msg = e.data as PyodideWorker.NonReplyMessage;
+    if (msg.subtype === "output") {
+      for (const chunk of msg.chunks) {
+        if (chunk.stream === "stdout") {
+          this.stdoutCallback(chunk.text);
+        } else {
+          this.stderrCallback(chunk.text);
         }
-        fn = fn as (...args: any[]) => any;
-        fn(...msg.args);
       }
-    };
+    } else if (msg.subtype === "callJS") {
+      let fn = self as any;
+      for (const el of msg.fnName) {
+        fn = fn[el];
+      }
+      fn = fn as (...args: any[]) => any;
+      fn(...msg.args);
+    }
   }
 
   async init(config: LoadPyodideConfig): Promise<void> {
+    this.config = config;
+    if (config.metrics) {
+      this.rpcMetrics ??= new RpcMetrics();
+    }
     const response = (await this.postMessageAsync({
       type: "init",
       config,
+      interruptBuffer: this.interruptBuffer,
     })) as PyodideWorker.ReplyMessageDone;
 
     // The worker reports an init failure in the reply rather than by dying, so
@@ -408,17 +585,56 @@ class WebWorkerPyodideProxy implements PyodideProxy {
   ): Promise<PyodideWorker.ReplyMessage> {
     return new Promise((onSuccess) => {
       const channel = new MessageChannel();
+      const done = this.rpcMetrics?.begin(msg.type, msg, { sent: true });
 
-      channel.port1.onmessage = (e) => {
+      const onReply = (reply: PyodideWorker.ReplyMessage) => {
+        this.pendingReplies.delete(onReply);
         channel.port1.close();
-        const msg = e.data as PyodideWorker.ReplyMessage;
-        onSuccess(msg);
+        done?.(reply, reply.timing);
+        onSuccess(reply);
+      };
+      this.pendingReplies.add(onReply);
+
+      channel.port1.onmessage = (e) => {
+        onReply(e.data as PyodideWorker.ReplyMessage);
       };
 
       this.pyWorker.postMessage(msg, [channel.port2]);
     });
   }
 
+  interrupt(): boolean {
+    if (!this.interruptBuffer) return false;
+    // 2 is SIGINT, which Pyodide turns into a KeyboardInterrupt.
+    this.interruptBuffer[0] = 2;
+    return true;
+  }
+
+  async restart(): Promise<void> {
+    this.pyWorker.terminate();
+
+    const error = errorToPostableErrorObject(
+      new Error("Python was restarted before this finished."),
+    );
+    for (const onReply of Array.from(this.pendingReplies)) {
+      onReply({ type: "reply", subtype: "done", error });
+    }
+
+    this.startWorker();
+    await this.init(this.config);
+    for (const callback of Array.from(this.restartCallbacks)) {
+      await callback();
+    }
+  }
+
+  onRestart(callback: () => Promise<void> | void): () => void {
+    this.restartCallbacks.push(callback);
+    return () => {
+      const i = this.restartCallbacks.indexOf(callback);
+      if (i !== -1) this.restartCallbacks.splice(i, 1);
+    };
+  }
+
   async loadPackagesFromImports(code: string): Promise<Array<PackageData>> {
     const msg = await this.postMessageAsync({
       type: "loadPackagesFromImports",
@@ -455,7 +671,8 @@ class WebWorkerPyodideProxy implements PyodideProxy {
     {
       returnResult = "none" as K,
       printResult = false,
-    }: { returnResult?: K; printResult?: boolean } = {
+      once = false,
+    }: { returnResult?: K; printResult?: boolean; once?: boolean } = {
       returnResult: "none" as K,
       printResult: false,
     },
@@ -465,6 +682,7 @@ class WebWorkerPyodideProxy implements PyodideProxy {
       code,
       returnResult,
       printResult,
+      once,
     })) as PyodideWorker.ReplyMessageDone;
 
     if (response.error) {
@@ -507,6 +725,24 @@ class WebWorkerPyodideProxy implements PyodideProxy {
     return response.value;
   }
 
+  async callPyBatchAsync(calls: PyCall[]): Promise<any[]> {
+    const response = (await this.postMessageAsync({
+      type: "callPyBatchAsync",
+      calls,
+    })) as PyodideWorker.ReplyMessageBatchDone;
+
+    // response.error is set if the worker failed before making any calls.
+    const error =
+      response.error ?? response.results?.find((result) => result.error)?.error;
+    if (error) {
+      const err = postableErrorObjectToError(error);
+      this.stderrCallback(err.message);
+      throw err;
+    }
+
+    return response.results.map((result) => result.value);
+  }
+
   async openChannel(
     path: string,
     appName: string,
@@ -527,6 +763,32 @@ class WebWorkerPyodideProxy implements PyodideProxy {
     ]);
   }
 
+  serveApps(port: MessagePort): void {
+    this.pyWorker.postMessage({ type: "serveApps" }, [port]);
+  }
+
+  async metrics(): Promise<RpcMetricsReport | undefined> {
+    if (!this.rpcMetrics) return undefined;
+    // Taken before asking the worker, so that the getMetrics message itself
+    // isn't in the report.
+    const report = this.rpcMetrics.report();
+    const reply = (await this.postMessageAsync({
+      type: "getMetrics",
+    })) as PyodideWorker.ReplyMessageDone;
+    return reply.value ? mergeReports(report, reply.value) : report;
+  }
+
+  async trafficRecorder(
+    command: TrafficRecorderCommand,
+  ): Promise<HarEntry[]> {
+    if (!this.rpcMetrics) return [];
+    const reply = (await this.postMessageAsync({
+      type: "trafficRecorder",
+      command,
+    })) as PyodideWorker.ReplyMessageDone;
+    return reply.value;
+  }
+
   // The reason we have this build() method is because the class constructor
   // can't be async, but there is some async stuff that needs to happen in the
   // initialization. The solution is to have this static async build() method,
@@ -538,6 +800,79 @@ class WebWorkerPyodideProxy implements PyodideProxy {
     stderrCallback: (text: string) => void,
   ): Promise<WebWorkerPyodideProxy> {
     const proxy = new WebWorkerPyodideProxy(stdoutCallback, stderrCallback);
+    proxy.startWorker();
+    await proxy.init(config);
+    return proxy;
+  }
+}
+
+// =============================================================================
+// SharedWorkerPyodideProxy
+// =============================================================================
+
+// Like WebWorkerPyodideProxy, but the worker is a SharedWorker, so every tab
+// and iframe from this origin that uses one with the same name attaches to the
+// same engine, instead of each downloading and starting its own. Output from the engine goes
+// to all of them. When a document goes away, the worker stops the apps it was
+// showing.
+class SharedWorkerPyodideProxy extends WebWorkerPyodideProxy {
+  constructor(
+    stdoutCallback: (text: string) => void,
+    stderrCallback: (text: string) => void,
+    private workerName: string,
+  ) {
+    super(stdoutCallback, stderrCallback);
+    // A SharedArrayBuffer can't be sent to a SharedWorker, which isn't in the
+    // same agent cluster as this page, so the engine can't be interrupted.
+    this.interruptBuffer = undefined;
+  }
+
+  protected startWorker(): void {
+    const worker = new SharedWorker(
+      utils.currentScriptDir() + "/pyodide-worker.js",
+      { type: "module", name: this.workerName },
+    );
+    const port = worker.port;
+    port.onmessage = (e) => this.onWorkerMessage(e);
+
+    this.pyWorker = {
+      postMessage: (msg, transfer) => port.postMessage(msg, transfer),
+      // The worker keeps running for the other documents.
+      terminate: () => {
+        port.postMessage({ type: "disconnect" });
+        port.close();
+      },
+    };
+
+    // If the page is put in the back/forward cache, it may come back, so its
+    // apps are left running.
+    window.addEventListener("pagehide", (e) => {
+      if (!e.persisted) this.pyWorker.terminate();
+    });
+  }
+
+  proxyType(): ProxyType {
+    return "sharedworker";
+  }
+
+  async restart(): Promise<void> {
+    throw new Error(
+      "Python is shared with other pages, so it can't be restarted from here.",
+    );
+  }
+
+  public static async build(
+    config: LoadPyodideConfig,
+    stdoutCallback: (text: string) => void,
+    stderrCallback: (text: string) => void,
+    workerName: string,
+  ): Promise<SharedWorkerPyodideProxy> {
+    const proxy = new SharedWorkerPyodideProxy(
+      stdoutCallback,
+      stderrCallback,
+      workerName,
+    );
+    proxy.startWorker();
     await proxy.init(config);
     return proxy;
   }
@@ -546,8 +881,11 @@ class WebWorkerPyodideProxy implements PyodideProxy {
 // =============================================================================
 //
 // =============================================================================
+// `engineIndex` is the engine's position in the page's pool. SharedWorkers are
+// named by it, so that each engine in a pool is a separate worker, which it
+// shares with the engines at the same position in other tabs.
 export function loadPyodideProxy(
-  config: LoadPyodideConfig & { type: "normal" | "webworker" },
+  config: LoadPyodideConfig & { type: ProxyType; engineIndex?: number },
   stdoutCallback: (text: string) => void = console.log,
   stderrCallback: (text: string) => void = console.error,
 ): Promise<PyodideProxy> {
@@ -555,6 +893,21 @@ export function loadPyodideProxy(
     return NormalPyodideProxy.build(config, stdoutCallback, stderrCallback);
   } else if (config.type === "webworker") {
     return WebWorkerPyodideProxy.build(config, stdoutCallback, stderrCallback);
+  } else if (config.type === "sharedworker") {
+    // SharedWorker isn't available everywhere, notably in Chrome for Android.
+    if (typeof SharedWorker === "undefined") {
+      return WebWorkerPyodideProxy.build(
+        config,
+        stdoutCallback,
+        stderrCallback,
+      );
+    }
+    return SharedWorkerPyodideProxy.build(
+      config,
+      stdoutCallback,
+      stderrCallback,
+      `shinylive-pyodide-${config.engineIndex ?? 0}`,
+    );
   } else {
     throw new Error("Unknown type");
   }
@@ -564,6 +917,109 @@ export function loadPyodideProxy(
 // Utility functions
 // =============================================================================
 
+// Handle the messages on a port that was passed to serveApps(), with the
+// Pyodide in this thread. `onApp` is called with the name of the app that each
+// message is for, `metrics` records how long each one takes, and `traffic`
+// records the websockets' frames.
+export function serveAppsPort(
+  port: MessagePort,
+  pyodide: Pyodide,
+  {
+    onApp,
+    metrics,
+    traffic,
+  }: {
+    onApp?: (appName: string) => void;
+    metrics?: RpcMetrics;
+    traffic?: TrafficRecorder;
+  } = {},
+): void {
+  port.onmessage = async (e) => {
+    const msg = e.data as AppPortMessage;
+    onApp?.(msg.appName);
+    const done = metrics?.begin(msg.type, msg);
+    try {
+      if (msg.type === "makeRequest") {
+        await makeRequest(msg.scope, msg.appName, e.ports[0], pyodide);
+      } else if (msg.type === "openChannel") {
+        await openChannel(msg.path, msg.appName, e.ports[0], pyodide, traffic);
+      }
+    } finally {
+      done?.();
+    }
+  };
+}
+
+// Python callables that have been looked up by their fnName path, so that the
+// path doesn't have to be walked from pyodide.globals on every call. Running
+// arbitrary code can rebind any of these names, so runPyAsync() clears it.
+export class PyCallableCache {
+  private callables = new Map<string, any>();
+
+  constructor(private pyodide: Pyodide) {}
+
+  get(fnName: string[]): any {
+    const key = fnName.join(".");
+    let fn = this.callables.get(key);
+    if (fn === undefined) {
+      // fnName is something like ["os", "path", "join"]. Get the first
+      // element, then descend into it.
+      fn = this.pyodide.globals.get(fnName[0]);
+      for (const el of fnName.slice(1)) {
+        fn = fn[el];
+      }
+      this.callables.set(key, fn);
+    }
+    return fn;
+  }
+
+  clear(): void {
+    for (const fn of this.callables.values()) {
+      if (fn instanceof this.pyodide.ffi.PyProxy) {
+        fn.destroy();
+      }
+    }
+    this.callables.clear();
+  }
+}
+
+// Make a single call for callPyAsync() or callPyBatchAsync(), and process the
+// return value according to call.returnResult.
+export async function callPyFunction(
+  call: PyCall,
+  callables: PyCallableCache,
+  pyodide: Pyodide,
+  pyUtils: PyUtils,
+  stdoutCallback: (text: string) => void,
+): Promise<any> {
+  const {
+    fnName,
+    args = [],
+    kwargs = {},
+    returnResult = "none",
+    printResult = false,
+  } = call;
+  const fn = callables.get(fnName);
+
+  // If fn is an async function, this will return a Promise; if it is a normal
+  // function, it will reutrn a normal value.
+  const resultMaybePromise = fn.callKwargs(...args, kwargs);
+  // This will convert non-Promises to Promises, and then await them.
+  const result = await Promise.resolve(resultMaybePromise);
+
+  if (printResult && result !== undefined) {
+    stdoutCallback(pyUtils.repr(result));
+  }
+
+  try {
+    return processReturnValue(result, returnResult, pyodide, pyUtils.repr);
+  } finally {
+    if (result instanceof pyodide.ffi.PyProxy) {
+      result.destroy();
+    }
+  }
+}
+
 // Given the return value from a callPyAsync or runPyAsync, process the return
 // value according to the returnResult parameter.
 // https://stackoverflow.com/questions/72166620/typescript-conditional-return-type-using-an-object-parameter-and-default-values
@@ -591,7 +1047,7 @@ export function processReturnValue<K extends keyof ReturnMapping = "none">(
       // rather than a ToHtmlResult; `toJs()` below is what turns it into one.
       let toHtml: ((x: any) => PyProxy) | null = null;
       try {
-        toHtml = pyodide.globals.get("_to_html") as (x: any) => PyProxy;
+        toHtml = pyodide.globals.spec.get("_to_html") as (x: any) => PyProxy;
       } catch (e) {
         console.error("Couldn't find _to_html function: ", e);
       }
@@ -609,6 +1065,21 @@ export function processReturnValue<K extends keyof ReturnMapping = "none">(
         dict_converter: Object.fromEntries,
       }) as ToHtmlResult;
     },
+    get columnar() {
+      const toColumnar = pyodide.globals.spec.get("_to_columnar") as
+        | ((x: any) => PyProxyWithGet)
+        | undefined;
+      if (toColumnar === undefined) {
+        throw new Error("Couldn't find _to_columnar function.");
+      }
+
+      const spec = toColumnar(value);
+      try {
+        return columnarSpecToResult(spec, pyodide);
+      } finally {
+        spec.destroy();
+      }
+    },
     get none() {
       return undefined;
     },
@@ -616,3 +1087,88 @@ export function processReturnValue<K extends keyof ReturnMapping = "none">(
 
   return possibleReturnValues[returnResult];
 }
+
+// Convert the dict returned by the Python _to_columnar() function into a
+// ColumnarResult.
+function columnarSpecToResult(
+  spec: PyProxyWithGet,
+  pyodide: Pyodide,
+): ColumnarResult {
+  const type = spec.get("type") as ColumnarResult["type"];
+  if (type === "array" || type === "arrow") {
+    const data = spec.get("data") as PyBuffer;
+    let copy: ArrayBufferView;
+    try {
+      const buffer = data.getBuffer();
+      try {
+        // The buffer is a view of the wasm heap, which can't be transferred, so
+        // this copy is the one that can't be avoided.
+        copy = buffer.data.slice();
+      } finally {
+        buffer.release();
+      }
+    } finally {
+      data.destroy();
+    }
+
+    if (type === "arrow") {
+      return { type, data: copy as Uint8Array };
+    }
+    const shape = spec.get("shape") as PyProxy;
+    try {
+      return {
+        type,
+        dtype: spec.get("dtype") as string,
+        shape: shape.toJs() as number[],
+        data: copy,
+      };
+    } finally {
+      shape.destroy();
+    }
+  }
+
+  if (type === "table") {
+    const names = spec.get("names") as PyProxy;
+    const columns = spec.get("columns") as PyIterable;
+    try {
+      return {
+        type,
+        names: names.toJs() as string[],
+        columns: Array.from(columns, (column: PyProxyWithGet) => {
+          try {
+            return columnarSpecToResult(column, pyodide) as
+              | ColumnarArray
+              | ColumnarValue;
+          } finally {
+            column.destroy();
+          }
+        }),
+      };
+    } finally {
+      names.destroy();
+      columns.destroy();
+    }
+  }
+
+  const value = spec.get("value");
+  if (value instanceof pyodide.ffi.PyProxy) {
+    try {
+      return { type: "value", value: value.toJs() };
+    } finally {
+      value.destroy();
+    }
+  }
+  return { type: "value", value };
+}
+
+// Return the buffers of a ColumnarResult, for a postMessage() transfer list.
+// They were all copied out of the wasm heap for this result, so nothing else
+// refers to them.
+export function columnarTransferList(result: ColumnarResult): Transferable[] {
+  if (result.type === "array" || result.type === "arrow") {
+    return [result.data.buffer];
+  } else if (result.type === "table") {
+    return result.columns.flatMap((column) => columnarTransferList(column));
+  }
+  return [];
+}
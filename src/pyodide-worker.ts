@@ -1,18 +1,39 @@
 import type { ASGIHTTPRequestScope } from "./messageporthttp";
 import { makeRequest } from "./messageporthttp";
 import { openChannel } from "./messageportwebsocket-channel";
+import type { OutputChunk } from "./output-buffer";
+import { OutputBuffer } from "./output-buffer";
 import { errorToPostableErrorObject } from "./postable-error";
-import type { LoadPyodideConfig, PyUtils, ResultType } from "./pyodide-proxy";
-import { processReturnValue, setupPythonEnv } from "./pyodide-proxy";
+import type {
+  LoadPyodideConfig,
+  PyCall,
+  PyUtils,
+  ResultType,
+} from "./pyodide-proxy";
+import {
+  callPyFunction,
+  columnarTransferList,
+  PyCallableCache,
+  processReturnValue,
+  serveAppsPort,
+  setupPythonEnv,
+} from "./pyodide-proxy";
 import type { PyIterable } from "./pyodide/ffi";
 import { loadPyodide } from "./pyodide/pyodide";
+import type { RpcTiming } from "./rpc-metrics";
+import { now, RpcMetrics } from "./rpc-metrics";
+import type { TrafficRecorderCommand } from "./traffic-recorder";
+import { TrafficRecorder } from "./traffic-recorder";
 
 type Pyodide = Awaited<ReturnType<typeof loadPyodide>>;
 
-let pyodideStatus: "none" | "loading" | "loaded" = "none";
+// Resolves when Pyodide is loaded. Unset until the first init message, and
+// after a failed load, so that the next init starts over.
+let pyodideReady: Promise<void> | undefined;
 let pyodide: Pyodide;
 
-// This top-level Web Worker object (viewed from the inside).
+// This top-level Web Worker object (viewed from the inside). The same script is
+// also run as a SharedWorker; see the end of this file.
 interface PyodideWebWorkerInside
   extends Omit<DedicatedWorkerGlobalScope, "postMessage"> {
   postMessage(msg: NonReplyMessage): void;
@@ -21,12 +42,25 @@ interface PyodideWebWorkerInside
 }
 declare let self: PyodideWebWorkerInside;
 
+// A document that's using this worker. A dedicated worker has just the page
+// that started it; a SharedWorker has every tab and iframe that attached to it.
+interface Client {
+  port: { postMessage(msg: NonReplyMessage): void };
+  // Apps that this document has made requests to. They're stopped when it
+  // disconnects.
+  apps: Set<string>;
+}
+const clients = new Set<Client>();
+
 // =============================================================================
 // Input message types
 // =============================================================================
 interface InMessageInit {
   type: "init";
   config: LoadPyodideConfig;
+  // A one-byte SharedArrayBuffer view for pyodide.setInterruptBuffer(). Only
+  // sent when the page is cross-origin isolated.
+  interruptBuffer?: Uint8Array;
 }
 
 // Incoming message that contains Python code as text.
@@ -41,6 +75,8 @@ export interface InMessageRunPythonAsync {
   code: string;
   returnResult: ResultType;
   printResult: boolean;
+  // See runPythonOnce().
+  once?: boolean;
 }
 
 export interface InMessageTabComplete {
@@ -62,6 +98,14 @@ export interface InMessageCallPyAsync {
   printResult: boolean;
 }
 
+// Incoming message with a list of calls like the one above, to be made in
+// order. The reply has a result for each call, up to and including the first
+// one that raised an error.
+export interface InMessageCallPyBatchAsync {
+  type: "callPyBatchAsync";
+  calls: PyCall[];
+}
+
 export interface InMessageOpenChannel {
   type: "openChannel";
   path: string;
@@ -74,21 +118,62 @@ export interface InMessageMakeRequest {
   appName: string;
 }
 
+// Incoming message with a port from the service worker, for apps' HTTP
+// requests and websocket connections. See PyodideProxy.serveApps().
+export interface InMessageServeApps {
+  type: "serveApps";
+}
+
+// Asks for the timings that the worker has recorded, when metrics are enabled.
+// See rpc-metrics.ts.
+export interface InMessageGetMetrics {
+  type: "getMetrics";
+}
+
+// Controls the worker's recording of its apps' websocket frames, when metrics
+// are enabled. For "export", the reply has the recorded HAR entries. See
+// traffic-recorder.ts.
+export interface InMessageTrafficRecorder {
+  type: "trafficRecorder";
+  command: TrafficRecorderCommand;
+}
+
+// Sent by a document that's leaving a SharedWorker.
+export interface InMessageDisconnect {
+  type: "disconnect";
+}
+
 export type InMessage =
   | InMessageInit
   | InMessageLoadPackagesFromImports
   | InMessageRunPythonAsync
   | InMessageTabComplete
   | InMessageCallPyAsync
+  | InMessageCallPyBatchAsync
   | InMessageOpenChannel
-  | InMessageMakeRequest;
+  | InMessageMakeRequest
+  | InMessageServeApps
+  | InMessageGetMetrics
+  | InMessageTrafficRecorder
+  | InMessageDisconnect;
 
 // =============================================================================
+// Output is sent to the main thread in batches; see output-buffer.ts. The
+// options are replaced when the first init message arrives. There's no telling
+// which document a line of output is for, so every document gets all of it.
+let outputBuffer = new OutputBuffer(postOutput);
+
+function postOutput(chunks: OutputChunk[]) {
+  for (const client of clients) {
+    client.port.postMessage({ type: "nonreply", subtype: "output", chunks });
+  }
+}
+
 self.stdout_callback = function (s: string) {
-  self.postMessage({ type: "nonreply", subtype: "output", stdout: s });
+  outputBuffer.write("stdout", s);
 };
 self.stderr_callback = function (s: string) {
-  self.postMessage({ type: "nonreply", subtype: "output", stderr: s });
+  outputBuffer.write("stderr", s);
 };
 
 // =============================================================================
@@ -101,53 +186,97 @@ self.stderr_callback = function (s: string) {
 //   foo.bar("a", 2)
 // This function gets injected into the Python global namespace.
 async function callJS(fnName: PyIterable, args: PyIterable) {
-  self.postMessage({
-    type: "nonreply",
-    subtype: "callJS",
-    fnName: fnName.toJs() as string[],
-    args: args.toJs() as any[],
-  });
+  for (const client of clients) {
+    client.port.postMessage({
+      type: "nonreply",
+      subtype: "callJS",
+      fnName: fnName.toJs() as string[],
+      args: args.toJs() as any[],
+    });
+  }
 }
 
 let pyUtils: PyUtils;
+let callables: PyCallableCache;
+let interruptBuffer: Uint8Array | undefined;
+// Set when the first init message enables metrics.
+let metrics: RpcMetrics | undefined;
+let traffic: TrafficRecorder | undefined;
+
+// An interrupt that arrived while nothing was running is stale by the time the
+// next message comes in, and shouldn't stop the code that it runs. Code that's
+// stuck in a computation holds up the worker's event loop, so this doesn't run
+// before an interrupt that's meant for it takes effect.
+function clearStaleInterrupt(): void {
+  if (interruptBuffer) interruptBuffer[0] = 0;
+}
 
-self.onmessage = async function (e: MessageEvent): Promise<void> {
+async function handleMessage(e: MessageEvent, client: Client): Promise<void> {
   const msg = e.data as InMessage;
+  clearStaleInterrupt();
 
   if (msg.type === "openChannel") {
     const clientPort = e.ports[0];
-    await openChannel(msg.path, msg.appName, clientPort, pyodide);
+    const done = metrics?.begin(msg.type, msg);
+    try {
+      await openChannel(msg.path, msg.appName, clientPort, pyodide, traffic);
+    } finally {
+      done?.();
+    }
     return;
   } else if (msg.type === "makeRequest") {
     const clientPort = e.ports[0];
-    await makeRequest(msg.scope, msg.appName, clientPort, pyodide);
+    client.apps.add(msg.appName);
+    const done = metrics?.begin(msg.type, msg);
+    try {
+      await makeRequest(msg.scope, msg.appName, clientPort, pyodide);
+    } finally {
+      done?.();
+    }
+    return;
+  } else if (msg.type === "serveApps") {
+    serveAppsPort(e.ports[0], pyodide, {
+      onApp: (appName) => {
+        client.apps.add(appName);
+        clearStaleInterrupt();
+      },
+      metrics,
+      traffic,
+    });
+    return;
+  } else if (msg.type === "disconnect") {
+    await disconnect(client);
     return;
   }
 
-  const messagePort: ReplyMesssagePort = e.ports[0];
+  const replyPort: ReplyMesssagePort = e.ports[0];
+  const started = now();
+  // Anything printed while handling the message is sent before the reply, so
+  // that, for example, the terminal shows it before the next prompt.
+  const messagePort = {
+    postMessage(msg: ReplyMessage, transfer: Transferable[] = []) {
+      outputBuffer.flush();
+      if (metrics) {
+        msg.timing = { started, ended: now() };
+      }
+      replyPort.postMessage(msg, transfer);
+    },
+  };
+
   try {
     if (msg.type === "init") {
-      // Ensure we only try to load pyodide once.
-      if (pyodideStatus === "none") {
-        pyodideStatus = "loading";
-
-        try {
-          pyodide = await loadPyodide({
-            ...msg.config,
-            stdout: self.stdout_callback,
-            stderr: self.stderr_callback,
-          });
-
-          pyUtils = await setupPythonEnv(pyodide, callJS);
-
-          pyodideStatus = "loaded";
-        } catch (e) {
-          // Reset the status so that a subsequent init starts over. Otherwise
-          // it would take the "already loading/loaded" path and report success
-          // with a pyodide that was never initialized.
-          pyodideStatus = "none";
-          throw e;
-        }
+      // Ensure we only try to load pyodide once. Documents that attach to a
+      // SharedWorker while it's loading wait for the same load.
+      if (pyodideReady === undefined) {
+        pyodideReady = init(msg);
+      }
+      try {
+        await pyodideReady;
+      } catch (e) {
+        // Reset so that a subsequent init starts over. Otherwise it would
+        // report success with a pyodide that was never initialized.
+        pyodideReady = undefined;
+        throw e;
       }
 
       messagePort.postMessage({ type: "reply", subtype: "done" });
@@ -162,10 +291,20 @@ self.onmessage = async function (e: MessageEvent): Promise<void> {
       });
     }
     //
+    else if (msg.type === "runPythonAsync" && msg.once) {
+      await runPythonOnce(msg.code);
+      messagePort.postMessage({ type: "reply", subtype: "done" });
+    }
+    //
     else if (msg.type === "runPythonAsync") {
       await pyodide.loadPackagesFromImports(msg.code);
 
-      const result = await pyodide.runPythonAsync(msg.code);
+      let result: any;
+      try {
+        result = await pyodide.runPythonAsync(msg.code);
+      } finally {
+        callables.clear();
+      }
 
       if (msg.printResult && result !== undefined) {
         self.stdout_callback(pyUtils.repr(result));
@@ -179,11 +318,14 @@ self.onmessage = async function (e: MessageEvent): Promise<void> {
           pyUtils.repr,
         );
 
-        messagePort.postMessage({
-          type: "reply",
-          subtype: "done",
-          value: processedResult,
-        });
+        messagePort.postMessage(
+          {
+            type: "reply",
+            subtype: "done",
+            value: processedResult,
+          },
+          resultTransferList(msg.returnResult, processedResult),
+        );
       } finally {
         if (result instanceof pyodide.ffi.PyProxy) {
           result.destroy();
@@ -191,6 +333,31 @@ self.onmessage = async function (e: MessageEvent): Promise<void> {
       }
     }
     //
+    else if (msg.type === "getMetrics") {
+      messagePort.postMessage({
+        type: "reply",
+        subtype: "done",
+        value: metrics?.report(),
+      });
+    }
+    //
+    else if (msg.type === "trafficRecorder") {
+      if (traffic && msg.command === "start") {
+        traffic.recording = true;
+      } else if (traffic && msg.command === "stop") {
+        traffic.recording = false;
+      } else if (msg.command === "clear") {
+        traffic?.clear();
+      }
+      const entries =
+        msg.command === "export" && traffic ? traffic.toHar().log.entries : [];
+      messagePort.postMessage({
+        type: "reply",
+        subtype: "done",
+        value: entries,
+      });
+    }
+    //
     else if (msg.type === "tabComplete") {
       const completions: string[] = pyUtils.tabComplete(msg.code).toJs()[0];
       messagePort.postMessage({
@@ -201,42 +368,42 @@ self.onmessage = async function (e: MessageEvent): Promise<void> {
     }
     //
     else if (msg.type === "callPyAsync") {
-      const { fnName: fnName, args, kwargs } = msg;
-      // fnName is something like ["os", "path", "join"]. Get the first
-      // element with pyodide.globals.get(), then descend into it with [].
-      let fn = pyodide.globals.get(fnName[0]);
-      for (const el of fnName.slice(1)) {
-        fn = fn[el];
-      }
-
-      // If fn is an async function, this will return a Promise; if it is a normal
-      // function, it will reutrn a normal value.
-      const resultMaybePromise = fn.callKwargs(...args, kwargs);
-      // This will convert non-Promises to Promises, and then await them.
-      const result = await Promise.resolve(resultMaybePromise);
-
-      if (msg.printResult && result !== undefined) {
-        self.stdout_callback(pyUtils.repr(result));
-      }
-
-      try {
-        const processedResult = processReturnValue(
-          result,
-          msg.returnResult,
-          pyodide,
-          pyUtils.repr,
-        );
-
-        messagePort.postMessage({
-          type: "reply",
-          subtype: "done",
-          value: processedResult,
-        });
-      } finally {
-        if (result instanceof pyodide.ffi.PyProxy) {
-          result.destroy();
+      const value = await callPyFunction(
+        msg,
+        callables,
+        pyodide,
+        pyUtils,
+        self.stdout_callback,
+      );
+      messagePort.postMessage(
+        { type: "reply", subtype: "done", value },
+        resultTransferList(msg.returnResult, value),
+      );
+    }
+    //
+    else if (msg.type === "callPyBatchAsync") {
+      const results: ReplyMessageBatchDone["results"] = [];
+      const transfer: Transferable[] = [];
+      for (const call of msg.calls) {
+        try {
+          const value = await callPyFunction(
+            call,
+            callables,
+            pyodide,
+            pyUtils,
+            self.stdout_callback,
+          );
+          results.push({ value });
+          transfer.push(...resultTransferList(call.returnResult, value));
+        } catch (e) {
+          results.push({ error: postableCallError(e) });
+          break;
         }
       }
+      messagePort.postMessage(
+        { type: "reply", subtype: "batchDone", results },
+        transfer,
+      );
     }
     //
     else {
@@ -247,32 +414,119 @@ self.onmessage = async function (e: MessageEvent): Promise<void> {
       });
     }
   } catch (e) {
-    // pyUtils can still be undefined here if init failed before
-    // setupPythonEnv() returned.
-    if (
-      typeof pyodide !== "undefined" &&
-      typeof pyUtils !== "undefined" &&
-      e instanceof pyodide.ffi.PythonError
-    ) {
-      e.message = pyUtils.shortFormatLastTraceback();
-    }
-
     messagePort.postMessage({
       type: "reply",
       subtype: "done",
-      error: errorToPostableErrorObject(e),
+      error: postableCallError(e),
     });
   }
-};
+}
+
+async function init(msg: InMessageInit): Promise<void> {
+  const { output, metrics: metricsEnabled, ...config } = msg.config;
+  outputBuffer.flush();
+  outputBuffer = new OutputBuffer(postOutput, output);
+  if (metricsEnabled) {
+    metrics = new RpcMetrics();
+    // Off until it's started, along with the service worker's recorder.
+    traffic = new TrafficRecorder();
+  }
+
+  pyodide = await loadPyodide({
+    ...config,
+    stdout: self.stdout_callback,
+    stderr: self.stderr_callback,
+  });
+
+  pyUtils = await setupPythonEnv(pyodide, callJS);
+  callables = new PyCallableCache(pyodide);
+
+  if (msg.interruptBuffer) {
+    interruptBuffer = msg.interruptBuffer;
+    pyodide.setInterruptBuffer(interruptBuffer);
+  }
+}
+
+// Code that's sent with `once` is run the first time only; after that, the
+// reply waits for the first run to finish. Every document that attaches to a
+// SharedWorker sends the code that sets up the Python environment, and running
+// it again would throw away the state of the apps that are already running.
+const onceRuns = new Map<string, Promise<void>>();
+
+function runPythonOnce(code: string): Promise<void> {
+  let run = onceRuns.get(code);
+  if (run === undefined) {
+    run = (async () => {
+      await pyodide.loadPackagesFromImports(code);
+      try {
+        const result = await pyodide.runPythonAsync(code);
+        if (result instanceof pyodide.ffi.PyProxy) {
+          result.destroy();
+        }
+      } finally {
+        callables.clear();
+      }
+    })();
+    onceRuns.set(code, run);
+    // If it failed, the next document to send it can try again.
+    run.catch(() => onceRuns.delete(code));
+  }
+  return run;
+}
+
+// Stop the apps of a document that has left, unless another document is also
+// using them.
+async function disconnect(client: Client): Promise<void> {
+  clients.delete(client);
+  if (typeof pyodide === "undefined" || typeof callables === "undefined") {
+    return;
+  }
+
+  for (const appName of client.apps) {
+    if (Array.from(clients).some((other) => other.apps.has(appName))) {
+      continue;
+    }
+    try {
+      await callables.get(["_stop_app"])(appName);
+    } catch (e) {
+      console.error(`Could not stop ${appName}:`, e);
+    }
+  }
+}
+
+// Results which hold buffers that were created just for the reply can be sent
+// without copying them again.
+function resultTransferList(
+  returnResult: ResultType | undefined,
+  value: any,
+): Transferable[] {
+  return returnResult === "columnar" ? columnarTransferList(value) : [];
+}
+
+function postableCallError(e: unknown) {
+  // pyUtils can still be undefined here if init failed before
+  // setupPythonEnv() returned.
+  if (
+    typeof pyodide !== "undefined" &&
+    typeof pyUtils !== "undefined" &&
+    e instanceof pyodide.ffi.PythonError
+  ) {
+    e.message = pyUtils.shortFormatLastTraceback();
+  }
+  return errorToPostableErrorObject(e);
+}
 
 interface ReplyMesssagePort extends Omit<MessagePort, "postMessage"> {
-  postMessage(msg: ReplyMessage): void;
+  postMessage(msg: ReplyMessage, transfer?: Transferable[]): void;
 }
 
 // A ReplyMessage is one that's sent back to the main thread in response to an
 // InMessage. When the main thread receives the ReplyMessage, it knows that
 // whatever task it requested (by sending the InMessage) has finished.
-export type ReplyMessage = ReplyMessageDone | ReplyMessageTabCompletions;
+export type ReplyMessage =
+  | ReplyMessageDone
+  | ReplyMessageBatchDone
+  | ReplyMessageTabCompletions;
 
 // A message sent to the main thread which indicates that the worker has
 // finished its work. It may also contain a value and/or an error message.
@@ -281,6 +535,17 @@ export interface ReplyMessageDone {
   subtype: "done";
   value?: any;
   error?: any;
+  timing?: RpcTiming;
+}
+
+// The reply to an InMessageCallPyBatchAsync, with a result for each call that
+// was made.
+export interface ReplyMessageBatchDone {
+  type: "reply";
+  subtype: "batchDone";
+  results: Array<{ value?: any; error?: any }>;
+  error?: any;
+  timing?: RpcTiming;
 }
 
 export interface ReplyMessageTabCompletions {
@@ -288,6 +553,7 @@ export interface ReplyMessageTabCompletions {
   subtype: "tabCompletions";
   completions: string[];
   error?: any;
+  timing?: RpcTiming;
 }
 
 // A NonReplyMessage is one that's sent to the main thread, but not (directly)
@@ -299,8 +565,7 @@ export type NonReplyMessage = NonReplyMessageOutput | NonReplyMessageCallJS;
 export interface NonReplyMessageOutput {
   type: "nonreply";
   subtype: "output";
-  stdout?: string;
-  stderr?: string;
+  chunks: OutputChunk[];
 }
 
 export interface NonReplyMessageCallJS {
@@ -309,3 +574,20 @@ export interface NonReplyMessageCallJS {
   fnName: string[];
   args: any[];
 }
+
+// =============================================================================
+// Connecting to documents
+// =============================================================================
+if ("onconnect" in self) {
+  // Running as a SharedWorker: each document that attaches gets its own port.
+  (self as unknown as SharedWorkerGlobalScope).onconnect = (e) => {
+    const port = e.ports[0];
+    const client: Client = { port, apps: new Set() };
+    clients.add(client);
+    port.onmessage = (e) => handleMessage(e, client);
+  };
+} else {
+  const client: Client = { port: self, apps: new Set() };
+  clients.add(client);
+  self.onmessage = (e) => handleMessage(e, client);
+}
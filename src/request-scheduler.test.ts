@@ -0,0 +1,73 @@
+import { requestPriority, RequestScheduler } from "./request-scheduler";
+
+describe("requestPriority()", () => {
+  test("puts documents first and other requests last", () => {
+    expect(requestPriority("iframe")).toBe(0);
+    expect(requestPriority("script")).toBe(1);
+    expect(requestPriority("style")).toBe(1);
+    expect(requestPriority("font")).toBe(2);
+    expect(requestPriority("image")).toBe(2);
+    expect(requestPriority("")).toBe(3);
+  });
+});
+
+// Let any requests that were let in run their callbacks.
+function flush(): Promise<void> {
+  return new Promise((resolve) => setTimeout(resolve, 0));
+}
+
+describe("RequestScheduler", () => {
+  test("lets `maxConcurrent` requests in at once", async () => {
+    const scheduler = new RequestScheduler(2);
+    const started: number[] = [];
+    const releases: Array<() => void> = [];
+    for (let i = 0; i < 3; i++) {
+      // eslint-disable-next-line @typescript-eslint/no-floating-promises
+      scheduler.acquire(0).then((release) => {
+        started.push(i);
+        releases.push(release);
+      });
+    }
+    await flush();
+    expect(started).toEqual([0, 1]);
+    expect(scheduler.stats()).toMatchObject({
+      running: 2,
+      queued: [1, 0, 0, 0],
+    });
+
+    releases[0]();
+    // Releasing twice doesn't free up a second place.
+    releases[0]();
+    await flush();
+    expect(started).toEqual([0, 1, 2]);
+    expect(scheduler.stats()).toMatchObject({ running: 2, completed: 1 });
+  });
+
+  test("lets waiting requests in by priority", async () => {
+    const scheduler = new RequestScheduler(1);
+    const release = await scheduler.acquire(0);
+
+    const started: string[] = [];
+    const wait = (name: string, priority: 0 | 1 | 2 | 3) =>
+      scheduler.acquire(priority).then((release) => {
+        started.push(name);
+        release();
+      });
+    const done = Promise.all([
+      wait("download", 3),
+      wait("font", 2),
+      wait("script", 1),
+      wait("document", 0),
+    ]);
+    expect(scheduler.stats().maxQueued).toBe(4);
+
+    release();
+    await done;
+    expect(started).toEqual(["document", "script", "font", "download"]);
+    expect(scheduler.stats()).toMatchObject({
+      running: 0,
+      queued: [0, 0, 0, 0],
+      completed: 5,
+    });
+  });
+});
@@ -0,0 +1,120 @@
+// Scheduling of requests from apps' pages into their engine.
+//
+// Loading an app's page fans out into dozens of requests at once, for its
+// scripts, stylesheets, fonts and images. The engine runs Python on one thread,
+// so when they all go in together they just take turns, and the requests that
+// the page is actually waiting on -- the HTML, and the scripts that open the
+// websocket -- end up behind the fonts. Instead, the service worker keeps a
+// queue for each engine, and lets only a few requests into the engine at a
+// time, the most important first. A request counts until its response starts;
+// its body is streamed at the pace of whatever reads it, so it doesn't count
+// after that.
+
+import type { Percentiles } from "./rpc-metrics";
+import { percentiles, RingBuffer } from "./rpc-metrics";
+
+// Lower numbers go first: documents, then scripts and stylesheets, then fonts
+// and images, then everything else (fetch() and XHR from the page, and
+// downloads).
+export type RequestPriority = 0 | 1 | 2 | 3;
+
+const numPriorities = 4;
+
+// The priority for a request, from its Request.destination.
+export function requestPriority(destination: string): RequestPriority {
+  switch (destination) {
+    case "document":
+    case "iframe":
+    case "frame":
+      return 0;
+    case "script":
+    case "style":
+    case "worker":
+    case "sharedworker":
+    case "manifest":
+      return 1;
+    case "font":
+    case "image":
+    case "audio":
+    case "video":
+    case "track":
+      return 2;
+    default:
+      return 3;
+  }
+}
+
+export type SchedulerStats = {
+  // Requests in the engine now.
+  running: number;
+  // Requests waiting to go in, by priority.
+  queued: number[];
+  // The most that have been waiting at once.
+  maxQueued: number;
+  completed: number;
+  // How long requests waited before going into the engine.
+  waitMs: Percentiles;
+};
+
+export class RequestScheduler {
+  private running = 0;
+  private queues: Array<Array<() => void>> = Array.from(
+    { length: numPriorities },
+    () => [],
+  );
+  private maxQueued = 0;
+  private completed = 0;
+  private waits = new RingBuffer<number>(1000);
+
+  constructor(readonly maxConcurrent: number) {}
+
+  // Resolves when a request may go into the engine, with a function to call
+  // when its response has started.
+  async acquire(priority: RequestPriority): Promise<() => void> {
+    const queuedAt = performance.now();
+    if (this.running < Math.max(1, this.maxConcurrent)) {
+      this.running++;
+    } else {
+      // The request that finishes next hands its place straight to this one,
+      // so `running` doesn't change.
+      await new Promise<void>((resolve) => {
+        this.queues[priority].push(resolve);
+        this.maxQueued = Math.max(this.maxQueued, this.queuedCount());
+      });
+    }
+    this.waits.push(performance.now() - queuedAt);
+
+    let released = false;
+    return () => {
+      if (released) return;
+      released = true;
+      this.completed++;
+      this.release();
+    };
+  }
+
+  stats(): SchedulerStats {
+    return {
+      running: this.running,
+      queued: this.queues.map((queue) => queue.length),
+      maxQueued: this.maxQueued,
+      completed: this.completed,
+      waitMs: percentiles(this.waits.toArray()),
+    };
+  }
+
+  private release(): void {
+    for (const queue of this.queues) {
+      const next = queue.shift();
+      if (next) {
+        next();
+        return;
+      }
+    }
+    this.running--;
+  }
+
+  private queuedCount(): number {
+    return this.queues.reduce((n, queue) => n + queue.length, 0);
+  }
+}
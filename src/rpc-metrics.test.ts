@@ -0,0 +1,146 @@
+import {
+  estimateSize,
+  formatStats,
+  mergeReports,
+  RingBuffer,
+  RpcMetrics,
+} from "./rpc-metrics";
+
+describe("RingBuffer", () => {
+  test("keeps the newest items, oldest first", () => {
+    const buffer = new RingBuffer<number>(3);
+    buffer.push(1);
+    buffer.push(2);
+    expect(buffer.toArray()).toEqual([1, 2]);
+
+    expect(buffer.push(3)).toBeUndefined();
+    expect(buffer.push(4)).toBe(1);
+    expect(buffer.push(5)).toBe(2);
+    expect(buffer.toArray()).toEqual([3, 4, 5]);
+  });
+});
+
+describe("estimateSize()", () => {
+  test("counts strings, binary data and nested values", () => {
+    expect(estimateSize("abc")).toBe(3);
+    expect(estimateSize(new Uint8Array(10))).toBe(10);
+    expect(estimateSize(new ArrayBuffer(4))).toBe(4);
+    expect(
+      estimateSize({ code: "x = 1", args: [1, true], body: new Uint8Array(2) }),
+    ).toBe(5 + 8 + 8 + 2);
+  });
+
+  test("ignores values without a size", () => {
+    expect(estimateSize(undefined)).toBe(0);
+    expect(estimateSize(null)).toBe(0);
+  });
+});
+
+describe("RpcMetrics", () => {
+  let time: number;
+
+  beforeEach(() => {
+    time = 0;
+    jest.spyOn(performance, "now").mockImplementation(() => time);
+  });
+
+  afterEach(() => {
+    jest.restoreAllMocks();
+  });
+
+  test("times sent messages with the worker's timing", () => {
+    const metrics = new RpcMetrics();
+    const origin = performance.timeOrigin;
+
+    const done = metrics.begin("callPyAsync", { code: "abcd" }, { sent: true });
+    expect(metrics.report().stats.callPyAsync.inFlight).toBe(1);
+
+    time = 10;
+    done({ value: "xy" }, { started: origin + 2, ended: origin + 7 });
+
+    const { records, stats } = metrics.report();
+    expect(records).toEqual([
+      {
+        type: "callPyAsync",
+        enqueued: origin,
+        started: origin + 2,
+        ended: origin + 7,
+        replied: origin + 10,
+        requestBytes: 4,
+        replyBytes: 2,
+      },
+    ]);
+    expect(stats.callPyAsync).toMatchObject({
+      count: 1,
+      inFlight: 0,
+      queueMs: { p50: 2, p95: 2, max: 2 },
+      execMs: { p50: 5, p95: 5, max: 5 },
+      replyMs: { p50: 3, p95: 3, max: 3 },
+    });
+  });
+
+  test("times messages that are handled where they're received", () => {
+    const metrics = new RpcMetrics();
+    const done = metrics.begin("makeRequest", {});
+    time = 4;
+    done();
+
+    const stats = metrics.report().stats.makeRequest;
+    expect(stats.execMs.p50).toBe(4);
+    expect(stats.queueMs).toEqual({ p50: 0, p95: 0, max: 0 });
+  });
+
+  test("only keeps as many records as its capacity", () => {
+    const metrics = new RpcMetrics(2);
+    for (let i = 0; i < 5; i++) {
+      metrics.begin("tabComplete", {})();
+    }
+    expect(metrics.report().records).toHaveLength(2);
+  });
+
+  test("removes records from the timeline when they're dropped", () => {
+    const { measure, clearMeasures } = performance;
+    const timeline = new Set<string>();
+    Object.assign(performance, {
+      measure: (name: string) => timeline.add(name),
+      clearMeasures: (name: string) => timeline.delete(name),
+    });
+    try {
+      const metrics = new RpcMetrics(2);
+      for (let i = 0; i < 5; i++) {
+        metrics.begin("tabComplete", {})();
+      }
+      expect(Array.from(timeline)).toEqual([
+        "shinylive:tabComplete:3",
+        "shinylive:tabComplete:4",
+      ]);
+    } finally {
+      Object.assign(performance, { measure, clearMeasures });
+    }
+  });
+
+  test("reports from two threads can be merged", () => {
+    const main = new RpcMetrics();
+    const worker = new RpcMetrics();
+    main.begin("runPythonAsync", {}, { sent: true })();
+    worker.begin("makeRequest", {})();
+
+    const merged = mergeReports(main.report(), worker.report());
+    expect(Object.keys(merged.stats).sort()).toEqual([
+      "makeRequest",
+      "runPythonAsync",
+    ]);
+    expect(merged.records).toHaveLength(2);
+  });
+});
+
+describe("formatStats()", () => {
+  test("lays out one row per message type", () => {
+    const metrics = new RpcMetrics();
+    metrics.begin("callPyAsync", {})();
+    const lines = formatStats(metrics.report().stats).split("\n");
+    expect(lines).toHaveLength(2);
+    expect(lines[0]).toMatch(/^type\s+count\s+in flight/);
+    expect(lines[1]).toMatch(/^callPyAsync\s+1\s+0/);
+  });
+});
@@ -0,0 +1,250 @@
+// Timings for the messages between the main thread and the Pyodide worker.
+//
+// This is off unless the page is loaded with ?metrics=1. Then each message is
+// recorded with when it was sent, when the worker started and finished
+// handling it, and when the reply arrived, along with rough payload sizes. The
+// records are kept in a ring buffer, so memory use is bounded however long the
+// page is open, and each one is also added to the performance timeline, where
+// it shows up in DevTools traces, until it falls out of the ring buffer. See
+// PyodideProxy.metrics().
+
+// Times are in milliseconds since the Unix epoch (performance.timeOrigin +
+// performance.now()), so that times from the worker and the main thread can be
+// compared.
+export type RpcRecord = {
+  type: string;
+  // When the message was sent. Not set for messages from the service worker,
+  // which are only timed in the worker.
+  enqueued?: number;
+  started?: number;
+  ended?: number;
+  replied?: number;
+  requestBytes: number;
+  replyBytes: number;
+};
+
+// When the worker started and finished handling a message. Sent in replies.
+export type RpcTiming = { started: number; ended: number };
+
+export type RpcStats = {
+  count: number;
+  inFlight: number;
+  // Time from being sent to being started, including the trip to the worker.
+  queueMs: Percentiles;
+  // Time the worker spent handling the message.
+  execMs: Percentiles;
+  // Time from the worker finishing to the reply arriving.
+  replyMs: Percentiles;
+  requestBytes: number;
+  replyBytes: number;
+};
+
+export type Percentiles = { p50: number; p95: number; max: number };
+
+export type RpcMetricsReport = {
+  records: RpcRecord[];
+  stats: Record<string, RpcStats>;
+};
+
+export function now(): number {
+  return performance.timeOrigin + performance.now();
+}
+
+export class RingBuffer<T> {
+  private items: T[] = [];
+  private next = 0;
+
+  constructor(readonly capacity: number) {}
+
+  // Add an item. Returns the item it replaced, if the buffer was full.
+  push(item: T): T | undefined {
+    let dropped: T | undefined;
+    if (this.items.length < this.capacity) {
+      this.items.push(item);
+    } else {
+      dropped = this.items[this.next];
+      this.items[this.next] = item;
+    }
+    this.next = (this.next + 1) % this.capacity;
+    return dropped;
+  }
+
+  // The items, oldest first.
+  toArray(): T[] {
+    if (this.items.length < this.capacity) return this.items.slice();
+    return this.items.slice(this.next).concat(this.items.slice(0, this.next));
+  }
+}
+
+export class RpcMetrics {
+  private records: RingBuffer<RpcRecord>;
+  // The names of the records' entries on the performance timeline, in step
+  // with `records`, so that each entry is removed along with its record.
+  private measures: RingBuffer<string | undefined>;
+  private measureCount = 0;
+  private inFlight = new Map<string, number>();
+
+  constructor(capacity = 1000) {
+    this.records = new RingBuffer(capacity);
+    this.measures = new RingBuffer(capacity);
+  }
+
+  // Start timing a message. Call the returned function when it's finished.
+  begin(
+    type: string,
+    request: unknown,
+    { sent = false }: { sent?: boolean } = {},
+  ): (reply?: unknown, timing?: RpcTiming) => void {
+    const record: RpcRecord = {
+      type,
+      requestBytes: estimateSize(request),
+      replyBytes: 0,
+    };
+    if (sent) {
+      record.enqueued = now();
+    } else {
+      record.started = now();
+    }
+    this.inFlight.set(type, (this.inFlight.get(type) ?? 0) + 1);
+
+    return (reply?: unknown, timing?: RpcTiming) => {
+      if (sent) {
+        record.replied = now();
+        record.started = timing?.started;
+        record.ended = timing?.ended;
+      } else {
+        record.ended = now();
+      }
+      record.replyBytes = estimateSize(reply);
+      this.inFlight.set(type, this.inFlight.get(type)! - 1);
+      this.records.push(record);
+      const name = `shinylive:${type}:${this.measureCount++}`;
+      const dropped = this.measures.push(
+        addToTimeline(name, record) ? name : undefined,
+      );
+      if (dropped !== undefined) performance.clearMeasures(dropped);
+    };
+  }
+
+  report(): RpcMetricsReport {
+    const records = this.records.toArray();
+    const byType = new Map<string, RpcRecord[]>();
+    for (const record of records) {
+      const group = byType.get(record.type) ?? [];
+      group.push(record);
+      byType.set(record.type, group);
+    }
+    for (const type of this.inFlight.keys()) {
+      if (!byType.has(type)) byType.set(type, []);
+    }
+
+    const stats: Record<string, RpcStats> = {};
+    for (const [type, group] of byType) {
+      stats[type] = {
+        count: group.length,
+        inFlight: this.inFlight.get(type) ?? 0,
+        queueMs: percentiles(group.map((r) => span(r.enqueued, r.started))),
+        execMs: percentiles(group.map((r) => span(r.started, r.ended))),
+        replyMs: percentiles(group.map((r) => span(r.ended, r.replied))),
+        requestBytes: sum(group.map((r) => r.requestBytes)),
+        replyBytes: sum(group.map((r) => r.replyBytes)),
+      };
+    }
+    return { records, stats };
+  }
+}
+
+// Combine reports from the main thread and the worker.
+export function mergeReports(
+  a: RpcMetricsReport,
+  b: RpcMetricsReport,
+): RpcMetricsReport {
+  return {
+    records: [...a.records, ...b.records].sort(
+      (x, y) => (x.enqueued ?? x.started ?? 0) - (y.enqueued ?? y.started ?? 0),
+    ),
+    stats: { ...a.stats, ...b.stats },
+  };
+}
+
+// A rough count of the bytes in a message: strings count their length and
+// binary data its byteLength, without serializing anything.
+export function estimateSize(x: unknown, depth = 0): number {
+  if (typeof x === "string") return x.length;
+  if (typeof x === "number" || typeof x === "boolean") return 8;
+  if (x === null || typeof x !== "object" || depth > 8) return 0;
+  if (x instanceof ArrayBuffer) return x.byteLength;
+  if (ArrayBuffer.isView(x)) return x.byteLength;
+
+  let size = 0;
+  for (const value of Object.values(x)) {
+    size += estimateSize(value, depth + 1);
+  }
+  return size;
+}
+
+// A table of the stats, for printing in the terminal.
+export function formatStats(stats: Record<string, RpcStats>): string {
+  const header = [
+    "type",
+    "count",
+    "in flight",
+    "queue p50/p95",
+    "exec p50/p95",
+    "reply p50/p95",
+    "bytes in/out",
+  ];
+  const ms = (p: Percentiles) => `${p.p50.toFixed(1)}/${p.p95.toFixed(1)}`;
+  const rows = Object.entries(stats).map(([type, s]) => [
+    type,
+    String(s.count),
+    String(s.inFlight),
+    ms(s.queueMs),
+    ms(s.execMs),
+    ms(s.replyMs),
+    `${s.requestBytes}/${s.replyBytes}`,
+  ]);
+
+  const widths = header.map((h, i) =>
+    Math.max(h.length, ...rows.map((row) => row[i].length)),
+  );
+  return [header, ...rows]
+    .map((row) => row.map((cell, i) => cell.padEnd(widths[i])).join("  "))
+    .join("\n");
+}
+
+function span(from?: number, to?: number): number | undefined {
+  return from === undefined || to === undefined ? undefined : to - from;
+}
+
+export function percentiles(values: Array<number | undefined>): Percentiles {
+  const sorted = values
+    .filter((x): x is number => x !== undefined)
+    .sort((a, b) => a - b);
+  if (sorted.length === 0) return { p50: 0, p95: 0, max: 0 };
+  const at = (q: number) =>
+    sorted[Math.min(sorted.length - 1, Math.floor(q * sorted.length))];
+  return { p50: at(0.5), p95: at(0.95), max: sorted[sorted.length - 1] };
+}
+
+function sum(values: number[]): number {
+  return values.reduce((a, b) => a + b, 0);
+}
+
+// Returns whether the record was added.
+function addToTimeline(name: string, record: RpcRecord): boolean {
+  const start = record.enqueued ?? record.started;
+  const end = record.replied ?? record.ended;
+  if (start === undefined || end === undefined) return false;
+  try {
+    performance.measure(name, {
+      start: start - performance.timeOrigin,
+      end: end - performance.timeOrigin,
+      detail: record,
+    });
+    return true;
+  } catch {
+    // Older browsers don't take the options argument.
+    return false;
+  }
+}
@@ -17,18 +17,24 @@ export {};
 // to communicate to the Python backend.
 (window as any).Shiny.createSocket = function () {
   const channel = new MessageChannel();
-  window.parent.postMessage(
-    {
-      type: "openChannel",
-      // Infer app name from path: "/foo/app_abc123/"" => "app_abc123"
-      appName: window.location.pathname.replace(
-        new RegExp(".*/([^/]+)/$"),
-        "$1"
-      ),
-      path: "/websocket/",
-    },
-    "*",
-    [channel.port2]
-  );
+  const msg = {
+    type: "openChannel",
+    // Infer app name from path: "/foo/app_abc123/"" => "app_abc123"
+    appName: window.location.pathname.replace(
+      new RegExp(".*/([^/]+)/$"),
+      "$1"
+    ),
+    path: "/websocket/",
+  };
+
+  // The service worker passes the connection straight to the app's engine. If
+  // this page isn't controlled by it for some reason, go through the parent
+  // window instead.
+  const controller = navigator.serviceWorker?.controller;
+  if (controller) {
+    controller.postMessage(msg, [channel.port2]);
+  } else {
+    window.parent.postMessage(msg, "*", [channel.port2]);
+  }
   return new MessagePortWebSocket(channel.port1);
 };
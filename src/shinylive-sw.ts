@@ -2,20 +2,84 @@
 /// <reference lib="WebWorker" />
 // Load the content of shinylive-inject-socket.js as a string.
 import shinylive_inject_socket_js from "./assets/shinylive-inject-socket.txt";
+import { injectBeforeHeadEnd } from "./inject-head";
 import { fetchASGI } from "./messageporthttp";
-import { dirname, sleep, uint8ArrayToString } from "./utils";
-
-// When doing development, it's best to disable caching so that you don't have
-// to keep manually clearing the browser's application cache.
-const useCaching = false;
+import type { SchedulerStats } from "./request-scheduler";
+import { requestPriority, RequestScheduler } from "./request-scheduler";
+import { now } from "./rpc-metrics";
+import {
+  fromStoredPartial,
+  headResponse,
+  rangeCacheKey,
+  rangeResponse,
+  toStoredPartial,
+} from "./sw-range";
+import { recordResponse, TrafficRecorder } from "./traffic-recorder";
+import { dirname } from "./utils";
 
 // Export empty type because of isolatedModules flag.
 export type {};
 declare const self: ServiceWorkerGlobalScope;
 
+declare const SHINYLIVE_VERSION: string;
+
 const cacheName = "::shinyliveServiceworker";
 const version = "v10";
 
+// The files to download and cache when the service worker is installed, with
+// their SRI hashes (see precacheManifest() in scripts/build.ts). The list is
+// empty in development builds, which turns caching off: when doing
+// development, it's best to disable caching so that you don't have to keep
+// manually clearing the browser's application cache.
+declare const SHINYLIVE_PRECACHE_MANIFEST: {
+  version: string;
+  entries: { url: string; integrity: string; core: boolean }[];
+};
+const useCaching = SHINYLIVE_PRECACHE_MANIFEST.entries.length > 0;
+
+// Both caches belong to one build. The runtime cache holds files that weren't
+// precached, like Pyodide packages that are loaded on demand, and HTML pages.
+const precacheName =
+  version + cacheName + "::precache::" + SHINYLIVE_PRECACHE_MANIFEST.version;
+const runtimeCacheName =
+  version + cacheName + "::runtime::" + SHINYLIVE_PRECACHE_MANIFEST.version;
+
+// The SRI hash of each precached file, by URL.
+const precacheIntegrity = new Map(
+  SHINYLIVE_PRECACHE_MANIFEST.entries.map(({ url, integrity }) => [
+    new URL(url, self.location.href).href,
+    integrity,
+  ]),
+);
+// The core files (shinylive's and Pyodide's own) are downloaded before the
+// service worker is installed. The packages are downloaded in the background
+// once it's active, so that a first visit doesn't wait for all of them before
+// an app can start.
+const corePrecacheUrls = SHINYLIVE_PRECACHE_MANIFEST.entries
+  .filter((entry) => entry.core)
+  .map((entry) => new URL(entry.url, self.location.href).href);
+const backgroundPrecacheUrls = SHINYLIVE_PRECACHE_MANIFEST.entries
+  .filter((entry) => !entry.core)
+  .map((entry) => new URL(entry.url, self.location.href).href);
+// Precached responses are stored with their hash in this header, so that files
+// that didn't change can be carried over from one build's cache to the next.
+const integrityHeader = "X-Shinylive-Integrity";
+
+// The static dependencies that shiny and htmltools serve at
+// lib/<name>-<version>/ (Bootstrap, shiny.js, fonts, and so on) are the same
+// for every app and every session, so they're cached here, rather than asking
+// the app for them each time. Only the files in the manifest that's extracted
+// from the wheels at build time are cached: an app's own dependencies can
+// change as it's edited, and two apps can have different dependencies with the
+// same name. The key is set at build time from the shiny and htmltools wheels,
+// so that shipping new wheels starts a new cache.
+declare const SHINYLIVE_APP_DEPENDENCIES_KEY: string;
+const cacheAppDependencies = true;
+const appDependenciesCacheName =
+  version + cacheName + "::appDependencies::" + SHINYLIVE_APP_DEPENDENCIES_KEY;
+// Paths that might be in the manifest, which is only loaded for these.
+const appDependencyPathRegex = /^\/lib\/[^/]+-\d[^/]*\/./;
+
 // Modify a response so that the required CORP/COOP/COEP headers are in place
 // for cross-origin isolation. Required when using `browser()` or CURL in webR.
 function addCoiHeaders(resp: Response): Response {
@@ -45,22 +109,97 @@ function addCorpHeader(resp: Response): Response {
 
 self.addEventListener("install", (event) => {
   event.waitUntil(
-    Promise.all([self.skipWaiting(), caches.open(version + cacheName)]),
+    Promise.all([
+      self.skipWaiting(),
+      caches.open(runtimeCacheName),
+      useCaching ? precache(corePrecacheUrls) : undefined,
+    ]),
   );
 });
 
+// Download files in the precache manifest. Files that haven't changed since an
+// earlier build are copied from its cache instead, and files that are already
+// cached are skipped, so this can be run again to finish an earlier run. A file
+// that can't be downloaded doesn't fail the install, because apps need the
+// service worker even if it can't cache anything; the file is fetched when it's
+// needed.
+async function precache(urls: string[]): Promise<void> {
+  const cache = await caches.open(precacheName);
+  const earlier = await Promise.all(
+    (await caches.keys())
+      .filter((key) => key.includes("::precache::") && key !== precacheName)
+      .map((key) => caches.open(key)),
+  );
+
+  await Promise.all(
+    urls.map(async (url) => {
+      const integrity = precacheIntegrity.get(url)!;
+      if (await cache.match(url)) return;
+
+      for (const earlierCache of earlier) {
+        const resp = await earlierCache.match(url);
+        if (resp?.headers.get(integrityHeader) === integrity) {
+          await cache.put(url, resp);
+          return;
+        }
+      }
+
+      try {
+        const resp = await fetch(
+          new Request(url, { integrity, cache: "no-cache" }),
+        );
+        if (!resp.ok) return;
+        const headers = new Headers(resp.headers);
+        headers.set(integrityHeader, integrity);
+        await cache.put(
+          url,
+          new Response(resp.body, {
+            status: resp.status,
+            statusText: resp.statusText,
+            headers,
+          }),
+        );
+      } catch (e) {
+        console.warn(`Couldn't precache ${url}:`, e);
+      }
+    }),
+  );
+}
+
+// Download the packages in the precache, once per run of the service worker.
+// This isn't waited for: fetch events wait until activation is done, and the
+// packages aren't needed for that. If the browser stops the service worker
+// before it's done, it's picked up again the next time the worker starts and
+// hears from a page.
+let backgroundPrecacheStarted = false;
+
+function startBackgroundPrecache(): void {
+  if (!useCaching || backgroundPrecacheStarted) return;
+  backgroundPrecacheStarted = true;
+  precache(backgroundPrecacheUrls).catch((e) => {
+    console.warn("Couldn't precache packages:", e);
+  });
+}
+
 self.addEventListener("activate", function (event) {
+  startBackgroundPrecache();
   event.waitUntil(
     (async () => {
       await self.clients.claim();
 
       const keys = await caches.keys();
 
-      // Remove caches whose name is no longer valid
+      // Remove our caches from other versions and builds, including app
+      // dependencies from other versions of the shiny and htmltools wheels.
+      const current = [
+        precacheName,
+        runtimeCacheName,
+        appDependenciesCacheName,
+      ];
       return Promise.all(
         keys
           .filter(function (key) {
-            return key.indexOf(version + cacheName) !== 0;
+            return key.includes(cacheName) && !current.includes(key);
           })
           .map(function (key) {
             return caches.delete(key);
@@ -101,54 +240,70 @@ self.addEventListener("fetch", function (event): void {
 
   // Fetches that are prepended with /app_<id>/ need to be proxied to pyodide.
   // We use fetchASGI.
-  const appPathRegex = /.*\/(app_[^/]+\/)/;
+  const appPathRegex = /.*\/(app_[^/]+)\//;
   const m_appPath = appPathRegex.exec(url.pathname);
   if (m_appPath) {
+    const appName = m_appPath[1];
+    // Strip off the app root; the Python app doesn't know anything about it.
+    const appUrl = new URL(url);
+    appUrl.pathname = url.pathname.replace(appPathRegex, "/");
+
+    const fetchFromApp = async () => {
+      const appPort = await waitForApp(appName);
+      if (!appPort) {
+        return new Response(
+          `Couldn't find parent page for ${url}. This may be because the Service Worker has updated. Try reloading the page.`,
+          {
+            status: 404,
+          },
+        );
+      }
+      // Wait for the engine to have room for the request. The request body
+      // is streamed to the app from the original request, rather than read
+      // into memory first.
+      const record = trafficRecorder.recording
+        ? trafficRecorder.startHttp(
+            appName,
+            request.method,
+            url.href,
+            contentLength(request),
+          )
+        : undefined;
+      const release = await schedulerFor(appPort).acquire(
+        requestPriority(request.destination),
+      );
+      if (record) record.started = now();
+      // The request gives its place back once the response has started. If
+      // it held on until the whole body was sent, a few long downloads or
+      // streaming responses, which send at the reader's pace, would take every
+      // place, and the page's own requests would wait behind them.
+      let resp: Response;
+      try {
+        resp = await fetchASGI(appPort, appName, request, { url: appUrl });
+      } finally {
+        release();
+      }
+      return record ? recordResponse(record, resp) : resp;
+    };
+
     event.respondWith(
       (async () => {
-        // If the app URL isn't found, wait up to 250ms for it to be registered.
-        let pollCount = 5;
-        while (!apps[m_appPath[1]]) {
-          if (pollCount == 0) {
-            return new Response(
-              `Couldn't find parent page for ${url}. This may be because the Service Worker has updated. Try reloading the page.`,
-              {
-                status: 404,
-              },
-            );
-          }
-
-          console.log("App URL not registered. Waiting 50ms.");
-          await sleep(50);
-          pollCount--;
+        let resp: Response;
+        if (
+          cacheAppDependencies &&
+          request.method === "GET" &&
+          appDependencyPathRegex.test(appUrl.pathname)
+        ) {
+          resp = await fetchAppDependency(event, appUrl, fetchFromApp);
+        } else {
+          resp = await fetchFromApp();
         }
 
-        // Strip off the app root; the Python app doesn't know anything about it.
-        url.pathname = url.pathname.replace(appPathRegex, "/");
-
         // If this is the app homepage, we need to mangle the returned HTML to
         // include <script src="../shinylive-inject-socket.js"> in the <head>.
-        const isAppRoot = url.pathname === "/";
-        const filter = isAppRoot ? injectSocketFilter : identityFilter;
-
-        const blob = await request.blob();
-        const resp = await fetchASGI(
-          apps[m_appPath[1]],
-          new Request(url.toString(), {
-            method: request.method,
-            headers: request.headers,
-            body:
-              request.method === "GET" || request.method === "HEAD"
-                ? undefined
-                : blob,
-            credentials: request.credentials,
-            cache: request.cache,
-            redirect: request.redirect,
-            referrer: request.referrer,
-          }),
-          undefined,
-          filter,
-        );
+        if (appUrl.pathname === "/") {
+          resp = injectSocketScript(resp);
+        }
         if (coiRequested) {
           return addCorpHeader(resp);
         } else {
@@ -159,8 +314,12 @@ self.addEventListener("fetch", function (event): void {
     return;
   }
 
-  // Always fetch non-GET requests from the network
-  if (request.method !== "GET") {
+  // Always fetch non-GET requests from the network, except for HEAD requests
+  // for files that may be cached.
+  if (
+    request.method !== "GET" &&
+    !(useCaching && request.method === "HEAD" && isCacheable(request.url))
+  ) {
     return;
   }
 
@@ -168,27 +327,9 @@ self.addEventListener("fetch", function (event): void {
     // Try to serve the request from the cache.
     event.respondWith(
       (async (): Promise<Response> => {
-        // Search for the request in the cache; if found, return the response.
-        const cachedResponse = await caches.match(request);
-        if (cachedResponse) {
-          return cachedResponse;
-        }
-        // If we got here, it wasn't in the cache. Fetch it.
         try {
-          const networkResponse = addCoiHeaders(await fetch(request));
-
-          // If it's a local URL in shinylive/, cache it.
-          const baseUrl =
-            self.location.origin + dirname(self.location.pathname);
-          if (
-            request.url.startsWith(baseUrl + "/shinylive/") ||
-            request.url === baseUrl + "/favicon.ico"
-          ) {
-            const cache = await caches.open(version + cacheName);
-            await cache.put(request, networkResponse.clone());
-          }
-
-          return networkResponse;
+          const resp = await fetchWithCache(event, request);
+          return coiRequested ? addCoiHeaders(resp) : resp;
         } catch {
           return new Response("Failed to find in cache, or fetch.", {
             status: 404,
@@ -209,11 +350,186 @@ self.addEventListener("fetch", function (event): void {
   }
 });
 
+// =============================================================================
+// Caching
+// =============================================================================
+
+async function fetchWithCache(
+  event: FetchEvent,
+  request: Request,
+): Promise<Response> {
+  // Shinylive's pages are served from the cache straight away, if they're
+  // there, and updated in the background for next time.
+  if (request.mode === "navigate" && isShinylivePage(request.url)) {
+    return staleWhileRevalidate(event, request);
+  }
+
+  const cachedResponse = await matchCached(request.url);
+  const range = request.headers.get("Range");
+  if (cachedResponse) {
+    if (request.method === "HEAD") {
+      return headResponse(cachedResponse);
+    }
+    return range ? rangeResponse(cachedResponse, range) : cachedResponse;
+  }
+
+  const cache = await caches.open(runtimeCacheName);
+  if (request.method === "HEAD") {
+    // Whether or not the server accepts ranges, this service worker does.
+    const resp = await fetch(request);
+    if (!resp.ok || !isCacheable(request.url)) return resp;
+    const headers = new Headers(resp.headers);
+    headers.set("Accept-Ranges", "bytes");
+    return new Response(null, {
+      status: resp.status,
+      statusText: resp.statusText,
+      headers,
+    });
+  }
+
+  // A range that was fetched from the server before.
+  if (range && isCacheable(request.url)) {
+    const cachedRange = await cache.match(rangeCacheKey(request.url, range));
+    if (cachedRange) return fromStoredPartial(cachedRange);
+  }
+
+  // If we got here, it wasn't in the cache. Fetch it.
+  const networkResponse = await fetch(request);
+  if (!isCacheable(request.url)) {
+    return networkResponse;
+  }
+
+  if (networkResponse.status === 206 && range) {
+    // The server sent just the range, so cache just that.
+    await cache.put(
+      rangeCacheKey(request.url, range),
+      toStoredPartial(networkResponse.clone()),
+    );
+  } else if (networkResponse.status === 200) {
+    await cache.put(request.url, networkResponse.clone());
+    // The server ignored the range, and sent the whole thing.
+    if (range) return rangeResponse(networkResponse, range);
+  }
+
+  return networkResponse;
+}
+
+// Look for a complete copy of a file in this build's caches.
+async function matchCached(url: string): Promise<Response | undefined> {
+  if (precacheIntegrity.has(url)) {
+    const resp = await (await caches.open(precacheName)).match(url);
+    if (resp) return resp;
+  }
+  return (await caches.open(runtimeCacheName)).match(url);
+}
+
+// Local URLs in shinylive/ are cached when they're fetched.
+function isCacheable(url: string): boolean {
+  const baseUrl = self.location.origin + dirname(self.location.pathname);
+  return (
+    url.startsWith(baseUrl + "/shinylive/") || url === baseUrl + "/favicon.ico"
+  );
+}
+
+// The directories, next to the service worker, of shinylive's own pages (see
+// site_template/ and export_template/). Other pages on the site aren't
+// shinylive's to cache: they may change on every visit.
+const shinylivePageDirs = ["app", "editor", "examples", "edit"];
+
+function isShinylivePage(url: string): boolean {
+  const { origin, pathname } = new URL(url);
+  if (origin !== self.location.origin) return false;
+  const basePath = dirname(self.location.pathname);
+  return shinylivePageDirs.some(
+    (dir) =>
+      pathname === `${basePath}/${dir}/` ||
+      pathname === `${basePath}/${dir}/index.html`,
+  );
+}
+
+async function staleWhileRevalidate(
+  event: FetchEvent,
+  request: Request,
+): Promise<Response> {
+  const cache = await caches.open(runtimeCacheName);
+  // Pages don't depend on their query string, so any cached copy will do.
+  const cachedResponse = await cache.match(request, { ignoreSearch: true });
+
+  const update = fetch(request).then(async (resp) => {
+    if (resp.ok) {
+      await cache.put(request, resp.clone());
+    }
+    return resp;
+  });
+
+  if (cachedResponse) {
+    event.waitUntil(update.catch(() => {}));
+    return cachedResponse;
+  }
+  return update;
+}
+
 // =============================================================================
 // Utilities for proxying requests to pyodide
 // =============================================================================
 
-const apps = {} as Record<string, MessagePort>;
+// Each page has a channel to each of its engines (see app-registry.ts), by an
+// ID that the page chose. The other end of the port is either the engine or,
+// for engines that can't take one, a listener on the main thread that relays
+// to the engine.
+const engines = new Map<string, MessagePort>();
+
+// The port for each app, by app name.
+const apps = new Map<string, MessagePort>();
+
+// How many requests each engine is given at once (see request-scheduler.ts).
+// More than one, so that a slow request doesn't hold up the rest, but few
+// enough that the page's most important requests don't wait behind a crowd.
+const maxConcurrentAppRequests = 4;
+
+// Off until it's turned on with a "trafficRecorder" message.
+const trafficRecorder = new TrafficRecorder();
+
+function contentLength(request: Request): number | undefined {
+  const header = request.headers.get("Content-Length");
+  return header === null ? undefined : Number(header);
+}
+
+// The request queue for each engine, by its port.
+const schedulers = new WeakMap<MessagePort, RequestScheduler>();
+
+function schedulerFor(port: MessagePort): RequestScheduler {
+  let scheduler = schedulers.get(port);
+  if (!scheduler) {
+    scheduler = new RequestScheduler(maxConcurrentAppRequests);
+    schedulers.set(port, scheduler);
+  }
+  return scheduler;
+}
+
+// Requests for apps that haven't been registered yet, waiting for them to be.
+const appWaiters = new Map<string, Set<(port: MessagePort) => void>>();
+
+// If the app isn't registered yet, wait up to 250ms for it to be.
+function waitForApp(appName: string): Promise<MessagePort | undefined> {
+  const port = apps.get(appName);
+  if (port) {
+    return Promise.resolve(port);
+  }
+
+  return new Promise((resolve) => {
+    const waiters = appWaiters.get(appName) ?? new Set();
+    appWaiters.set(appName, waiters);
+    waiters.add(resolve);
+
+    setTimeout(() => {
+      if (waiters.delete(resolve)) {
+        if (waiters.size === 0) appWaiters.delete(appName);
+        resolve(undefined);
+      }
+    }, 250);
+  });
+}
 
 // When we start up a service worker, alert all clients. This is important
 // because service workers may stop at any time and then restart when needed.
@@ -235,30 +551,150 @@ const apps = {} as Record<string, MessagePort>;
 
 self.addEventListener("message", (event) => {
   const msg = event.data;
-  if (msg.type === "configureProxyPath") {
-    const path = msg.path;
-    const port = event.ports[0];
-    apps[path] = port;
+  if (msg.type === "registerApps") {
+    // Only an active service worker controls pages.
+    startBackgroundPrecache();
+
+    // Sent with a port when there's a new channel to the engine, and without
+    // one when a page adds an app to an engine it has already connected.
+    if (event.ports[0]) {
+      engines.set(msg.engineId, event.ports[0]);
+    }
+    const port = engines.get(msg.engineId);
+    if (!port) return;
+
+    for (const appName of msg.appNames as string[]) {
+      apps.set(appName, port);
+      for (const resolve of appWaiters.get(appName) ?? []) {
+        resolve(port);
+      }
+      appWaiters.delete(appName);
+    }
+  } else if (msg.type === "getRequestStats") {
+    // The request queues of a page's engines, by engine ID.
+    const stats: Record<string, SchedulerStats> = {};
+    for (const engineId of msg.engineIds as string[]) {
+      const port = engines.get(engineId);
+      const scheduler = port && schedulers.get(port);
+      if (scheduler) stats[engineId] = scheduler.stats();
+    }
+    event.ports[0].postMessage(stats);
+  } else if (msg.type === "openChannel") {
+    // A websocket from an app's page (see shinylive-inject-socket.ts), which
+    // is passed on to the app's engine.
+    const clientPort = event.ports[0];
+    event.waitUntil(
+      (async () => {
+        const appPort = await waitForApp(msg.appName);
+        if (!appPort) {
+          clientPort.close();
+          return;
+        }
+        appPort.postMessage(
+          { type: "openChannel", appName: msg.appName, path: msg.path },
+          [clientPort],
+        );
+      })(),
+    );
+  } else if (msg.type === "trafficRecorder") {
+    // Turn recording on or off, or clear it, and reply with whether it's on
+    // and, for "export", the recording as HAR.
+    if (msg.command === "start") {
+      trafficRecorder.recording = true;
+    } else if (msg.command === "stop") {
+      trafficRecorder.recording = false;
+    } else if (msg.command === "clear") {
+      trafficRecorder.clear();
+    }
+    event.ports[0]?.postMessage({
+      recording: trafficRecorder.recording,
+      har:
+        msg.command === "export"
+          ? trafficRecorder.toHar(SHINYLIVE_VERSION)
+          : undefined,
+    });
   }
 });
 
-function identityFilter(bodyChunk: Uint8Array, response: Response) {
-  return bodyChunk;
-}
+// The files in apps' lib/ directories that were extracted from the shiny and
+// htmltools wheels at build time (by scripts/app_dependencies.py), as paths
+// under lib/. Loaded the first time an app asks for one of its dependencies.
+let appDependencyManifest: Promise<Set<string>> | undefined;
 
-function injectSocketFilter(bodyChunk: Uint8Array, response: Response) {
-  const contentType = response.headers.get("content-type");
-  if (contentType && /^text\/html(;|$)/.test(contentType)) {
-    const bodyChunkStr = uint8ArrayToString(bodyChunk);
+function loadAppDependencyManifest(): Promise<Set<string>> {
+  if (!appDependencyManifest) {
     const base_path = dirname(self.location.pathname);
-    const newStr = bodyChunkStr.replace(
-      /<\/head>/,
-      `<script src="${base_path}/shinylive-inject-socket.js" type="module"></script>\n</head>`,
-    );
-    const newChunk = Uint8Array.from(
-      newStr.split("").map((s) => s.charCodeAt(0)),
-    );
-    return newChunk;
+    appDependencyManifest = (async () => {
+      try {
+        const resp = await fetch(
+          `${base_path}/shinylive/app-dependencies.json`,
+        );
+        if (!resp.ok) return new Set<string>();
+        const manifest: { files: string[] } = await resp.json();
+        return new Set(manifest.files);
+      } catch {
+        // Not built (as for the R engine): everything comes from the app.
+        return new Set<string>();
+      }
+    })();
   }
-  return bodyChunk;
+  return appDependencyManifest;
+}
+
+// Serve a file from an app's lib/ directory. If it's one of shiny's or
+// htmltools' files, serve it from the cache, or failing that from the files
+// that were extracted at build time, or from the app; and save it for the next
+// app that asks. It's cached by its path within the app, without the app's
+// name, so that all apps share it. Other files always come from the app.
+async function fetchAppDependency(
+  event: FetchEvent,
+  url: URL,
+  fetchFromApp: () => Promise<Response>,
+): Promise<Response> {
+  const file = url.pathname.replace(/^\/lib\//, "");
+  if (!(await loadAppDependencyManifest()).has(file)) {
+    return fetchFromApp();
+  }
+
+  const base_path = dirname(self.location.pathname);
+  const cacheKey = `${self.location.origin}${base_path}/app_dependencies${url.pathname}`;
+
+  const cache = await caches.open(appDependenciesCacheName);
+  const cachedResponse = await cache.match(cacheKey);
+  if (cachedResponse) {
+    return cachedResponse;
+  }
+
+  let resp: Response | undefined;
+  const staticResp = await fetch(
+    `${base_path}/shinylive/app-dependencies/${file}`,
+  ).catch(() => undefined);
+  if (staticResp?.ok) resp = staticResp;
+  resp ??= await fetchFromApp();
+
+  if (resp.status === 200) {
+    event.waitUntil(cache.put(cacheKey, resp.clone()).catch(() => {}));
+  }
+  return resp;
+}
+
+function injectSocketScript(resp: Response): Response {
+  const contentType = resp.headers.get("content-type");
+  if (!resp.body || !contentType || !/^text\/html(;|$)/.test(contentType)) {
+    return resp;
+  }
+
+  const base_path = dirname(self.location.pathname);
+  const script = new TextEncoder().encode(
+    `<script src="${base_path}/shinylive-inject-socket.js" type="module"></script>\n`,
+  );
+  // The body gets longer, so the app's content-length no longer holds.
+  const headers = new Headers(resp.headers);
+  headers.delete("content-length");
+
+  return new Response(resp.body.pipeThrough(injectBeforeHeadEnd(script)), {
+    status: resp.status,
+    statusText: resp.statusText,
+    headers,
+  });
 }
@@ -0,0 +1,41 @@
+import { parseRange, rangeCacheKey } from "./sw-range";
+
+describe("parseRange()", () => {
+  test("reads single ranges", () => {
+    expect(parseRange("bytes=0-99", 1000)).toEqual({ start: 0, end: 99 });
+    expect(parseRange("bytes=100-", 1000)).toEqual({ start: 100, end: 999 });
+    expect(parseRange("bytes=-100", 1000)).toEqual({ start: 900, end: 999 });
+  });
+
+  test("clamps ranges to the end of the resource", () => {
+    expect(parseRange("bytes=900-2000", 1000)).toEqual({
+      start: 900,
+      end: 999,
+    });
+    expect(parseRange("bytes=-2000", 1000)).toEqual({ start: 0, end: 999 });
+  });
+
+  test("reports ranges that lie outside of the resource", () => {
+    expect(parseRange("bytes=1000-", 1000)).toBe("unsatisfiable");
+    expect(parseRange("bytes=5000-6000", 1000)).toBe("unsatisfiable");
+    expect(parseRange("bytes=-0", 1000)).toBe("unsatisfiable");
+  });
+
+  test("ignores headers that it doesn't support", () => {
+    expect(parseRange("bytes=0-1,5-6", 1000)).toBeUndefined();
+    expect(parseRange("bytes=-", 1000)).toBeUndefined();
+    expect(parseRange("bytes=10-5", 1000)).toBeUndefined();
+    expect(parseRange("items=0-5", 1000)).toBeUndefined();
+  });
+});
+
+describe("rangeCacheKey()", () => {
+  test("puts the range in the query string", () => {
+    expect(rangeCacheKey("https://x.org/a.data", " bytes=0-9")).toBe(
+      "https://x.org/a.data?shinylive-range=bytes%3D0-9",
+    );
+    expect(rangeCacheKey("https://x.org/a.data?v=1", "bytes=0-9")).toBe(
+      "https://x.org/a.data?v=1&shinylive-range=bytes%3D0-9",
+    );
+  });
+});
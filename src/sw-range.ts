@@ -0,0 +1,119 @@
+// HTTP byte ranges, for the service worker to answer Range requests from the
+// cache.
+//
+// Emscripten's lazy filesystem (which webR uses for library.data.gz, among
+// others) reads files a chunk at a time with Range requests, if a HEAD request
+// says that the server accepts them. Browsers don't cache partial responses
+// well -- GitHub Pages' are not cached at all -- so the service worker keeps
+// them: either as slices of a full copy that it has cached, or as the
+// individual ranges that the server sent.
+
+// The first and last bytes of a range, inclusive, as in a Content-Range header.
+export type ByteRange = { start: number; end: number };
+
+// Parse a Range header like "bytes=0-99", "bytes=100-" or "bytes=-100" for a
+// resource of `size` bytes. Only single ranges are supported: for anything
+// else this returns undefined, and the whole resource should be sent instead.
+// For a range that lies outside of the resource, it returns "unsatisfiable".
+export function parseRange(
+  header: string,
+  size: number,
+): ByteRange | "unsatisfiable" | undefined {
+  const m = /^bytes=(\d*)-(\d*)$/.exec(header.trim());
+  if (!m || (m[1] === "" && m[2] === "")) return undefined;
+
+  let start: number;
+  let end: number;
+  if (m[1] === "") {
+    // The last N bytes.
+    const suffix = Number(m[2]);
+    if (suffix === 0) return "unsatisfiable";
+    start = Math.max(0, size - suffix);
+    end = size - 1;
+  } else {
+    start = Number(m[1]);
+    if (m[2] !== "" && Number(m[2]) < start) return undefined;
+    end = m[2] === "" ? size - 1 : Math.min(Number(m[2]), size - 1);
+  }
+
+  if (start >= size) return "unsatisfiable";
+  return { start, end };
+}
+
+// Answer a Range request from a complete response, with a 206 response that
+// has just the bytes that were asked for.
+export async function rangeResponse(
+  full: Response,
+  rangeHeader: string,
+): Promise<Response> {
+  // Slicing a Blob doesn't copy the data.
+  const body = await full.blob();
+  const range = parseRange(rangeHeader, body.size);
+  const headers = new Headers(full.headers);
+
+  if (range === undefined) {
+    headers.set("Content-Length", String(body.size));
+    return new Response(body, {
+      status: full.status,
+      statusText: full.statusText,
+      headers,
+    });
+  }
+
+  if (range === "unsatisfiable") {
+    return new Response(null, {
+      status: 416,
+      statusText: "Range Not Satisfiable",
+      headers: { "Content-Range": `bytes */${body.size}` },
+    });
+  }
+
+  const { start, end } = range;
+  // The body was decoded when it was cached, and the slice is of that.
+  headers.delete("Content-Encoding");
+  headers.set("Content-Range", `bytes ${start}-${end}/${body.size}`);
+  headers.set("Content-Length", String(end - start + 1));
+  return new Response(body.slice(start, end + 1), {
+    status: 206,
+    statusText: "Partial Content",
+    headers,
+  });
+}
+
+// Answer a HEAD request from a complete response, saying that ranges of it can
+// be requested.
+export async function headResponse(full: Response): Promise<Response> {
+  const body = await full.blob();
+  const headers = new Headers(full.headers);
+  headers.delete("Content-Encoding");
+  headers.set("Content-Length", String(body.size));
+  headers.set("Accept-Ranges", "bytes");
+  return new Response(null, {
+    status: full.status,
+    statusText: full.statusText,
+    headers,
+  });
+}
+
+// The Cache API won't store 206 responses, so partial responses from the server
+// are stored as 200s, which keep their Content-Range header, and are turned
+// back into 206s when they're read.
+export function toStoredPartial(partial: Response): Response {
+  return new Response(partial.body, { status: 200, headers: partial.headers });
+}
+
+export function fromStoredPartial(stored: Response): Response {
+  return new Response(stored.body, {
+    status: 206,
+    statusText: "Partial Content",
+    headers: stored.headers,
+  });
+}
+
+// The URL that a partial response from the server is cached under. The Cache
+// API ignores Range headers, so the range goes in the query string.
+export function rangeCacheKey(url: string, rangeHeader: string): string {
+  const key = new URL(url);
+  key.searchParams.set("shinylive-range", rangeHeader.trim());
+  return key.href;
+}
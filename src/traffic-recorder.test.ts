@@ -0,0 +1,180 @@
+import type { MessagePortWebSocket } from "./messageportwebsocket";
+import {
+  frameSize,
+  mergeHarEntries,
+  recordWebSocket,
+  TrafficRecorder,
+} from "./traffic-recorder";
+
+describe("frameSize()", () => {
+  test("counts text frames in UTF-8 bytes", () => {
+    expect(frameSize("abc")).toBe(3);
+    expect(frameSize("é")).toBe(2);
+  });
+
+  test("counts binary frames by their bytes", () => {
+    expect(frameSize(new ArrayBuffer(10))).toBe(10);
+    expect(frameSize(new Uint8Array(new ArrayBuffer(10), 2, 4))).toBe(4);
+  });
+});
+
+describe("TrafficRecorder", () => {
+  test("exports HTTP requests as HAR entries with their phases", () => {
+    const recorder = new TrafficRecorder();
+    const record = recorder.startHttp(
+      "app_1",
+      "POST",
+      "https://x.org/app_1/upload?n=2",
+      100,
+    );
+    record.queued = 1000;
+    record.started = 1005;
+    record.responded = 1025;
+    record.finished = 1065;
+    record.status = 200;
+    record.mimeType = "text/csv";
+    record.responseBytes = 5000;
+
+    const har = recorder.toHar("1.0.0");
+    expect(har.log.creator).toEqual({ name: "Shinylive", version: "1.0.0" });
+    const [entry] = har.log.entries;
+    expect(entry).toMatchObject({
+      startedDateTime: new Date(1000).toISOString(),
+      time: 65,
+      request: {
+        method: "POST",
+        queryString: [{ name: "n", value: "2" }],
+        bodySize: 100,
+      },
+      response: {
+        status: 200,
+        content: { size: 5000, mimeType: "text/csv" },
+        bodySize: 5000,
+      },
+      timings: { blocked: 5, send: 0, wait: 20, receive: 40 },
+      _appName: "app_1",
+    });
+  });
+
+  test("marks phases that haven't happened as not applying", () => {
+    const recorder = new TrafficRecorder();
+    recorder.startHttp("app_1", "GET", "https://x.org/app_1/");
+
+    const [entry] = recorder.toHar().log.entries;
+    expect(entry.request.bodySize).toBe(-1);
+    expect(entry.timings).toEqual({
+      blocked: -1,
+      send: 0,
+      wait: -1,
+      receive: -1,
+    });
+  });
+
+  test("exports websocket frames with their size and direction", () => {
+    const recorder = new TrafficRecorder();
+    const record = recorder.openWebSocket(
+      "app_1",
+      "https://x.org/app_1/websocket/",
+    );
+    recorder.addFrame(record, "send", '{"method":"init"}');
+    recorder.addFrame(record, "receive", new Uint8Array(8));
+
+    const [entry] = recorder.toHar().log.entries;
+    expect(entry._resourceType).toBe("websocket");
+    expect(entry.response.status).toBe(101);
+    expect(entry.request.bodySize).toBe(17);
+    expect(entry.response.bodySize).toBe(8);
+    expect(entry._webSocketMessages).toMatchObject([
+      { type: "send", opcode: 1, _size: 17 },
+      { type: "receive", opcode: 2, _size: 8 },
+    ]);
+  });
+
+  test("keeps only the most recent records", () => {
+    const recorder = new TrafficRecorder(2, 2);
+    for (const path of ["a", "b", "c"]) {
+      recorder.startHttp("app_1", "GET", `https://x.org/app_1/${path}`);
+    }
+    const record = recorder.openWebSocket("app_1", "https://x.org/ws");
+    for (let i = 0; i < 3; i++) recorder.addFrame(record, "send", "x");
+
+    const entries = recorder.toHar().log.entries;
+    expect(entries.map((entry) => entry.request.url).sort()).toEqual([
+      "https://x.org/app_1/b",
+      "https://x.org/app_1/c",
+      "https://x.org/ws",
+    ]);
+    const ws = entries.find((entry) => entry._resourceType === "websocket");
+    expect(ws!._webSocketMessages).toHaveLength(2);
+
+    recorder.clear();
+    expect(recorder.toHar().log.entries).toEqual([]);
+  });
+});
+
+describe("mergeHarEntries()", () => {
+  test("adds another recording's entries in order", () => {
+    const service = new TrafficRecorder();
+    service.startHttp("app_1", "GET", "https://x.org/app_1/").queued = 1000;
+    service.startHttp("app_1", "GET", "https://x.org/app_1/b").queued = 3000;
+    const engine = new TrafficRecorder();
+    engine.openWebSocket("app_1", "https://x.org/app_1/websocket/").opened =
+      2000;
+
+    const har = mergeHarEntries(
+      service.toHar("1.0.0"),
+      engine.toHar().log.entries,
+    );
+    expect(har.log.creator.version).toBe("1.0.0");
+    expect(har.log.entries.map((entry) => entry.request.url)).toEqual([
+      "https://x.org/app_1/",
+      "https://x.org/app_1/websocket/",
+      "https://x.org/app_1/b",
+    ]);
+  });
+});
+
+describe("recordWebSocket()", () => {
+  // Just enough of a MessagePortWebSocket for recordWebSocket().
+  function fakeConn() {
+    return Object.assign(new EventTarget(), {
+      onframe: undefined,
+    }) as unknown as MessagePortWebSocket;
+  }
+
+  test("records frames only while recording, from the first one", () => {
+    const recorder = new TrafficRecorder();
+    const conn = fakeConn();
+    recordWebSocket(recorder, "app_1", "https://x.org/app_1/websocket/", conn);
+
+    conn.onframe!("in", "before");
+    expect(recorder.toHar().log.entries).toEqual([]);
+
+    recorder.recording = true;
+    conn.onframe!("in", "abc");
+    conn.onframe!("out", "de");
+    recorder.recording = false;
+    conn.onframe!("out", "after");
+
+    const [entry] = recorder.toHar().log.entries;
+    expect(entry._webSocketMessages).toMatchObject([
+      { type: "send", _size: 3 },
+      { type: "receive", _size: 2 },
+    ]);
+  });
+
+  test("starts a new record after the recording is cleared", () => {
+    const recorder = new TrafficRecorder();
+    recorder.recording = true;
+    const conn = fakeConn();
+    recordWebSocket(recorder, "app_1", "https://x.org/app_1/websocket/", conn);
+
+    conn.onframe!("in", "abc");
+    recorder.clear();
+    conn.onframe!("in", "de");
+
+    const entries = recorder.toHar().log.entries;
+    expect(entries).toHaveLength(1);
+    expect(entries[0]._webSocketMessages).toMatchObject([{ _size: 2 }]);
+  });
+});
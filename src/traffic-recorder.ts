@@ -0,0 +1,371 @@
+// A recorder of the traffic between apps' pages and their engines.
+//
+// Requests for /app_<id>/ paths are answered by the service worker, and
+// websocket frames travel over MessagePorts, so none of it shows up in the
+// browser's network panel. When recording is turned on, the service worker
+// notes each app request, with its size and how long it spent in each phase:
+// waiting for a place in the engine (see request-scheduler.ts), in the engine
+// until the response started, and streaming the response body. Websocket
+// frames are noted, with their size and direction, by the engine's end of
+// each MessagePortWebSocket, in engines that were loaded with metrics on. The
+// recordings can be exported as a HAR file, which DevTools and other HAR
+// viewers can open.
+//
+// Recording is off by default, and costs nothing then. The records are kept in
+// ring buffers, so memory use is bounded however long it's left on. Recording
+// is controlled with TrafficRecorderCommands, which window.shinylive.traffic
+// sends to the service worker (see trafficRecorder() in app-registry.ts) and to
+// each engine, so that they record over the same span of time. Note that the
+// browser can stop the service worker when it's idle, which loses what it has
+// recorded.
+
+import type { MessagePortWebSocket } from "./messageportwebsocket";
+import { now, RingBuffer } from "./rpc-metrics";
+
+export type TrafficRecorderCommand = "start" | "stop" | "clear" | "export";
+
+// Times are in milliseconds since the Unix epoch.
+export type HttpRecord = {
+  appName: string;
+  method: string;
+  url: string;
+  // Not known when the request has no Content-Length.
+  requestBytes?: number;
+  status?: number;
+  mimeType?: string;
+  responseBytes: number;
+  // When the request arrived, went into the engine, started getting a
+  // response, and got the end of the response body.
+  queued: number;
+  started?: number;
+  responded?: number;
+  finished?: number;
+};
+
+export type WebSocketFrame = {
+  time: number;
+  // "send" is from the app's page to the engine, as in a browser's HAR files.
+  direction: "send" | "receive";
+  // 1 for text, 2 for binary.
+  opcode: 1 | 2;
+  size: number;
+};
+
+export type WebSocketRecord = {
+  appName: string;
+  url: string;
+  opened: number;
+  closed?: number;
+  frames: RingBuffer<WebSocketFrame>;
+};
+
+// The subset of HAR 1.2 that's filled in. Custom fields start with an
+// underscore, and websocket frames are in `_webSocketMessages`, as in the HAR
+// files that Chrome writes.
+export type Har = {
+  log: {
+    version: "1.2";
+    creator: { name: string; version: string };
+    entries: HarEntry[];
+  };
+};
+
+export type HarEntry = {
+  startedDateTime: string;
+  time: number;
+  request: {
+    method: string;
+    url: string;
+    httpVersion: string;
+    headers: [];
+    queryString: { name: string; value: string }[];
+    cookies: [];
+    headersSize: -1;
+    bodySize: number;
+  };
+  response: {
+    status: number;
+    statusText: string;
+    httpVersion: string;
+    headers: [];
+    cookies: [];
+    content: { size: number; mimeType: string };
+    redirectURL: string;
+    headersSize: -1;
+    bodySize: number;
+  };
+  cache: Record<string, never>;
+  timings: { blocked: number; send: number; wait: number; receive: number };
+  _appName: string;
+  _resourceType?: "websocket";
+  _webSocketMessages?: {
+    type: "send" | "receive";
+    // Seconds since the Unix epoch.
+    time: number;
+    opcode: 1 | 2;
+    // Only the sizes of frames are recorded, not their contents.
+    data: "";
+    _size: number;
+  }[];
+};
+
+const textEncoder = new TextEncoder();
+
+export class TrafficRecorder {
+  recording = false;
+  // Counts the calls to clear(), so that a record from before one can be told
+  // apart from the records in the recording.
+  generation = 0;
+  private http: RingBuffer<HttpRecord>;
+  private websockets: RingBuffer<WebSocketRecord>;
+
+  constructor(
+    capacity = 1000,
+    private readonly framesPerWebSocket = 10000,
+  ) {
+    this.http = new RingBuffer(capacity);
+    this.websockets = new RingBuffer(capacity);
+  }
+
+  // Note a request that just arrived. The caller fills in the rest of the
+  // record as the request goes on; it's in the recording already, so that
+  // requests that never finish show up too.
+  startHttp(
+    appName: string,
+    method: string,
+    url: string,
+    requestBytes?: number,
+  ): HttpRecord {
+    const record: HttpRecord = {
+      appName,
+      method,
+      url,
+      requestBytes,
+      responseBytes: 0,
+      queued: now(),
+    };
+    this.http.push(record);
+    return record;
+  }
+
+  openWebSocket(appName: string, url: string): WebSocketRecord {
+    const record: WebSocketRecord = {
+      appName,
+      url,
+      opened: now(),
+      frames: new RingBuffer(this.framesPerWebSocket),
+    };
+    this.websockets.push(record);
+    return record;
+  }
+
+  addFrame(
+    record: WebSocketRecord,
+    direction: WebSocketFrame["direction"],
+    data: unknown,
+  ): void {
+    const text = typeof data === "string";
+    record.frames.push({
+      time: now(),
+      direction,
+      opcode: text ? 1 : 2,
+      size: frameSize(data),
+    });
+  }
+
+  clear(): void {
+    this.generation++;
+    this.http = new RingBuffer(this.http.capacity);
+    this.websockets = new RingBuffer(this.websockets.capacity);
+  }
+
+  toHar(creatorVersion = ""): Har {
+    const entries = [
+      ...this.http.toArray().map(httpEntry),
+      ...this.websockets.toArray().map(webSocketEntry),
+    ].sort((a, b) => a.startedDateTime.localeCompare(b.startedDateTime));
+    return {
+      log: {
+        version: "1.2",
+        creator: { name: "Shinylive", version: creatorVersion },
+        entries,
+      },
+    };
+  }
+}
+
+// The size of a websocket frame in bytes, as it would be on the wire.
+export function frameSize(data: unknown): number {
+  if (typeof data === "string") return textEncoder.encode(data).length;
+  if (data instanceof ArrayBuffer) return data.byteLength;
+  if (ArrayBuffer.isView(data)) return data.byteLength;
+  if (data instanceof Blob) return data.size;
+  return 0;
+}
+
+// Wrap a response from the app so that its body is counted as it's read, and
+// the record gets the time that the last of it was read.
+export function recordResponse(record: HttpRecord, resp: Response): Response {
+  record.responded = now();
+  record.status = resp.status;
+  record.mimeType = resp.headers.get("Content-Type") ?? undefined;
+  if (!resp.body) {
+    record.finished = record.responded;
+    return resp;
+  }
+
+  const counter = new TransformStream<Uint8Array, Uint8Array>({
+    transform(chunk, controller) {
+      record.responseBytes += chunk.byteLength;
+      controller.enqueue(chunk);
+    },
+    flush() {
+      record.finished = now();
+    },
+  });
+  return new Response(resp.body.pipeThrough(counter), {
+    status: resp.status,
+    statusText: resp.statusText,
+    headers: resp.headers,
+  });
+}
+
+// Record the frames on the engine's end of a websocket, while `recorder` is
+// recording. Frames that the engine receives were sent by the app's page. The
+// websocket is added to the recording with its first recorded frame, so one
+// that was opened before recording started, as an app's usually is, shows up
+// too.
+export function recordWebSocket(
+  recorder: TrafficRecorder,
+  appName: string,
+  url: string,
+  conn: MessagePortWebSocket,
+): void {
+  let record: WebSocketRecord | undefined;
+  let generation = recorder.generation;
+  conn.onframe = (direction, data) => {
+    if (!recorder.recording) return;
+    if (!record || generation !== recorder.generation) {
+      record = recorder.openWebSocket(appName, url);
+      generation = recorder.generation;
+    }
+    recorder.addFrame(record, direction === "in" ? "send" : "receive", data);
+  };
+  conn.addEventListener("close", () => {
+    if (record) record.closed ??= now();
+  });
+}
+
+// Add entries from another recording, such as an engine's websockets, to a HAR
+// file, keeping them in order.
+export function mergeHarEntries(har: Har, entries: HarEntry[]): Har {
+  return {
+    log: {
+      ...har.log,
+      entries: [...har.log.entries, ...entries].sort((a, b) =>
+        a.startedDateTime.localeCompare(b.startedDateTime),
+      ),
+    },
+  };
+}
+
+// A span of time in milliseconds, or -1 (HAR's "doesn't apply") if either end
+// is missing.
+function span(start: number | undefined, end: number | undefined): number {
+  if (start === undefined || end === undefined) return -1;
+  return end - start;
+}
+
+function queryString(url: string): { name: string; value: string }[] {
+  try {
+    return Array.from(new URL(url).searchParams, ([name, value]) => ({
+      name,
+      value,
+    }));
+  } catch {
+    return [];
+  }
+}
+
+function httpEntry(record: HttpRecord): HarEntry {
+  const end = record.finished ?? record.responded ?? record.started;
+  return {
+    startedDateTime: new Date(record.queued).toISOString(),
+    time: Math.max(0, span(record.queued, end)),
+    request: {
+      method: record.method,
+      url: record.url,
+      httpVersion: "HTTP/1.1",
+      headers: [],
+      queryString: queryString(record.url),
+      cookies: [],
+      headersSize: -1,
+      bodySize: record.requestBytes ?? -1,
+    },
+    response: {
+      status: record.status ?? 0,
+      statusText: "",
+      httpVersion: "HTTP/1.1",
+      headers: [],
+      cookies: [],
+      content: { size: record.responseBytes, mimeType: record.mimeType ?? "" },
+      redirectURL: "",
+      headersSize: -1,
+      bodySize: record.responseBytes,
+    },
+    cache: {},
+    timings: {
+      blocked: span(record.queued, record.started),
+      send: 0,
+      wait: span(record.started, record.responded),
+      receive: span(record.responded, record.finished),
+    },
+    _appName: record.appName,
+  };
+}
+
+function webSocketEntry(record: WebSocketRecord): HarEntry {
+  const frames = record.frames.toArray();
+  const received = frames
+    .filter((frame) => frame.direction === "receive")
+    .reduce((n, frame) => n + frame.size, 0);
+  const sent = frames
+    .filter((frame) => frame.direction === "send")
+    .reduce((n, frame) => n + frame.size, 0);
+  return {
+    startedDateTime: new Date(record.opened).toISOString(),
+    time: Math.max(0, span(record.opened, record.closed)),
+    request: {
+      method: "GET",
+      url: record.url,
+      httpVersion: "HTTP/1.1",
+      headers: [],
+      queryString: [],
+      cookies: [],
+      headersSize: -1,
+      bodySize: sent,
+    },
+    response: {
+      status: 101,
+      statusText: "Switching Protocols",
+      httpVersion: "HTTP/1.1",
+      headers: [],
+      cookies: [],
+      content: { size: received, mimeType: "" },
+      redirectURL: "",
+      headersSize: -1,
+      bodySize: received,
+    },
+    cache: {},
+    timings: { blocked: -1, send: 0, wait: 0, receive: 0 },
+    _appName: record.appName,
+    _resourceType: "websocket",
+    _webSocketMessages: frames.map((frame) => ({
+      type: frame.direction,
+      time: frame.time / 1000,
+      opcode: frame.opcode,
+      data: "",
+      _size: frame.size,
+    })),
+  };
+}
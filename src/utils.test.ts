@@ -13,6 +13,7 @@ import {
   sleep,
   stringToArrayBuffer,
   stringToUint8Array,
+  transferList,
   uint8ArrayToString,
 } from "./utils";
 
@@ -144,6 +145,24 @@ describe("string/byte conversions", () => {
   });
 });
 
+describe("transferList()", () => {
+  test("transfers the buffer behind a whole-buffer view", () => {
+    const bytes = new Uint8Array([1, 2, 3]);
+    expect(transferList(bytes)).toEqual([bytes.buffer]);
+  });
+
+  test("doesn't transfer views of part of a buffer", () => {
+    const buffer = new ArrayBuffer(8);
+    expect(transferList(new Uint8Array(buffer, 2))).toEqual([]);
+    expect(transferList(new Uint8Array(buffer, 0, 4))).toEqual([]);
+  });
+
+  test("doesn't transfer anything that isn't binary data", () => {
+    expect(transferList("text")).toEqual([]);
+    expect(transferList(undefined)).toEqual([]);
+  });
+});
+
 describe("makeRandomKey()", () => {
   test("has the requested length, defaulting to 5", () => {
     expect(makeRandomKey()).toHaveLength(5);
@@ -151,6 +151,22 @@ export function stringToUint8Array(s: string): Uint8Array {
   return bytes;
 }
 
+// Return a postMessage() transfer list for `data`, so that its buffer is moved
+// to the receiver instead of copied. This is only safe when the sender won't
+// use the data again, and only done when `data` spans its whole buffer, since
+// transferring detaches the entire buffer from this side.
+export function transferList(data: unknown): Transferable[] {
+  if (
+    ArrayBuffer.isView(data) &&
+    data.buffer instanceof ArrayBuffer &&
+    data.byteOffset === 0 &&
+    data.byteLength === data.buffer.byteLength
+  ) {
+    return [data.buffer];
+  }
+  return [];
+}
+
 export function engineSwitch<T>(
   engine: AppEngine,
   rValue: T,
@@ -0,0 +1,66 @@
+"""The Python that usePyodide.tsx runs to set up each engine.
+
+It lives in a JS template literal, where escapes are JS's: a `\\n` meant for
+Python has to be written `\\\\n`, or it turns into a real newline inside a
+Python string, and no engine can boot. This renders the template the way JS
+does and compiles the result, without a browser.
+"""
+
+from __future__ import annotations
+
+import ast
+from pathlib import Path
+
+import pytest
+
+pytestmark = pytest.mark.site
+
+USE_PYODIDE = Path(__file__).parent.parent / "src" / "hooks" / "usePyodide.tsx"
+
+# What a backslash followed by this character means in a JS template literal.
+# Any other character stands for itself.
+_JS_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "0": "\0", "\n": ""}
+
+
+def _render_template_concat(source: str, name: str) -> str:
+    """
+    The value of `const <name> = `...` + `...`;`, which is a concatenation of
+    template literals without substitutions, with comments between them.
+    """
+    i = source.index(f"const {name} =") + len(f"const {name} =")
+    parts: list[str] = []
+    while True:
+        c = source[i]
+        if c in " \n+":
+            i += 1
+        elif source.startswith("//", i):
+            i = source.index("\n", i)
+        elif c == ";":
+            return "".join(parts)
+        elif c == "`":
+            i += 1
+            while source[i] != "`":
+                if source.startswith("${", i):
+                    raise AssertionError(f"{name} has a substitution")
+                if source[i] == "\\":
+                    parts.append(_JS_ESCAPES.get(source[i + 1], source[i + 1]))
+                    i += 2
+                else:
+                    parts.append(source[i])
+                    i += 1
+            i += 1
+        else:
+            raise AssertionError(f"Unexpected {c!r} in {name}")
+
+
+def test_bootstrap_python_compiles() -> None:
+    python = _render_template_concat(USE_PYODIDE.read_text(), "load_python_pre")
+    assert "def _start_app" in python
+    # The bootstrap is run with runPythonAsync(), which allows top-level await.
+    compile(
+        python,
+        "<load_python_pre>",
+        "exec",
+        flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT,
+        dont_inherit=True,
+    )